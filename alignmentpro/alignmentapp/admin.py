@@ -23,7 +23,12 @@
 #
 ##################################################
 
+from functools import reduce
+from operator import or_
+
 from django.contrib import admin
+from django.db import transaction
+from django.db.models import Q
 
 from treebeard.admin import TreeAdmin
 from treebeard.forms import movenodeform_factory
@@ -37,30 +42,60 @@ from alignmentapp.models import (
     SubjectArea,
     UserAction,
     UserProfile,
-    DocumentSection
+    DocumentSection,
+    Tombstone,
 )
 
 
+class TombstoneAdminMixin(object):
+    """
+    Leave tombstones (for delta data exports) for the rows deleted in the admin,
+    with the `bury(queryset)` method of the model admins using this mixin.
+    """
+
+    def delete_model(self, request, obj):
+        self.delete_queryset(request, self.model.objects.filter(pk=obj.pk))
+
+    def delete_queryset(self, request, queryset):
+        with transaction.atomic():
+            self.bury(queryset)
+            queryset.delete()
+
+
 @admin.register(CurriculumDocument)
-class CurriculumDocumentAdmin(admin.ModelAdmin):
+class CurriculumDocumentAdmin(TombstoneAdminMixin, admin.ModelAdmin):
     list_display = ["country", "title", "source_id"]
     list_filter = ("country", "digitization_method", "is_draft")
     search_fields = ["source_id", "title"]
     model = CurriculumDocument
 
+    def bury(self, queryset):
+        Tombstone.bury_nodes(StandardNode.objects.filter(document__in=queryset))
+
 
 @admin.register(StandardNode)
-class StandardNodeAdmin(TreeAdmin):
+class StandardNodeAdmin(TombstoneAdminMixin, TreeAdmin):
     # list_display = ["title"]
     list_filter = ("document__country", "document")
     search_fields = ["identifier", "title", "notes"]
     form = movenodeform_factory(StandardNode)
 
+    def bury(self, queryset):
+        # deleting nodes also deletes their descendants
+        paths = list(queryset.values_list("path", flat=True))
+        if paths:
+            subtrees = reduce(or_, [Q(path__startswith=path) for path in paths])
+            Tombstone.bury_nodes(StandardNode.objects.filter(subtrees))
+
 
 @admin.register(HumanRelevanceJudgment)
-class HumanRelevanceJudgmentAdmin(admin.ModelAdmin):
+class HumanRelevanceJudgmentAdmin(TombstoneAdminMixin, admin.ModelAdmin):
     model = HumanRelevanceJudgment
 
+    def bury(self, queryset):
+        judgment_ids = list(queryset.values_list("id", flat=True))
+        Tombstone.bury(HumanRelevanceJudgment, judgment_ids)
+
 
 @admin.register(Parameter)
 class ParameterAdmin(admin.ModelAdmin):
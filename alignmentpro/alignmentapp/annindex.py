@@ -0,0 +1,164 @@
+##################################################
+# MIT License
+#
+# Copyright (c) 2019 Learning Equality
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+##################################################
+
+import os
+
+import numpy as np
+
+
+ANN_INDEX_FILENAME = "ann_ivf.npz"
+EMBEDDINGS_FILENAME = "embeddings.npy"
+DEFAULT_NPROBE = 8
+ASSIGN_BATCH_SIZE = 4096
+
+
+class IVFIndex(object):
+    """
+    Inverted-file (IVF) approximate nearest-neighbour index over the rows of a
+    model's embeddings. The embeddings are clustered with spherical k-means and
+    each row is stored in the list of its closest centroid. A query only scores
+    the rows in the `nprobe` lists whose centroids best match the query.
+
+    The index also records the (n, mtime_ns, size) `source` of the embeddings
+    file it was built from, so that an index left behind by an older version of
+    the model is detected by `matches` instead of returning wrong rows.
+    """
+
+    def __init__(self, centroids, offsets, rows, source=None):
+        self.centroids = centroids  # nlist x d float32
+        self.offsets = offsets  # nlist + 1 offsets into rows
+        self.rows = rows  # embedding rows grouped by list
+        self.source = source  # (n, mtime_ns, size) of the embeddings file
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, embeddings, nlist=None, niter=20, seed=0):
+        """
+        Cluster `embeddings` into `nlist` lists (default ~ 4 * sqrt(N)).
+        """
+        vectors = _normalized(np.asarray(embeddings, dtype=np.float32))
+        n = len(vectors)
+        if nlist is None:
+            nlist = int(4 * np.sqrt(n))
+        nlist = max(1, min(nlist, n))
+
+        rng = np.random.RandomState(seed)
+        centroids = vectors[rng.choice(n, nlist, replace=False)].copy()
+        for _ in range(niter):
+            assignments = _assign(vectors, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, vectors)
+            counts = np.bincount(assignments, minlength=nlist)
+            empty = counts == 0
+            # re-seed empty clusters with random vectors
+            sums[empty] = vectors[rng.choice(n, int(empty.sum()))]
+            centroids = _normalized(sums)
+
+        assignments = _assign(vectors, centroids)
+        rows = np.argsort(assignments, kind="stable").astype(np.int64)
+        counts = np.bincount(assignments, minlength=nlist)
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return cls(centroids, offsets, rows)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            source = tuple(data["source"].tolist()) if "source" in data else None
+            return cls(data["centroids"], data["offsets"], data["rows"], source)
+
+    def save(self, path):
+        """
+        Write the index to `path` (atomically, via a temporary file).
+        """
+        tmppath = path + ".tmp.npz"
+        arrays = dict(centroids=self.centroids, offsets=self.offsets, rows=self.rows)
+        if self.source is not None:
+            arrays["source"] = np.array(self.source, dtype=np.int64)
+        np.savez(tmppath, **arrays)
+        os.replace(tmppath, path)
+
+    def matches(self, embeddingspath, n):
+        """
+        Check that the index was built from the current `n` rows of the
+        embeddings file at `embeddingspath`.
+        """
+        return self.source is not None and self.source == embeddings_source(
+            embeddingspath, n
+        )
+
+    def candidates(self, query, nprobe=DEFAULT_NPROBE):
+        """
+        Return the embedding rows stored in the `nprobe` lists closest to `query`.
+        """
+        nprobe = max(1, min(int(nprobe), self.nlist))
+        scores = np.dot(self.centroids, np.asarray(query, dtype=np.float32))
+        if nprobe < self.nlist:
+            probes = np.argpartition(-scores, nprobe - 1)[:nprobe]
+        else:
+            probes = np.arange(self.nlist)
+        return np.concatenate(
+            [self.rows[self.offsets[p] : self.offsets[p + 1]] for p in probes]
+        )
+
+
+def _normalized(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def _assign(vectors, centroids):
+    """
+    Index of the closest centroid (by inner product) for each vector, computed
+    in batches to keep the n x nlist score matrix small.
+    """
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), ASSIGN_BATCH_SIZE):
+        batch = vectors[start : start + ASSIGN_BATCH_SIZE]
+        assignments[start : start + len(batch)] = np.argmax(
+            np.dot(batch, centroids.T), axis=1
+        )
+    return assignments
+
+
+def embeddings_source(embeddingspath, n):
+    stat = os.stat(embeddingspath)
+    return (int(n), stat.st_mtime_ns, stat.st_size)
+
+
+def build_ann_index(modeldirpath, nlist=None, niter=20):
+    """
+    Build the IVF index for the model in `modeldirpath` from its embeddings.npy
+    and save it next to it as `ANN_INDEX_FILENAME`.
+    """
+    embeddingspath = os.path.join(modeldirpath, EMBEDDINGS_FILENAME)
+    embeddings = np.load(embeddingspath, mmap_mode="r")
+    index = IVFIndex.build(embeddings, nlist=nlist, niter=niter)
+    index.source = embeddings_source(embeddingspath, len(embeddings))
+    index.save(os.path.join(modeldirpath, ANN_INDEX_FILENAME))
+    return index
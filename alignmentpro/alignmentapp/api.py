@@ -26,12 +26,12 @@
 import json
 import os
 import re
-import shutil
 import urllib.request
 
 from django.contrib.auth.models import User
 from django.conf import settings
 from django.conf.urls import url, include
+from django.db import transaction
 from django.db.models import Count, Sum
 from django.db.models.functions import Coalesce
 from django.utils import timezone
@@ -40,11 +40,12 @@ from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import serializers, viewsets, views, status, response
 from rest_framework.authentication import SessionAuthentication
 from rest_framework.authentication import TokenAuthentication
+from rest_framework.decorators import action
 from rest_framework.decorators import api_view
 from rest_framework.decorators import authentication_classes
 from rest_framework.decorators import permission_classes
 from rest_framework.permissions import IsAuthenticated
-from rest_framework.exceptions import APIException
+from rest_framework.exceptions import APIException, ValidationError
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.permissions import IsAuthenticatedOrReadOnly, AllowAny
 from rest_framework.response import Response
@@ -54,10 +55,21 @@ from .models import (
     DocumentSection,
     StandardNode,
     HumanRelevanceJudgment,
+    Parameter,
+    Tombstone,
     UserAction,
 )
-from .schedulers import prob_weighted_random
-from .recommenders import recommend_top_ranked
+from .hydration import hydrate_children, hydrate_nodes
+from .judgedpairs import record_judgment
+from .modelruns import get_queue_status
+from .modelstore import DIRTY_FILENAME, convert_embeddings_to_float32
+from .modelstore import copy_atomically
+from .pairqueue import is_queueable, pop_pair
+from .schedulers import MAX_PAIRS
+from .schedulers import prob_weighted_random, prob_weighted_random_pairs
+from .splitting import get_test_size, is_test_pair
+from .recommenders import ENGINES, recommend_top_ranked
+from .treemetrics import compute_tree_metrics
 
 
 class CurriculumDocumentSerializer(serializers.ModelSerializer):
@@ -81,6 +93,9 @@ class CurriculumDocumentSerializer(serializers.ModelSerializer):
         ]
 
     def get_root_node_id(self, obj):
+        # set by hydration.hydrate_nodes to avoid one query per document
+        if hasattr(obj, "hydrated_root_node_id"):
+            return obj.hydrated_root_node_id
         try:
             return StandardNode.objects.get(depth=1, document_id=obj.id).id
         except:
@@ -113,6 +128,23 @@ class CurriculumDocumentViewSet(viewsets.ModelViewSet):
         else:
             return self.queryset.filter(is_draft=False)
 
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            Tombstone.bury_nodes(StandardNode.objects.filter(document=instance))
+            instance.delete()
+
+    @action(detail=True)
+    def tree_metrics(self, request, pk=None):
+        """
+        The parent, depth, height, and number of leaves and descendants of every
+        node in the document, computed from one query over the document's nodes.
+        """
+        document = self.get_object()
+        nodes = StandardNode.objects.filter(document=document).order_by("path")
+        rows = list(nodes.values("id", "path"))
+        metrics = compute_tree_metrics(rows)
+        return Response([dict(metrics[row["id"]], id=row["id"]) for row in rows])
+
 
 BASE_NODE_FIELDS = [
     "id",
@@ -182,20 +214,42 @@ class StandardNodeViewSet(viewsets.ModelViewSet):
             if scheduler == "fullyrandom":
                 queryset = queryset.order_by("?")[:2]
             elif scheduler == "random":
-                gamma = float(params.get("gamma", 20.0))
-                left_root_id = int(params.get("left_root_id", 0)) or None
-                right_root_id = int(params.get("right_root_id", 0)) or None
-                allow_same_doc = bool(params.get("allow_same_doc", False))
-                include_nonleaf_nodes = bool(params.get("include_nonleaf_nodes", False))
-                relevance, probability, distribution, queryset = prob_weighted_random(
-                    queryset,
-                    model_name="baseline",
-                    gamma=gamma,
-                    left_root_id=left_root_id,
-                    right_root_id=right_root_id,
-                    allow_same_doc=allow_same_doc,
-                    include_nonleaf_nodes=include_nonleaf_nodes,
+                scheduler_params = dict(
+                    gamma=float(params.get("gamma", 20.0)),
+                    left_root_id=int(params.get("left_root_id", 0)) or None,
+                    right_root_id=int(params.get("right_root_id", 0)) or None,
+                    allow_same_doc=bool(params.get("allow_same_doc", False)),
+                    include_nonleaf_nodes=bool(
+                        params.get("include_nonleaf_nodes", False)
+                    ),
+                    max_judgments=int(params.get("max_judgments", 0)) or None,
+                )
+                # skip the pairs the user already judged
+                if request.user.is_authenticated and params.get("unjudged_by_me"):
+                    scheduler_params["exclude_judged_by"] = request.user.id
+                num_pairs = params.get("pairs", "0")
+                if not num_pairs.isdigit():
+                    raise ValidationError({"pairs": "Must be a non-negative integer."})
+                num_pairs = min(int(num_pairs), MAX_PAIRS)
+                if num_pairs:
+                    return self.list_pairs(queryset, num_pairs, **scheduler_params)
+                # serve logged in users from their queue of pre-sampled pairs
+                pair = None
+                use_queue = params.get("queue") != "0" and is_queueable(
+                    scheduler_params
                 )
+                if request.user.is_authenticated and use_queue:
+                    pair = pop_pair(request.user.id, scheduler_params)
+                if pair is not None:
+                    relevance = pair.relevance
+                    probability = pair.probability
+                    distribution = None  # not computed for queued pairs
+                    queryset = queryset.filter(id__in=[pair.node1_id, pair.node2_id])
+                else:
+                    result = prob_weighted_random(
+                        queryset, model_name="baseline", **scheduler_params
+                    )
+                    relevance, probability, distribution, queryset = result
             else:
                 raise APIException("Unknown scheduler!")
         else:
@@ -215,6 +269,36 @@ class StandardNodeViewSet(viewsets.ModelViewSet):
             }
         )
 
+    def list_pairs(self, queryset, num_pairs, **kwargs):
+        """
+        Batch mode of the random scheduler (`?scheduler=random&pairs=K`): K pairs
+        (at most MAX_PAIRS) sampled in one pass, with all their distinct nodes
+        serialized once with a fixed number of queries.
+        """
+        pairs, queryset = prob_weighted_random_pairs(
+            queryset, num_pairs, model_name="baseline", **kwargs
+        )
+        node_ids = {p["left_id"] for p in pairs} | {p["right_id"] for p in pairs}
+        nodes = hydrate_children(hydrate_nodes(queryset, sorted(node_ids)))
+        serializer = StandardNodePairSerializer(
+            nodes, many=True, context={"request": self.request}
+        )
+        return Response(
+            {
+                "count": len(pairs),
+                "next": None,
+                "previous": None,
+                "pairs": pairs,
+                "results": serializer.data,
+            }
+        )
+
+    def perform_destroy(self, instance):
+        # deleting a node also deletes its descendants
+        with transaction.atomic():
+            Tombstone.bury_nodes(StandardNode.get_tree(instance))
+            instance.delete()
+
 
 class HumanRelevanceJudgmentSerializer(serializers.ModelSerializer):
     node1 = serializers.PrimaryKeyRelatedField(queryset=StandardNode.objects.all())
@@ -251,7 +335,21 @@ class HumanRelevanceJudgmentViewSet(viewsets.ModelViewSet):
             return self.queryset.filter(is_test_data=False)
 
     def perform_create(self, serializer):
-        serializer.save(user=self.request.user)
+        # assign the train/test split at ingest time, based on the node pair
+        node1 = serializer.validated_data["node1"]
+        node2 = serializer.validated_data["node2"]
+        try:
+            is_test_data = is_test_pair(node1.id, node2.id, get_test_size())
+        except Parameter.DoesNotExist:
+            is_test_data = None  # will be set by the next data export
+        judgment = serializer.save(user=self.request.user, is_test_data=is_test_data)
+        # so that the scheduler of this process doesn't offer the pair again
+        record_judgment(judgment)
+
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            Tombstone.bury(HumanRelevanceJudgment, [instance.id])
+            instance.delete()
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -340,15 +438,20 @@ class TrainedModelViewSet(viewsets.ViewSet):
             with open(os.path.join(exportpath, "metadata.json"), "w") as f:
                 json.dump(data, f)
 
+            # mark the model dirty before touching its files, so that no process
+            # reloads the model while they are being replaced
+            with open(os.path.join(export_base_dir, DIRTY_FILENAME), "w") as f:
+                f.write("dirty")
+
             # copy the contents of the timestamped folder into parent folder
             src_files = os.listdir(exportpath)
             for file_name in src_files:
                 full_file_name = os.path.join(exportpath, file_name)
                 if os.path.isfile(full_file_name):
-                    shutil.copy(full_file_name, os.path.join(exportpath, ".."))
-
-            with open(os.path.join(exportpath, "..", "dirty"), "w") as f:
-                f.write("dirty")
+                    copy_atomically(
+                        full_file_name, os.path.join(export_base_dir, file_name)
+                    )
+            convert_embeddings_to_float32(export_base_dir)
 
             scores_path = os.path.join(exportpath, "..", "scores.json")
             if os.path.exists(scores_path):
@@ -371,6 +474,19 @@ class TrainedModelViewSet(viewsets.ViewSet):
     # return response.Response(data, status=200)
 
 
+class ModelQueueView(views.APIView):
+    """
+    Shows which submitted models are waiting, running, done or failed in
+    `manage.py runmodels`, with the timing and log of their last run.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        base_dir = os.path.join(settings.MEDIA_ROOT, "models")
+        return Response(get_queue_status(base_dir))
+
+
 class LeaderboardView(views.APIView):
     queryset = User.objects.all()
 
@@ -384,7 +500,7 @@ class LeaderboardView(views.APIView):
 
 
 class StandardNodeRecommendationSerializer(BaseStandardNodeSerializer):
-    ancestors = BaseStandardNodeSerializer(source="get_ancestors", many=True)
+    ancestors = serializers.SerializerMethodField()
     document = CurriculumDocumentSerializer()
     # relevance = serializers.SerializerMethodField()
 
@@ -392,10 +508,41 @@ class StandardNodeRecommendationSerializer(BaseStandardNodeSerializer):
         model = StandardNode
         fields = BASE_NODE_FIELDS + ["document", "ancestors"]
 
+    def get_ancestors(self, obj):
+        # set by hydration.hydrate_nodes to avoid one query per node
+        ancestors = getattr(obj, "hydrated_ancestors", None)
+        if ancestors is None:
+            ancestors = obj.get_ancestors()
+        return BaseStandardNodeSerializer(
+            ancestors, many=True, context=self.context
+        ).data
+
     # def get_relevance(self, obj):
     #     return obj.relevance
 
 
+class StandardNodePairSerializer(StandardNodeRecommendationSerializer):
+    """
+    The nodes of the pairs of the batched random scheduler, with the ancestors
+    and children set by `hydration` instead of the queries per node that
+    `StandardNodeSerializer` makes (its siblings and judgments are left out).
+    """
+
+    children = serializers.SerializerMethodField()
+
+    class Meta:
+        model = StandardNode
+        fields = BASE_NODE_FIELDS + ["document", "ancestors", "children"]
+
+    def get_children(self, obj):
+        children = getattr(obj, "hydrated_children", None)
+        if children is None:
+            children = obj.get_children()
+        return BaseStandardNodeSerializer(
+            children, many=True, context=self.context
+        ).data
+
+
 class StandardNodeRecommendationViewSet(viewsets.ModelViewSet):
     queryset = StandardNode.objects.all()
     serializer_class = StandardNodeRecommendationSerializer
@@ -408,13 +555,20 @@ class StandardNodeRecommendationViewSet(viewsets.ModelViewSet):
         threshold = params.get("threshold")
         count = params.get("count", None if threshold else 10)
         model = params.get("model", "baseline")
-        target_node = StandardNode.objects.get(id=int(target))
+        engine = params.get("engine", "exact")
+        if engine not in ENGINES:
+            raise APIException("Unknown recommendation engine!")
+        hydrated = hydrate_nodes(StandardNode.objects.all(), [int(target)])
+        if not hydrated:
+            raise StandardNode.DoesNotExist("No StandardNode with id " + target)
+        target_node = hydrated[0]
         relevances, results = recommend_top_ranked(
             queryset=queryset,
             target_node=target_node,
             threshold=threshold,
             count=count,
             model=model,
+            engine=engine,
         )
         serializer = StandardNodeRecommendationSerializer(
             results, many=True, context={"request": request}
@@ -0,0 +1,135 @@
+##################################################
+# MIT License
+#
+# Copyright (c) 2019 Learning Equality
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+##################################################
+
+import numpy as np
+
+from django.db.models import Max
+
+from .models import StandardNode, Tombstone
+
+
+# sorts after all the characters of treebeard's path alphabet (0-9A-Z)
+PATH_UPPER_BOUND_SUFFIX = "~"
+
+# how often (in seconds) a model checks if its candidate index is out of date
+CANDIDATE_INDEX_CHECK_INTERVAL = 10
+
+
+def get_nodes_watermark():
+    """
+    A value that changes whenever nodes are inserted, updated or deleted: the
+    latest `modified` of the nodes and the latest tombstone id. Both columns are
+    indexed, so this is cheap enough to check often.
+    """
+    return (
+        StandardNode.objects.aggregate(Max("modified"))["modified__max"],
+        Tombstone.objects.aggregate(Max("id"))["id__max"],
+    )
+
+
+class CandidateIndex(object):
+    """
+    The tree structure of the nodes of a model, as arrays aligned with the
+    matrix rows, so the scheduler can filter candidates with boolean masks
+    instead of database queries:
+      - `exists`: the node is still in the database
+      - `is_leaf`: the node has no children
+      - `document_ids`: the document of the node (-1 if it doesn't exist)
+      - `sorted_paths` and `path_order`: the materialized paths in sorted order
+        and the rows they belong to, so the rows of a subtree are a contiguous
+        range `path_order[lo:hi]` found with two binary searches
+    The `watermark` is the `get_nodes_watermark()` the index was built at.
+    """
+
+    def __init__(self, node_ids, paths, numchilds, document_ids, watermark=None):
+        self.watermark = watermark
+        self.n = len(node_ids)
+        self.node_ids = node_ids
+        self.exists = np.array([path is not None for path in paths], dtype=bool)
+        self.is_leaf = self.exists & (np.asarray(numchilds) == 0)
+        self.document_ids = np.asarray(document_ids, dtype=np.int64)
+        self.paths = np.array([path or "" for path in paths], dtype=str)
+        path_order = np.argsort(self.paths, kind="stable")
+        self.path_order = path_order[self.exists[path_order]]
+        self.sorted_paths = self.paths[self.path_order]
+        self._subtree_masks = {}
+
+    @classmethod
+    def build(cls, model):
+        """
+        Build the index for the LoadedModel `model` with a single query.
+        """
+        # read before the nodes, so that changes made meanwhile trigger a rebuild
+        watermark = get_nodes_watermark()
+        # reading all the nodes is cheaper than sending all the ids in the query
+        values = list(
+            StandardNode.objects.values_list("id", "path", "numchild", "document_id")
+        )
+        paths = [None] * model.n
+        numchilds = np.zeros(model.n, dtype=np.int64)
+        document_ids = np.full(model.n, -1, dtype=np.int64)
+        if values:
+            ids, node_paths, node_numchilds, node_document_ids = zip(*values)
+            node_rows = model.rows_for_ids(np.array(ids))
+            in_model = node_rows >= 0
+            node_rows = node_rows[in_model]
+            for row, path in zip(node_rows, np.array(node_paths)[in_model]):
+                paths[row] = str(path)
+            numchilds[node_rows] = np.array(node_numchilds)[in_model]
+            document_ids[node_rows] = np.array(node_document_ids)[in_model]
+        return cls(model.node_id_lookup, paths, numchilds, document_ids, watermark)
+
+    def subtree_rows(self, path):
+        """
+        The rows of the node at `path` and all its descendants.
+        """
+        lo = np.searchsorted(self.sorted_paths, path, side="left")
+        hi = np.searchsorted(
+            self.sorted_paths, path + PATH_UPPER_BOUND_SUFFIX, side="left"
+        )
+        return self.path_order[lo:hi]
+
+    def subtree_mask(self, path):
+        """
+        Boolean mask of the rows of the subtree at `path`. Masks are cached and
+        shared between requests, so callers must not modify them.
+        """
+        mask = self._subtree_masks.get(path)
+        if mask is None:
+            mask = np.zeros(self.n, dtype=bool)
+            mask[self.subtree_rows(path)] = True
+            mask.flags.writeable = False
+            self._subtree_masks[path] = mask
+        return mask
+
+    def candidates_mask(self, include_nonleaf_nodes=False, root_path=None):
+        """
+        A new boolean mask of the candidate rows: the existing (leaf) nodes,
+        within the subtree at `root_path` if given.
+        """
+        mask = self.exists.copy() if include_nonleaf_nodes else self.is_leaf.copy()
+        if root_path is not None:
+            mask &= self.subtree_mask(root_path)
+        return mask
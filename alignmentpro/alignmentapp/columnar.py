@@ -0,0 +1,213 @@
+##################################################
+# MIT License
+#
+# Copyright (c) 2019 Learning Equality
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+##################################################
+
+import csv
+import os
+
+import numpy as np
+import pandas as pd
+
+
+CSV_FORMAT = "csv"
+NPZ_FORMAT = "npz"
+PARQUET_FORMAT = "parquet"
+EXPORT_FORMATS = [CSV_FORMAT, NPZ_FORMAT, PARQUET_FORMAT]
+
+COLUMNS_KEY = "__columns__"
+CODES_SUFFIX = ".codes"
+CATEGORIES_SUFFIX = ".categories"
+
+
+def get_format_path(csvfilepath, fmt):
+    """
+    The path of the `fmt` version of the table exported to `csvfilepath`,
+    e.g. humanjudgments.csv --> humanjudgments.npz
+    """
+    return os.path.splitext(csvfilepath)[0] + "." + fmt
+
+
+def to_columnar_frame(rowdicts, header):
+    """
+    DataFrame with the `rowdicts`, where the numeric columns with missing values
+    are converted to floats (NaN), and the string columns to categoricals so
+    they are stored dictionary-encoded.
+    """
+    df = pd.DataFrame.from_records(list(rowdicts), columns=header)
+    for column in header:
+        if pd.api.types.is_numeric_dtype(df[column]):
+            continue
+        inferred = pd.api.types.infer_dtype(df[column], skipna=True)
+        if inferred in ["integer", "floating", "mixed-integer-float", "decimal"]:
+            df[column] = pd.to_numeric(df[column]).astype(np.float64)
+        else:
+            df[column] = df[column].astype("category")
+    return df
+
+
+def frame_to_rowdicts(df):
+    """
+    Inverse of `to_columnar_frame`: yield the rows of `df` as dicts, with None
+    for missing values and ints for the float columns that only hold integers
+    (e.g. ids with missing values).
+    """
+    columns = {}
+    for column in df.columns:
+        series = df[column]
+        if pd.api.types.is_float_dtype(series):
+            values = series.dropna()
+            if (values == np.floor(values)).all():
+                series = series.astype("Int64")
+        series = series.astype(object)
+        columns[column] = series.where(series.notna(), None).tolist()
+    for values in zip(*columns.values()):
+        yield dict(zip(columns.keys(), values))
+
+
+# NPZ
+################################################################################
+
+
+def write_npz(df, path):
+    """
+    Write `df` as one typed array per column (dictionary-encoded columns as
+    int32 codes plus an array of categories), with no pickled objects.
+    """
+    arrays = {COLUMNS_KEY: np.array(df.columns, dtype=str)}
+    for column in df.columns:
+        series = df[column]
+        if hasattr(series, "cat"):
+            arrays[column + CODES_SUFFIX] = series.cat.codes.values.astype(np.int32)
+            categories = [str(c) for c in series.cat.categories]
+            arrays[column + CATEGORIES_SUFFIX] = np.array(categories, dtype=str)
+        else:
+            arrays[column] = series.values
+    tmppath = path + ".tmp.npz"
+    np.savez(tmppath, **arrays)
+    os.replace(tmppath, path)
+
+
+def read_npz(path):
+    """
+    Load the DataFrame written by `write_npz`.
+    """
+    with np.load(path, allow_pickle=False) as data:
+        names = [str(column) for column in data[COLUMNS_KEY]]
+        columns = {}
+        for column in names:
+            if column + CODES_SUFFIX in data:
+                columns[column] = pd.Categorical.from_codes(
+                    data[column + CODES_SUFFIX], data[column + CATEGORIES_SUFFIX]
+                )
+            else:
+                columns[column] = data[column]
+        return pd.DataFrame(columns, columns=names)
+
+
+# PARQUET
+################################################################################
+
+
+def write_parquet(df, path):
+    """
+    Write `df` as a parquet file (categoricals are dictionary-encoded by pyarrow).
+    Returns False when pyarrow isn't installed.
+    """
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        print("pyarrow is not installed, skipping", path)
+        return False
+    df.to_parquet(path, engine="pyarrow", index=False)
+    return True
+
+
+# HIGH LEVEL API
+################################################################################
+
+
+def write_table(rowdicts, header, csvfilepath, formats=(CSV_FORMAT,)):
+    """
+    Write the `rowdicts` to `csvfilepath`, and next to it in the other columnar
+    `formats`. The CSV is streamed, while the columnar formats need all the rows
+    in memory to build the columns.
+    """
+    columnar_formats = [fmt for fmt in formats if fmt != CSV_FORMAT]
+    rows = [] if columnar_formats else None
+    csv_file = open(csvfilepath, "w") if CSV_FORMAT in formats else None
+    try:
+        if csv_file:
+            csvwriter = csv.DictWriter(csv_file, header)
+            csvwriter.writeheader()
+        for rowdict in rowdicts:
+            if csv_file:
+                csvwriter.writerow(rowdict)
+            if rows is not None:
+                rows.append(rowdict)
+    finally:
+        if csv_file:
+            csv_file.close()
+
+    if columnar_formats:
+        df = to_columnar_frame(rows, header)
+        if NPZ_FORMAT in columnar_formats:
+            write_npz(df, get_format_path(csvfilepath, NPZ_FORMAT))
+        if PARQUET_FORMAT in columnar_formats:
+            write_parquet(df, get_format_path(csvfilepath, PARQUET_FORMAT))
+
+
+def read_csv(csvfilepath, numeric_columns):
+    """
+    Load the CSV at `csvfilepath` with the values of the columns that aren't in
+    `numeric_columns` kept as strings exactly as written (e.g. the identifiers
+    "1.10" and "01" aren't parsed as numbers), and the numeric columns as floats
+    (NaN for the empty values), like `to_columnar_frame` does.
+    """
+    df = pd.read_csv(csvfilepath, dtype=str, keep_default_na=False)
+    for column in numeric_columns:
+        if column in df.columns:
+            values = df[column].replace("", np.nan)
+            df[column] = pd.to_numeric(values).astype(np.float64)
+    return df
+
+
+def read_table(csvfilepath, index_col=None, numeric_columns=None):
+    """
+    Load the table exported to `csvfilepath`, preferring the columnar files
+    written next to it (npz, then parquet) over parsing the CSV. Pass the
+    `numeric_columns` to read the other columns of the CSV as strings.
+    """
+    npzpath = get_format_path(csvfilepath, NPZ_FORMAT)
+    parquetpath = get_format_path(csvfilepath, PARQUET_FORMAT)
+    if os.path.exists(npzpath):
+        df = read_npz(npzpath)
+    elif os.path.exists(parquetpath):
+        df = pd.read_parquet(parquetpath)
+    elif numeric_columns is None:
+        return pd.read_csv(csvfilepath, index_col=index_col)
+    else:
+        df = read_csv(csvfilepath, numeric_columns)
+    if index_col is not None:
+        df = df.set_index(index_col)
+    return df
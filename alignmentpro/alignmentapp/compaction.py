@@ -0,0 +1,242 @@
+##################################################
+# MIT License
+#
+# Copyright (c) 2019 Learning Equality
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+##################################################
+
+"""
+Merge delta data exports into a new full snapshot, reading only export files.
+"""
+
+import json
+import os
+
+import pandas as pd
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.timezone import localtime
+
+from .columnar import CSV_FORMAT, frame_to_rowdicts, read_table, write_table
+from .exporting import DELTA_EXPORT, FULL_EXPORT, update_latest_symlink
+from .exporting import CURRICULUM_DOCUMENT_HEADER_V0, STANDARD_NODE_HEADER_V0
+from .exporting import HUMAN_JUDGMENTS_HEADER_V0, USERPROFILES_HEADER_V0
+from .exporting import DOCUMENT_ID_KEY, ID_KEY, MODEL_NAME_KEY, OBJECT_ID_KEY
+from .exporting import DEPTH_KEY, DIST_FROM_LEAF_KEY, PARENT_ID_KEY, SORT_ORDER_KEY
+from .exporting import NODE1_KEY, NODE2_KEY, RATING_KEY, CONFIDENCE_KEY, USER_ID_KEY
+from .judgmentgraph import write_judgment_graph
+from .models import DataExport, HumanRelevanceJudgment, StandardNode
+
+
+# (table key, settings attribute with the filename, header)
+SNAPSHOT_TABLES = [
+    ("documents", "CURRICULUM_DOCUMENTS_FILENAME", CURRICULUM_DOCUMENT_HEADER_V0),
+    ("nodes", "STANDARD_NODES_FILENAME", STANDARD_NODE_HEADER_V0),
+    ("judgments", "HUMAN_JUDGMENTS_FILENAME", HUMAN_JUDGMENTS_HEADER_V0),
+    ("judgments_test", "HUMAN_JUDGMENTS_TEST_FILENAME", HUMAN_JUDGMENTS_HEADER_V0),
+    ("userprofiles", "USERPROFILES_FILENAME", USERPROFILES_HEADER_V0),
+]
+
+# the columns of the export tables that hold numbers, all others are strings
+NUMERIC_KEYS = [
+    ID_KEY,
+    DOCUMENT_ID_KEY,
+    DEPTH_KEY,
+    DIST_FROM_LEAF_KEY,
+    PARENT_ID_KEY,
+    SORT_ORDER_KEY,
+    NODE1_KEY,
+    NODE2_KEY,
+    RATING_KEY,
+    CONFIDENCE_KEY,
+    USER_ID_KEY,
+    OBJECT_ID_KEY,
+]
+
+
+def get_exports_to_compact():
+    """
+    The last full data export and the delta exports done after it.
+    """
+    exports = list(
+        DataExport.objects.filter(finished__isnull=False).order_by("started", "id")
+    )
+    full_indices = [i for i, export in enumerate(exports) if export.kind == FULL_EXPORT]
+    if not full_indices:
+        return None, []
+    base = exports[full_indices[-1]]
+    deltas = [e for e in exports[full_indices[-1] + 1 :] if e.kind == DELTA_EXPORT]
+    return base, deltas
+
+
+def read_export_table(exportpath, filename, index_col=None):
+    """
+    Load the table `filename` of the export at `exportpath`, or None if the
+    export doesn't have it (in any format).
+    """
+    csvfilepath = os.path.join(exportpath, filename)
+    stem = os.path.splitext(filename)[0]
+    if not any(name.startswith(stem + ".") for name in os.listdir(exportpath)):
+        return None
+    return read_table(
+        csvfilepath, index_col=index_col, numeric_columns=NUMERIC_KEYS
+    )
+
+
+def read_export_metadata(exportpath):
+    with open(os.path.join(exportpath, settings.METADATA_FILENAME)) as json_file:
+        return json.load(json_file)
+
+
+def apply_delta(tables, deltapath):
+    """
+    Update the `tables` of a full snapshot with the delta export at `deltapath`:
+    replace the nodes of the documents in the delta, upsert the judgments by id
+    (a judgment only ever is in one of the train and test tables), and drop
+    the deleted nodes and judgments.
+    """
+    delta_nodes = read_export_table(deltapath, settings.STANDARD_NODES_FILENAME)
+    nodes = tables["nodes"]
+    changed = nodes[DOCUMENT_ID_KEY].isin(delta_nodes[DOCUMENT_ID_KEY])
+    tables["nodes"] = pd.concat([nodes[~changed], delta_nodes], ignore_index=True)
+
+    judgment_tables = {
+        "judgments": settings.HUMAN_JUDGMENTS_FILENAME,
+        "judgments_test": settings.HUMAN_JUDGMENTS_TEST_FILENAME,
+    }
+    deltas = {
+        key: read_export_table(deltapath, filename)
+        for key, filename in judgment_tables.items()
+    }
+    changed_ids = pd.concat([d[ID_KEY] for d in deltas.values() if d is not None])
+    for key, delta_judgments in deltas.items():
+        judgments = tables[key]
+        if judgments is None:
+            continue  # the snapshot doesn't include the test data
+        judgments = judgments[~judgments[ID_KEY].isin(changed_ids)]
+        if delta_judgments is not None:
+            judgments = pd.concat([judgments, delta_judgments], ignore_index=True)
+        tables[key] = judgments
+
+    tombstones = read_export_table(deltapath, settings.TOMBSTONES_FILENAME)
+    if tombstones is not None and len(tombstones):
+        for key, model in [
+            ("nodes", StandardNode),
+            ("judgments", HumanRelevanceJudgment),
+            ("judgments_test", HumanRelevanceJudgment),
+        ]:
+            if tables[key] is None:
+                continue
+            is_model = tombstones[MODEL_NAME_KEY].astype(str) == model.__name__
+            deleted_ids = tombstones[OBJECT_ID_KEY][is_model]
+            tables[key] = tables[key][~tables[key][ID_KEY].isin(deleted_ids)]
+
+    # documents and user profiles are always exported in full
+    tables["documents"] = read_export_table(
+        deltapath, settings.CURRICULUM_DOCUMENTS_FILENAME
+    )
+    tables["userprofiles"] = read_export_table(
+        deltapath, settings.USERPROFILES_FILENAME
+    )
+    return tables
+
+
+def compact_exports(formats=(CSV_FORMAT,)):
+    """
+    Merge the last full data export and the delta exports after it into a new
+    full snapshot, which the `latest` symlink then points to. Returns the new
+    export dir name, or None if there was nothing to compact.
+    """
+    base, deltas = get_exports_to_compact()
+    if base is None or not deltas:
+        print("No delta exports to compact.")
+        return None
+
+    export_base_dir = settings.DATA_EXPORT_BASE_DIR
+    basepath = os.path.join(export_base_dir, base.exportdirname)
+    tables = {
+        key: read_export_table(basepath, getattr(settings, filename_setting))
+        for key, filename_setting, _ in SNAPSHOT_TABLES
+    }
+    metadata = read_export_metadata(basepath)
+    for delta in deltas:
+        print("Applying delta export", delta.exportdirname)
+        deltapath = os.path.join(export_base_dir, delta.exportdirname)
+        tables = apply_delta(tables, deltapath)
+        metadata = read_export_metadata(deltapath)
+
+    # drop the nodes of documents that were deleted (or became drafts)
+    nodes = tables["nodes"]
+    in_documents = nodes[DOCUMENT_ID_KEY].isin(tables["documents"][DOCUMENT_ID_KEY])
+    tables["nodes"] = nodes[in_documents]
+    for key in ["judgments", "judgments_test"]:
+        if tables[key] is not None:
+            tables[key] = tables[key].sort_values(ID_KEY)
+
+    # the snapshot holds the data as of when the last delta export started, so
+    # the next delta export starts from there too (see `get_previous_export`)
+    last_delta = deltas[-1]
+    exportdirname = localtime(last_delta.started).strftime("%Y%m%d-%H%M") + "-full"
+    exportpath = os.path.join(export_base_dir, exportdirname)
+    if not os.path.exists(exportpath):
+        os.makedirs(exportpath)
+    export_metadata = DataExport.objects.create(
+        exportdirname=exportdirname, kind=FULL_EXPORT
+    )
+    export_metadata.started = last_delta.started
+    export_metadata.save()
+
+    for key, filename_setting, header in SNAPSHOT_TABLES:
+        if tables[key] is not None:
+            csvfilepath = os.path.join(exportpath, getattr(settings, filename_setting))
+            rowdicts = frame_to_rowdicts(tables[key][header])
+            write_table(rowdicts, header, csvfilepath, formats)
+
+    node_ids = tables["nodes"][ID_KEY].values
+    for key, filename_setting in [
+        ("judgments", "HUMAN_JUDGMENTS_GRAPH_FILENAME"),
+        ("judgments_test", "HUMAN_JUDGMENTS_TEST_GRAPH_FILENAME"),
+    ]:
+        if tables[key] is not None:
+            filename = getattr(settings, filename_setting)
+            write_judgment_graph(exportpath, filename, node_ids, tables[key])
+
+    update_latest_symlink(exportpath)
+
+    finished = timezone.now()
+    metadata = dict(
+        metadata,
+        exportdirname=exportdirname,
+        kind=FULL_EXPORT,
+        since=None,
+        includetestdata=tables["judgments_test"] is not None,
+        formats=list(formats),
+        compacted=[base.exportdirname] + [d.exportdirname for d in deltas],
+        finished=localtime(finished).isoformat(),
+    )
+    with open(os.path.join(exportpath, settings.METADATA_FILENAME), "w") as json_file:
+        json.dump(metadata, json_file, indent=2, ensure_ascii=False)
+
+    print("Compacted", len(deltas), "delta exports into", exportpath)
+    export_metadata.finished = finished
+    export_metadata.save()
+    return exportdirname
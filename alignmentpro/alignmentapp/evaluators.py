@@ -24,6 +24,7 @@
 ##################################################
 
 from datetime import datetime
+import hashlib
 import os
 import numpy as np
 import pandas as pd
@@ -32,18 +33,37 @@ import scipy.stats
 
 from django.conf import settings
 
+from .columnar import EXPORT_FORMATS, get_format_path, read_table
 from .models import CurriculumDocument, StandardNode, HumanRelevanceJudgment
+from .modelstore import EMBEDDINGS_FILENAME, INDEX_FILENAME, get_model
 
 TEST_DATA_DUMP_PATH = os.path.join(settings.DATA_EXPORT_BASE_DIR, "../testdata")
+EVALUATION_BATCH_SIZE = 256
+
+# bump when a change to the evaluation code should invalidate all scores
+EVALUATION_VERSION = 2
+EVALUATION_MANIFEST_FILENAME = "scores_manifest.json"
+EVALUATION_MODEL_FILENAMES = [INDEX_FILENAME, EMBEDDINGS_FILENAME]
+EVALUATION_JUDGMENTS_FILENAMES = [
+    os.path.basename(get_format_path(filename, fmt))
+    for filename in [
+        settings.HUMAN_JUDGMENTS_FILENAME,
+        settings.HUMAN_JUDGMENTS_TEST_FILENAME,
+    ]
+    for fmt in EXPORT_FORMATS
+]
 
 
 def ranking(model):
-    judgments = pd.read_csv(
-        os.path.join(TEST_DATA_DUMP_PATH, "humanjudgments.csv"), index_col="id"
-    ).fillna("")
-    judgments_test = pd.read_csv(
-        os.path.join(TEST_DATA_DUMP_PATH, "humanjudgments_test.csv"), index_col="id"
-    ).fillna("")
+    # read from the npz or parquet files when the export has them
+    judgments = read_table(
+        os.path.join(TEST_DATA_DUMP_PATH, settings.HUMAN_JUDGMENTS_FILENAME),
+        index_col="id",
+    )
+    judgments_test = read_table(
+        os.path.join(TEST_DATA_DUMP_PATH, settings.HUMAN_JUDGMENTS_TEST_FILENAME),
+        index_col="id",
+    )
 
     return {
         "training": ranking_for_judgments(model, judgments),
@@ -51,86 +71,137 @@ def ranking(model):
     }
 
 
+def hash_file(path, chunk_size=1024 * 1024):
+    """
+    Return the sha256 hex digest of the file at `path`, or None if it is missing.
+    """
+    if not os.path.exists(path):
+        return None
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def get_judgments_hashes():
+    return {
+        filename: hash_file(os.path.join(TEST_DATA_DUMP_PATH, filename))
+        for filename in EVALUATION_JUDGMENTS_FILENAMES
+    }
+
+
+def get_evaluation_manifest(model_path, judgments_hashes=None):
+    """
+    Content hashes of all the inputs to `ranking` for the model in `model_path`.
+    The scores of a model only need recomputing when its manifest changes.
+    """
+    if judgments_hashes is None:
+        judgments_hashes = get_judgments_hashes()
+    return {
+        "evaluation_version": EVALUATION_VERSION,
+        "model": {
+            filename: hash_file(os.path.join(model_path, filename))
+            for filename in EVALUATION_MODEL_FILENAMES
+        },
+        "judgments": judgments_hashes,
+    }
+
+
 def get_rank(row, item):
     percentile = scipy.stats.percentileofscore(row, item) / 100
     return (1 - percentile) * len(row)
 
 
-def ranking_for_judgments(model, judgments):
+def percentileofscores(sorted_row, scores):
     """
+    Vectorized `scipy.stats.percentileofscore(row, score)` (with kind="rank")
+    for all `scores`, given the row already sorted.
     """
+    left = np.searchsorted(sorted_row, scores, side="left")
+    right = np.searchsorted(sorted_row, scores, side="right")
+    return (left + right + (right > left)) * 50.0 / len(sorted_row)
 
-    modeldirpath = os.path.join(settings.MODELS_BASE_DIR, model)
-    baselinemodeldirpath = os.path.join(settings.MODELS_BASE_DIR, "baseline")
-
-    # load the index
-    # node_id_lookup = np.load(os.path.join(modeldirpath, "index.npy"))
-    node_id_lookup = np.load(os.path.join(modeldirpath, "index.npy"))
-
-    # load the matrix
-    # relevance_matrix = np.load(os.path.join(modeldirpath, "relevance.npy"))
-
-    embeddings = np.load(os.path.join(modeldirpath, "embeddings.npy"))
-    relevance_matrix = np.inner(embeddings, embeddings)
-
-    # load the pickled DataFrame of nodes
-    nodes = pd.read_pickle(os.path.join(baselinemodeldirpath, "nodes.pk"))
-
-    percentiles_negative = []
-    percentiles_moderate = []
-    percentiles_positive = []
-    for index in judgments.index:
-        judgment = judgments.loc[index]
-        prediction_row = relevance_matrix[judgment.node1_id, :].flatten()
-        predicted_value = prediction_row[judgment.node2_id]
-        percentile = scipy.stats.percentileofscore(prediction_row, predicted_value)
-        if judgment.rating == 0.0:
-            percentiles_negative.append(percentile)
-        if judgment.rating == 0.5:
-            percentiles_moderate.append(percentile)
-        if judgment.rating == 1.0:
-            percentiles_positive.append(percentile)
-
-    # alternative:
-    # loop over nodes: sort by model rating, then look at how "unsorted" the positives vs negatives are
-    # (num nodes above above the lowest ranked positive not known to be positive)
 
+def get_ranks(sorted_row, items):
+    """
+    Vectorized `get_rank` for all `items`, given the row already sorted.
+    """
+    percentiles = percentileofscores(sorted_row, items) / 100
+    return (1 - percentiles) * len(sorted_row)
+
+
+def ranking_for_judgments(model, judgments):
+    """
+    Score how the embeddings of `model` rank the pairs in `judgments`. Judgments
+    are grouped by node, and the relevance row of each node that appears in a
+    judgment is computed and sorted once, so the cost grows with the number of
+    judged nodes instead of the total number of nodes.
+    """
+    model = get_model(model)
+
+    # map the judgment node ids to model rows, dropping unknown nodes
+    node1_rows = model.rows_for_ids(judgments.node1_id.values)
+    node2_rows = model.rows_for_ids(judgments.node2_id.values)
+    ratings = pd.to_numeric(judgments.rating, errors="coerce").values
+    known = (node1_rows >= 0) & (node2_rows >= 0)
+    node1_rows = node1_rows[known]
+    node2_rows = node2_rows[known]
+    ratings = ratings[known]
+
+    # judgments sorted by node1, to look up the judgments of each row
+    judgments_order = np.argsort(node1_rows, kind="stable")
+    sorted_node1_rows = node1_rows[judgments_order]
+
+    # undirected graph of the positive judgments, as edges sorted by source
+    positive = ratings == 1.0
+    sources = np.concatenate([node1_rows[positive], node2_rows[positive]])
+    targets = np.concatenate([node2_rows[positive], node1_rows[positive]])
+    not_loop = sources != targets
+    edges = np.unique(
+        np.stack([sources[not_loop], targets[not_loop]], axis=1).reshape(-1, 2),
+        axis=0,
+    )
+    edge_sources = edges[:, 0]
+    edge_targets = edges[:, 1]
+
+    percentiles = np.zeros(len(node1_rows))
     worst_ranks = []
     best_ranks = []
 
-    i = 0
-    for id, node in nodes.iterrows():
-        i += 1
-        if i % 1000 == 0:
-            print("Working on node", i)
-        prediction_row = relevance_matrix[node.row, :].flatten()
-        matching_judgments = judgments[
-            ((judgments.node1_id == id) | (judgments.node2_id == id))
-            & (judgments.rating == 1)
-        ]
-        if matching_judgments.empty:
-            continue
-        node_ids = list(
-            set(matching_judgments.node1_id)
-            | set(matching_judgments.node2_id) - set([id])
-        )
-        node_predictions = prediction_row[nodes.loc[node_ids].row]
-        worst_prediction = min(node_predictions)
-        best_prediction = max(node_predictions)
-        worst_rank = get_rank(prediction_row, worst_prediction) - len(node_ids) + 1
-        best_rank = get_rank(prediction_row, best_prediction)
-
-        worst_ranks.append(worst_rank)
-        best_ranks.append(best_rank)
-
-        # import IPython
-
-        # IPython.embed()
+    needed_rows = np.union1d(node1_rows, edge_sources)
+    for start in range(0, len(needed_rows), EVALUATION_BATCH_SIZE):
+        batch_rows = needed_rows[start : start + EVALUATION_BATCH_SIZE]
+        block = model.embedding_relevances(batch_rows)
+        sorted_block = np.sort(block, axis=1)
+        for k, row in enumerate(batch_rows):
+            prediction_row = block[k]
+            sorted_row = sorted_block[k]
+
+            # percentile of the predicted relevance of each judgment's node2
+            lo = np.searchsorted(sorted_node1_rows, row, side="left")
+            hi = np.searchsorted(sorted_node1_rows, row, side="right")
+            if hi > lo:
+                indices = judgments_order[lo:hi]
+                percentiles[indices] = percentileofscores(
+                    sorted_row, prediction_row[node2_rows[indices]]
+                )
+
+            # how far down the ranking the positively judged neighbours are
+            lo = np.searchsorted(edge_sources, row, side="left")
+            hi = np.searchsorted(edge_sources, row, side="right")
+            if hi > lo:
+                node_predictions = prediction_row[edge_targets[lo:hi]]
+                worst_rank, best_rank = get_ranks(
+                    sorted_row, [node_predictions.min(), node_predictions.max()]
+                )
+                worst_ranks.append(worst_rank - (hi - lo) + 1)
+                best_ranks.append(best_rank)
 
     return {
-        "avg_percentiles_negative": np.mean(percentiles_negative),
-        "avg_percentiles_moderate": np.mean(percentiles_moderate),
-        "avg_percentiles_positive": np.mean(percentiles_positive),
+        "avg_percentiles_negative": np.mean(percentiles[ratings == 0.0]),
+        "avg_percentiles_moderate": np.mean(percentiles[ratings == 0.5]),
+        "avg_percentiles_positive": np.mean(percentiles[ratings == 1.0]),
         "mean_best_rank": np.mean(best_ranks),
         "mean_worst_rank": np.mean(worst_ranks),
     }
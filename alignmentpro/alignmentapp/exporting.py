@@ -23,30 +23,66 @@
 #
 ##################################################
 
-import csv
 import json
 import os
 import random
 import subprocess
 
+import pandas as pd
+
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import transaction
+from django.db.models import Q
 from django.utils import timezone
 from django.utils.timezone import localtime
 
+from .columnar import CSV_FORMAT, write_table
+from .judgmentgraph import JUDGMENT_GRAPH_COLUMNS, write_judgment_graph
 from .models import CurriculumDocument, HumanRelevanceJudgment, StandardNode
-from .models import Parameter, DataExport, UserProfile
+from .models import DataExport, Tombstone, UserProfile
+from .splitting import assign_test_data
+from .treemetrics import HEIGHT, PARENT_ID, iter_rows_with_metrics
 
 
 # HIGH LEVEL API
 ################################################################################
 
 
-def export_data(drafts=False, includetestdata=False):
+FULL_EXPORT = "full"
+DELTA_EXPORT = "delta"
+
+
+def get_previous_export():
+    """
+    The last data export that completed, or None.
+    """
+    finished_exports = DataExport.objects.filter(finished__isnull=False)
+    return finished_exports.order_by("-started", "-id").first()
+
+
+def export_data(
+    drafts=False, includetestdata=False, formats=(CSV_FORMAT,), delta=False
+):
     """
-    Export the curriculum and human judgment data to be used for ML training.
+    Export the curriculum and human judgment data to be used for ML training,
+    as CSV and/or the columnar `formats` (see `columnar.EXPORT_FORMATS`).
+
+    When `delta` is True, only the nodes and judgments changed since the previous
+    export are written, along with tombstones for the deleted ones. Nodes are
+    exported by document: if any node of a document changed or was deleted, the
+    whole document is written, since parent ids and distances from leaves depend
+    on the tree.
+    Use `compact_exports` to merge the deltas into a new full snapshot.
     """
+    previous_export = get_previous_export() if delta else None
+    if delta and previous_export is None:
+        print("No previous data export found, doing a full export instead.")
+    kind = DELTA_EXPORT if previous_export else FULL_EXPORT
+    # rows modified while the previous export was running may not be in it,
+    # so deltas start when the previous export started (re-exported rows are
+    # simply replaced when compacting)
+    since = previous_export.started if previous_export else None
+
     exportdirname = timezone.localtime().strftime("%Y%m%d-%H%M")
     export_base_dir = settings.DATA_EXPORT_BASE_DIR
     if not os.path.exists(export_base_dir):
@@ -55,7 +91,7 @@ def export_data(drafts=False, includetestdata=False):
     if not os.path.exists(exportpath):
         os.makedirs(exportpath)
 
-    export_metadata = DataExport.objects.create(exportdirname=exportdirname)
+    export_metadata = DataExport.objects.create(exportdirname=exportdirname, kind=kind)
 
     # PART 1: EXPORT CURRICULUM DATA
     ########################################################################
@@ -63,19 +99,22 @@ def export_data(drafts=False, includetestdata=False):
         documents = CurriculumDocument.objects.all()
     else:
         documents = CurriculumDocument.objects.filter(is_draft=False)
-    #
-    all_documents = []
-    all_nodes = []
-    for document in documents:
-        all_documents.append(document)
-        root = document.root
-        nodes = [root] + list(document.root.get_descendants())
-        all_nodes.extend(nodes)
+    all_nodes = StandardNode.objects.filter(document__in=documents)
+    if since:
+        # deleting a node changes its parent's document too
+        changed_nodes = all_nodes.filter(modified__gte=since)
+        buried_nodes = Tombstone.objects.filter(
+            deleted__gte=since, model_name=StandardNode.__name__
+        )
+        all_nodes = all_nodes.filter(
+            Q(document_id__in=changed_nodes.values("document_id"))
+            | Q(document_id__in=buried_nodes.values("document_id"))
+        )
 
     csvpath1 = os.path.join(exportpath, settings.CURRICULUM_DOCUMENTS_FILENAME)
-    export_documents(all_documents, csvpath1)
+    export_documents(documents, csvpath1, formats=formats)
     csvpath2 = os.path.join(exportpath, settings.STANDARD_NODES_FILENAME)
-    export_nodes(all_nodes, csvpath2)
+    export_nodes(all_nodes, csvpath2, formats=formats)
 
     # PART 2: EXPORT HUMAN JUDGMENTS DATA
     ########################################################################
@@ -83,46 +122,62 @@ def export_data(drafts=False, includetestdata=False):
     all_users = User.objects.filter(profile__exclude=False)
     all_judgments = HumanRelevanceJudgment.objects.filter(user__in=all_users)
 
-    # set the `is_test_data` field for new data
-    with transaction.atomic():
-        new_feedback_data = all_judgments.filter(is_test_data=None).order_by("?")
-        count = new_feedback_data.count()
-
-        test_fraction = float(
-            Parameter.objects.get(key="test_size").value
-        )  # proportion of new jugments to be kept for test
-        test_count = int(test_fraction * count)
-
-        new_ids = list(new_feedback_data.values_list("id", flat=True))
-
-        all_judgments.filter(id__in=new_ids[:test_count]).update(is_test_data=True)
-        all_judgments.filter(id__in=new_ids[test_count:]).update(is_test_data=False)
+    # set the `is_test_data` field for new data (judgments created through the
+    # API are split at ingest time, this handles all the others)
+    assign_test_data(all_judgments)
+    if since:
+        all_judgments = all_judgments.filter(modified__gte=since)
 
     judgments_test = all_judgments.filter(is_test_data=True)
     judgments_train = all_judgments.filter(is_test_data=False)
 
     # write out the human judgments for training, and possibly also for testing
     csvpath5 = os.path.join(exportpath, settings.HUMAN_JUDGMENTS_FILENAME)
-    export_human_judgments(judgments_train, csvpath5)
+    export_human_judgments(judgments_train, csvpath5, formats=formats)
     if includetestdata:
         csvpath6 = os.path.join(exportpath, settings.HUMAN_JUDGMENTS_TEST_FILENAME)
-        export_human_judgments(judgments_test, csvpath6)
+        export_human_judgments(judgments_test, csvpath6, formats=formats)
+
+    # the judgments as sparse graphs aligned with the rows of the nodes file
+    # (deltas only have some of the nodes, so they don't get graphs)
+    if not since:
+        node_ids = list(all_nodes.order_by("path").values_list("id", flat=True))
+        write_judgment_graph(
+            exportpath,
+            settings.HUMAN_JUDGMENTS_GRAPH_FILENAME,
+            node_ids,
+            get_judgment_columns(judgments_train),
+        )
+        if includetestdata:
+            write_judgment_graph(
+                exportpath,
+                settings.HUMAN_JUDGMENTS_TEST_GRAPH_FILENAME,
+                node_ids,
+                get_judgment_columns(judgments_test),
+            )
 
     # export the user profiles
     csvpath7 = os.path.join(exportpath, settings.USERPROFILES_FILENAME)
-    export_userprofiles(all_users, csvpath7)
+    export_userprofiles(all_users, csvpath7, formats=formats)
 
-    # update latest symlink
-    latestpath = os.path.join(export_base_dir, "latest")
-    if os.path.exists(latestpath):
-        os.remove(latestpath)
-    subprocess.run(["ln", "-s", exportpath, latestpath])
+    # PART 3: DELETIONS AND LATEST SYMLINK
+    ########################################################################
+    if since:
+        tombstones = Tombstone.objects.filter(deleted__gte=since).order_by("id")
+        csvpath8 = os.path.join(exportpath, settings.TOMBSTONES_FILENAME)
+        export_tombstones(tombstones, csvpath8, formats=formats)
+    else:
+        # deltas are incomplete, so latest always points to a full snapshot
+        update_latest_symlink(exportpath)
 
     finished = timezone.now()
     metadata = dict(
         exportdirname=exportdirname,
+        kind=kind,
+        since=localtime(since).isoformat() if since else None,
         drafts=drafts,
         includetestdata=includetestdata,
+        formats=list(formats),
         finished=localtime(finished).isoformat(),
     )
     with open(os.path.join(exportpath, settings.METADATA_FILENAME), "w") as json_file:
@@ -135,6 +190,13 @@ def export_data(drafts=False, includetestdata=False):
     return exportdirname
 
 
+def update_latest_symlink(exportpath):
+    latestpath = os.path.join(settings.DATA_EXPORT_BASE_DIR, "latest")
+    if os.path.lexists(latestpath):
+        os.remove(latestpath)
+    subprocess.run(["ln", "-s", exportpath, latestpath])
+
+
 # CURRICULUM DOCUMENT CSV EXPORT FORMAT
 ################################################################################
 DOCUMENT_ID_KEY = "document_id"
@@ -170,16 +232,12 @@ def document_to_rowdict(document):
     return datum
 
 
-def export_documents(documents, csvfilepath):
+def export_documents(documents, csvfilepath, formats=(CSV_FORMAT,)):
     """
     Writes the documents data in `documents` to the CSV file at `csvfilepath`.
     """
-    with open(csvfilepath, "w") as csv_file:
-        csvwriter = csv.DictWriter(csv_file, CURRICULUM_DOCUMENT_HEADER_V0)
-        csvwriter.writeheader()
-        for document in documents:
-            rowdict = document_to_rowdict(document)
-            csvwriter.writerow(rowdict)
+    rowdicts = (document_to_rowdict(document) for document in documents)
+    write_table(rowdicts, CURRICULUM_DOCUMENT_HEADER_V0, csvfilepath, formats)
 
 
 # STANDARD NODE CSV EXPORT FORMAT
@@ -212,48 +270,54 @@ STANDARD_NODE_HEADER_V0 = [
     EXTRA_FIELDS_KEY,
 ]
 
-# TODO: add dist_from_leaf
-def dist_from_furthest_leaf(node):
-    descendant_data = StandardNode.get_annotated_list(node)
-    max_child_level = 0
-    for desc in descendant_data:
-        item, data = desc
-        level = data["level"]
-        if level > max_child_level:
-            max_child_level = level
-
-    return max_child_level
-
-
-def node_to_rowdict(node):
-    parent_node = node.get_parent()
-    datum = {
-        ID_KEY: node.id,
-        DOCUMENT_ID_KEY: node.document_id,
-        DEPTH_KEY: node.depth,
-        DIST_FROM_LEAF_KEY: dist_from_furthest_leaf(node),
-        PARENT_ID_KEY: parent_node.id if parent_node else None,
-        SORT_ORDER_KEY: node.sort_order,
-        IDENTIFIER_KEY: node.identifier,
-        KIND_KEY: node.kind,
-        TITLE_KEY: node.title,
-        TIME_UNITS_KEY: node.time_units,
-        NOTES_KEY: node.notes,
-        EXTRA_FIELDS_KEY: json.dumps(node.extra_fields),
-    }
-    return datum
+NODE_VALUES_FIELDS = [
+    "id",
+    "path",
+    "depth",
+    "document_id",
+    "sort_order",
+    "identifier",
+    "kind",
+    "title",
+    "time_units",
+    "notes",
+    "extra_fields",
+]
 
 
-def export_nodes(nodes, csvfilepath):
+def iter_node_rowdicts(nodes):
     """
-    Writes the standard nodes data in `nodes` to the CSV file at `csvfilepath`.
+    Stream the rows of the queryset `nodes` in path order, with `parent_id` and
+    `dist_from_leaf` computed by `treemetrics` from the materialized paths without
+    any extra queries. The rows of a tree are yielded as soon as the tree is
+    complete, so memory use is bounded by the size of the largest document.
     """
-    with open(csvfilepath, "w") as csv_file:
-        csvwriter = csv.DictWriter(csv_file, STANDARD_NODE_HEADER_V0)
-        csvwriter.writeheader()
-        for node in nodes:
-            noderow = node_to_rowdict(node)
-            csvwriter.writerow(noderow)
+    values = nodes.order_by("path").values(*NODE_VALUES_FIELDS).iterator()
+    for values_row, metrics in iter_rows_with_metrics(values):
+        datum = {
+            ID_KEY: values_row["id"],
+            DOCUMENT_ID_KEY: values_row["document_id"],
+            DEPTH_KEY: values_row["depth"],
+            DIST_FROM_LEAF_KEY: metrics[HEIGHT],
+            PARENT_ID_KEY: metrics[PARENT_ID],
+            SORT_ORDER_KEY: values_row["sort_order"],
+            IDENTIFIER_KEY: values_row["identifier"],
+            KIND_KEY: values_row["kind"],
+            TITLE_KEY: values_row["title"],
+            TIME_UNITS_KEY: values_row["time_units"],
+            NOTES_KEY: values_row["notes"],
+            EXTRA_FIELDS_KEY: json.dumps(values_row["extra_fields"]),
+        }
+        yield datum
+
+
+def export_nodes(nodes, csvfilepath, formats=(CSV_FORMAT,)):
+    """
+    Writes the standard nodes data in the queryset `nodes` to the CSV file at
+    `csvfilepath`.
+    """
+    rowdicts = iter_node_rowdicts(nodes)
+    write_table(rowdicts, STANDARD_NODE_HEADER_V0, csvfilepath, formats)
 
 
 # HUMAN JUDGMENT CSV EXPORT FORMAT
@@ -296,16 +360,20 @@ def human_judgment_to_rowdict(human_judgment):
     return datum
 
 
-def export_human_judgments(human_judgments, csvfilepath):
+def get_judgment_columns(human_judgments):
+    """
+    DataFrame with the columns of `human_judgments` needed for the graphs.
+    """
+    rows = human_judgments.values_list(*JUDGMENT_GRAPH_COLUMNS)
+    return pd.DataFrame.from_records(list(rows), columns=JUDGMENT_GRAPH_COLUMNS)
+
+
+def export_human_judgments(human_judgments, csvfilepath, formats=(CSV_FORMAT,)):
     """
     Writes the human judgements data to the CSV file at `csvfilepath`.
     """
-    with open(csvfilepath, "w") as csv_file:
-        csvwriter = csv.DictWriter(csv_file, HUMAN_JUDGMENTS_HEADER_V0)
-        csvwriter.writeheader()
-        for human_judgment in human_judgments:
-            rowdict = human_judgment_to_rowdict(human_judgment)
-            csvwriter.writerow(rowdict)
+    rowdicts = (human_judgment_to_rowdict(hj) for hj in human_judgments)
+    write_table(rowdicts, HUMAN_JUDGMENTS_HEADER_V0, csvfilepath, formats)
 
 
 # USERS CSV EXPORT FORMAT
@@ -332,13 +400,35 @@ def user_to_rowdict(user):
     return datum
 
 
-def export_userprofiles(users, csvfilepath):
+def export_userprofiles(users, csvfilepath, formats=(CSV_FORMAT,)):
     """
     Writes the user profile data to the CSV file at `csvfilepath`.
     """
-    with open(csvfilepath, "w") as csv_file:
-        csvwriter = csv.DictWriter(csv_file, USERPROFILES_HEADER_V0)
-        csvwriter.writeheader()
-        for user in users:
-            rowdict = user_to_rowdict(user)
-            csvwriter.writerow(rowdict)
+    rowdicts = (user_to_rowdict(user) for user in users)
+    write_table(rowdicts, USERPROFILES_HEADER_V0, csvfilepath, formats)
+
+
+# TOMBSTONES CSV EXPORT FORMAT
+################################################################################
+MODEL_NAME_KEY = "model_name"
+OBJECT_ID_KEY = "object_id"
+DELETED_KEY = "deleted"
+
+TOMBSTONES_HEADER_V0 = [MODEL_NAME_KEY, OBJECT_ID_KEY, DELETED_KEY]
+
+
+def tombstone_to_rowdict(tombstone):
+    datum = {
+        MODEL_NAME_KEY: tombstone.model_name,
+        OBJECT_ID_KEY: tombstone.object_id,
+        DELETED_KEY: str(tombstone.deleted),
+    }
+    return datum
+
+
+def export_tombstones(tombstones, csvfilepath, formats=(CSV_FORMAT,)):
+    """
+    Writes the deleted nodes and judgments to the CSV file at `csvfilepath`.
+    """
+    rowdicts = (tombstone_to_rowdict(tombstone) for tombstone in tombstones)
+    write_table(rowdicts, TOMBSTONES_HEADER_V0, csvfilepath, formats)
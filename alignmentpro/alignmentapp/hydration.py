@@ -0,0 +1,103 @@
+##################################################
+# MIT License
+#
+# Copyright (c) 2019 Learning Equality
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+##################################################
+
+from functools import reduce
+from operator import or_
+
+from django.db.models import Q
+
+from .models import StandardNode
+
+
+def get_ancestor_paths(path, steplen=StandardNode.steplen):
+    """
+    Materialized paths of all the ancestors of the node at `path`, root first.
+    """
+    return [path[0:pos] for pos in range(steplen, len(path), steplen)]
+
+
+def hydrate_nodes(queryset, ids):
+    """
+    Load the StandardNodes with `ids` from `queryset`, keeping the order of `ids`,
+    using one query for the nodes (and their documents) and one query for all
+    their ancestors. Each node gets the attribute `hydrated_ancestors` and each
+    node's document gets `hydrated_root_node_id`, which the API serializers use
+    instead of querying once per node. Ids not in `queryset` are skipped.
+    """
+    ids = [int(i) for i in ids]
+    nodes_by_id = queryset.select_related("document").in_bulk(ids)
+    nodes = [nodes_by_id[i] for i in ids if i in nodes_by_id]
+
+    ancestor_paths = set()
+    for node in nodes:
+        ancestor_paths.update(get_ancestor_paths(node.path, node.steplen))
+    if ancestor_paths:
+        ancestors_by_path = {
+            ancestor.path: ancestor
+            for ancestor in StandardNode.objects.filter(path__in=ancestor_paths)
+        }
+    else:
+        ancestors_by_path = {}
+
+    for node in nodes:
+        node.hydrated_ancestors = [
+            ancestors_by_path[path]
+            for path in get_ancestor_paths(node.path, node.steplen)
+            if path in ancestors_by_path
+        ]
+        if node.depth == 1:
+            node.document.hydrated_root_node_id = node.id
+        elif node.hydrated_ancestors:
+            node.document.hydrated_root_node_id = node.hydrated_ancestors[0].id
+
+    return nodes
+
+
+def hydrate_children(nodes):
+    """
+    Set the attribute `hydrated_children` of each of the StandardNodes `nodes`
+    to the list of its children (in path order), using one query for the
+    children of all the nodes (none when they are all leaves).
+    """
+    parents_by_path = {}
+    for node in nodes:
+        node.hydrated_children = []
+        if node.numchild:
+            parents_by_path[node.path] = node
+    if not parents_by_path:
+        return nodes
+
+    children_filter = reduce(
+        or_,
+        [
+            Q(path__startswith=node.path, depth=node.depth + 1)
+            for node in parents_by_path.values()
+        ],
+    )
+    for child in StandardNode.objects.filter(children_filter).order_by("path"):
+        parent = parents_by_path.get(child.path[: -child.steplen])
+        if parent is not None:
+            parent.hydrated_children.append(child)
+    return nodes
@@ -0,0 +1,158 @@
+##################################################
+# MIT License
+#
+# Copyright (c) 2019 Learning Equality
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+##################################################
+
+"""
+In-memory index of the node pairs that have already been judged, so that the
+scheduler doesn't keep offering them. The index is loaded once per process and
+then catches up with the new judgments with one query per use, for the ids
+after the last one seen. Ids that were missing below it (judgments whose
+transaction commits after one with a higher id) are re-scanned until they show
+up, or for up to `GAP_MAX_AGE` seconds. The judgments created through the API
+are also recorded as soon as they are saved. Deleted judgments are not removed
+from the index until the process restarts.
+"""
+
+import threading
+import time
+from collections import Counter, defaultdict
+
+from .models import HumanRelevanceJudgment
+
+
+GAP_MAX_AGE = 600  # seconds, after which a missing id is taken as rolled back
+
+
+class JudgedPairs(object):
+    """
+    The judged pairs as adjacency lists, so the pairs of a node can be looked up
+    in O(degree): the number of judgments of each pair, and the pairs judged by
+    each user.
+    """
+
+    def __init__(self):
+        self.last_id = 0
+        self.counts = defaultdict(Counter)  # node id --> {other node id: count}
+        self.by_user = defaultdict(lambda: defaultdict(set))  # user --> node --> ids
+        self._recorded_ids = set()  # ids not seen by a refresh but already counted
+        self._gaps = {}  # missing ids <= last_id --> time they were found missing
+        self._lock = threading.Lock()
+
+    def _is_new(self, judgment_id):
+        if judgment_id in self._recorded_ids:
+            return False
+        return judgment_id > self.last_id or judgment_id in self._gaps
+
+    def _add(self, judgment_id, node1_id, node2_id, user_id):
+        if not self._is_new(judgment_id):
+            return False
+        self._gaps.pop(judgment_id, None)
+        self.counts[node1_id][node2_id] += 1
+        self.by_user[user_id][node1_id].add(node2_id)
+        if node2_id != node1_id:
+            self.counts[node2_id][node1_id] += 1
+            self.by_user[user_id][node2_id].add(node1_id)
+        return True
+
+    def refresh(self):
+        """
+        Add the judgments created since the last refresh (by any process), and
+        those that were committed late in the gaps of the ids seen before.
+        """
+        with self._lock:
+            # re-scan the trailing range of ids from the oldest missing one
+            first_id = min(self._gaps) if self._gaps else self.last_id + 1
+        judgments = HumanRelevanceJudgment.objects.filter(id__gte=first_id)
+        fields = ["id", "node1_id", "node2_id", "user_id"]
+        rows = list(judgments.order_by("id").values_list(*fields))
+        with self._lock:
+            now = time.monotonic()
+            # the holes in the ids of the first load are deletions, not gaps
+            track_gaps = self.last_id > 0
+            expected_id = self.last_id + 1
+            for row in rows:
+                judgment_id = row[0]
+                if judgment_id > self.last_id and track_gaps:
+                    for missing_id in range(expected_id, judgment_id):
+                        self._gaps[missing_id] = now
+                    expected_id = judgment_id + 1
+                if not self._add(*row):
+                    # counted when it was recorded, and now seen by a refresh
+                    self._gaps.pop(judgment_id, None)
+                    self._recorded_ids.discard(judgment_id)
+            if rows:
+                self.last_id = max(self.last_id, rows[-1][0])
+            self._gaps = {
+                gap_id: found
+                for gap_id, found in self._gaps.items()
+                if now - found < GAP_MAX_AGE
+            }
+            self._recorded_ids = {
+                i for i in self._recorded_ids if i > self.last_id or i in self._gaps
+            }
+
+    def record(self, judgment):
+        """
+        Add the `judgment` that was just created by this process.
+        """
+        j = judgment
+        with self._lock:
+            if self._add(j.id, j.node1_id, j.node2_id, j.user_id):
+                self._recorded_ids.add(j.id)
+                # until a refresh sees it, its id is treated as missing
+                if j.id <= self.last_id:
+                    self._gaps[j.id] = time.monotonic()
+
+    def judged_with(self, node_id, user_id=None, max_judgments=None):
+        """
+        The ids of the nodes that were paired with `node_id` in a judgment by
+        `user_id`, or in at least `max_judgments` judgments by anyone.
+        """
+        judged = set()
+        with self._lock:
+            if user_id is not None and user_id in self.by_user:
+                judged.update(self.by_user[user_id].get(node_id, ()))
+            if max_judgments and node_id in self.counts:
+                judged.update(
+                    other
+                    for other, count in self.counts[node_id].items()
+                    if count >= max_judgments
+                )
+        return judged
+
+
+_judged_pairs = JudgedPairs()
+
+
+def get_judged_pairs(refresh=True):
+    """
+    The `JudgedPairs` of this process, caught up with the database.
+    """
+    if refresh:
+        _judged_pairs.refresh()
+    return _judged_pairs
+
+
+def record_judgment(judgment):
+    _judged_pairs.record(judgment)
@@ -0,0 +1,249 @@
+##################################################
+# MIT License
+#
+# Copyright (c) 2019 Learning Equality
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+##################################################
+
+import os
+
+import numpy as np
+import scipy.sparse
+
+from django.conf import settings
+
+
+JUDGMENT_GRAPH_COLUMNS = ["node1_id", "node2_id", "rating", "confidence"]
+
+
+class JudgmentGraph(object):
+    """
+    The human judgments as a symmetric sparse N x N graph over the exported
+    nodes, in compressed sparse row (CSR) layout. Row i corresponds to the node
+    `node_ids[i]`, following the row order of standardnodes.csv (saved next to
+    the graph as nodeindex.npy, the same layout as the `index.npy` of models).
+
+    All judgments of a pair are aggregated into one entry: `counts` is the number
+    of judgments, and `ratings` and `confidences` are the means of the non-null
+    values (NaN if there are none). The three share the `indptr` and `indices`
+    arrays, so a node's judged neighbours are the slice `indptr[i]:indptr[i+1]`.
+    """
+
+    def __init__(self, node_ids, indptr, indices, ratings, confidences, counts):
+        self.node_ids = node_ids
+        self.indptr = indptr
+        self.indices = indices
+        self.ratings = ratings
+        self.confidences = confidences
+        self.counts = counts
+        self._id_index = None
+
+    @property
+    def n(self):
+        return len(self.node_ids)
+
+    @classmethod
+    def build(cls, node_ids, node1_ids, node2_ids, ratings, confidences):
+        """
+        Build the graph over `node_ids` from the judgment columns. Judgments of
+        nodes that are not in `node_ids` are dropped.
+        """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        n = len(node_ids)
+        sorter = np.argsort(node_ids)
+        rows = _lookup(node_ids, sorter, node1_ids)
+        cols = _lookup(node_ids, sorter, node2_ids)
+        ratings = np.asarray(ratings, dtype=np.float64)
+        confidences = np.asarray(confidences, dtype=np.float64)
+        known = (rows >= 0) & (cols >= 0)
+        rows, cols = rows[known], cols[known]
+        ratings, confidences = ratings[known], confidences[known]
+
+        # mirror the judgments (self-judgments only go on the diagonal once)
+        mirrored = rows != cols
+        sources = np.concatenate([rows, cols[mirrored]])
+        targets = np.concatenate([cols, rows[mirrored]])
+        ratings = np.concatenate([ratings, ratings[mirrored]])
+        confidences = np.concatenate([confidences, confidences[mirrored]])
+
+        # one entry per (source, target), sorted by source then target
+        keys = sources * n + targets
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        counts = np.bincount(inverse, minlength=len(unique_keys))
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(unique_keys // n, minlength=n), out=indptr[1:])
+        return cls(
+            node_ids,
+            indptr,
+            (unique_keys % n).astype(np.int64),
+            _nanmeans(inverse, ratings, len(unique_keys)),
+            _nanmeans(inverse, confidences, len(unique_keys)),
+            counts.astype(np.int64),
+        )
+
+    @classmethod
+    def load(cls, path, nodeindexpath):
+        node_ids = np.load(nodeindexpath)
+        with np.load(path, allow_pickle=False) as data:
+            return cls(
+                node_ids,
+                data["indptr"],
+                data["indices"],
+                data["ratings"],
+                data["confidences"],
+                data["counts"],
+            )
+
+    def save(self, path, nodeindexpath=None):
+        """
+        Write the graph to the npz file `path` (atomically, via a temporary file)
+        and, if given, the node ids to `nodeindexpath`.
+        """
+        if nodeindexpath is not None:
+            tmppath = nodeindexpath + ".tmp.npy"
+            np.save(tmppath, self.node_ids)
+            os.replace(tmppath, nodeindexpath)
+        tmppath = path + ".tmp.npz"
+        np.savez(
+            tmppath,
+            indptr=self.indptr,
+            indices=self.indices,
+            ratings=self.ratings,
+            confidences=self.confidences,
+            counts=self.counts,
+        )
+        os.replace(tmppath, path)
+
+    def rows_for_ids(self, node_ids):
+        """
+        The rows of the array `node_ids`, with -1 for unknown ids.
+        """
+        if self._id_index is None:
+            self._id_index = np.argsort(self.node_ids)
+        return _lookup(self.node_ids, self._id_index, node_ids)
+
+    def neighbours(self, row):
+        """
+        The judged neighbours of `row` as `(rows, ratings, confidences, counts)`,
+        in O(degree).
+        """
+        lo, hi = self.indptr[row], self.indptr[row + 1]
+        return (
+            self.indices[lo:hi],
+            self.ratings[lo:hi],
+            self.confidences[lo:hi],
+            self.counts[lo:hi],
+        )
+
+    def _matrix(self, data):
+        return scipy.sparse.csr_matrix(
+            (data, self.indices, self.indptr), shape=(self.n, self.n)
+        )
+
+    @property
+    def ratings_matrix(self):
+        return self._matrix(self.ratings)
+
+    @property
+    def confidences_matrix(self):
+        return self._matrix(self.confidences)
+
+    @property
+    def counts_matrix(self):
+        return self._matrix(self.counts)
+
+    def reindexed(self, node_ids):
+        """
+        The same graph with rows following `node_ids` instead, e.g. the
+        `node_id_lookup` of a model whose rows are in a different order.
+        Nodes that are not in this graph have no neighbours.
+        """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        row_map = _lookup(node_ids, np.argsort(node_ids), self.node_ids)
+        sources = np.repeat(row_map, np.diff(self.indptr))
+        targets = row_map[self.indices]
+        known = (sources >= 0) & (targets >= 0)
+        order = np.lexsort((targets[known], sources[known]))
+        sources = sources[known][order]
+        indptr = np.zeros(len(node_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(node_ids)), out=indptr[1:])
+        return JudgmentGraph(
+            node_ids,
+            indptr,
+            targets[known][order],
+            self.ratings[known][order],
+            self.confidences[known][order],
+            self.counts[known][order],
+        )
+
+
+def _lookup(node_ids, sorter, ids):
+    """
+    Positions of `ids` in the array `node_ids` (argsorted by `sorter`), or -1.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    if len(node_ids) == 0:
+        return np.full(len(ids), -1, dtype=np.int64)
+    positions = np.searchsorted(node_ids, ids, sorter=sorter)
+    positions = np.minimum(positions, len(node_ids) - 1)
+    rows = sorter[positions]
+    return np.where(node_ids[rows] == ids, rows, -1)
+
+
+def _nanmeans(groups, values, ngroups):
+    """
+    Mean of the non-NaN `values` in each of the `ngroups` groups.
+    """
+    present = ~np.isnan(values)
+    sums = np.bincount(groups[present], values[present], minlength=ngroups)
+    counts = np.bincount(groups[present], minlength=ngroups)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return sums / counts
+
+
+def write_judgment_graph(exportpath, filename, node_ids, judgments):
+    """
+    Write the graph of the `judgments` (a DataFrame or dict of columns with
+    `JUDGMENT_GRAPH_COLUMNS`) over `node_ids` to `filename` in `exportpath`,
+    and the node ids to `settings.NODE_INDEX_FILENAME` too.
+    """
+    columns = [judgments[column] for column in JUDGMENT_GRAPH_COLUMNS]
+    graph = JudgmentGraph.build(node_ids, *columns)
+    nodeindexpath = os.path.join(exportpath, settings.NODE_INDEX_FILENAME)
+    graph.save(os.path.join(exportpath, filename), nodeindexpath)
+    return graph
+
+
+def load_judgment_graph(exportpath, test=False):
+    """
+    Load the training (or `test`) judgment graph of the export at `exportpath`,
+    or None if the export doesn't have it.
+    """
+    if test:
+        filename = settings.HUMAN_JUDGMENTS_TEST_GRAPH_FILENAME
+    else:
+        filename = settings.HUMAN_JUDGMENTS_GRAPH_FILENAME
+    path = os.path.join(exportpath, filename)
+    if not os.path.exists(path):
+        return None
+    return JudgmentGraph.load(
+        path, os.path.join(exportpath, settings.NODE_INDEX_FILENAME)
+    )
@@ -0,0 +1,90 @@
+##################################################
+# MIT License
+#
+# Copyright (c) 2019 Learning Equality
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+##################################################
+
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from ...annindex import DEFAULT_NPROBE
+from ...modelstore import get_model
+from ...recommenders import top_k, top_k_ann
+
+
+class Command(BaseCommand):
+    """
+    Measure the recall and latency of the ANN recommendation engine against
+    the exact top-k search on a random sample of query nodes.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("--model", type=str, default="baseline")
+        parser.add_argument("--queries", type=int, default=200)
+        parser.add_argument("--count", type=int, default=10)
+        parser.add_argument(
+            "--nprobe", type=int, nargs="+", default=[1, 2, 4, DEFAULT_NPROBE, 16]
+        )
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        model = get_model(options["model"])
+        if model.ann_index is None:
+            print("Model has no ANN index, run `manage.py buildannindex` first.")
+            return
+        count = options["count"]
+        rng = np.random.RandomState(options["seed"])
+        rows = rng.choice(model.n, min(options["queries"], model.n), replace=False)
+        document_ids = model.document_ids
+
+        exact_results = {}
+        start = time.time()
+        for row in rows:
+            ids, _ = top_k(
+                model, row, exclude_document_id=document_ids[row], count=count
+            )
+            exact_results[row] = set(ids)
+        exact_ms = 1000 * (time.time() - start) / len(rows)
+        print("exact         {:8.2f} ms/query".format(exact_ms))
+
+        for nprobe in options["nprobe"]:
+            recalls = []
+            start = time.time()
+            for row in rows:
+                ids, _ = top_k_ann(
+                    model,
+                    row,
+                    exclude_document_id=document_ids[row],
+                    count=count,
+                    nprobe=nprobe,
+                )
+                expected = exact_results[row]
+                if expected:
+                    recalls.append(len(expected & set(ids)) / len(expected))
+            ann_ms = 1000 * (time.time() - start) / len(rows)
+            print(
+                "ann nprobe={:<3d}{:8.2f} ms/query  recall@{}={:.3f}".format(
+                    nprobe, ann_ms, count, np.mean(recalls)
+                )
+            )
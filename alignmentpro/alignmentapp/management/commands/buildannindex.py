@@ -0,0 +1,59 @@
+##################################################
+# MIT License
+#
+# Copyright (c) 2019 Learning Equality
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+##################################################
+
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ...annindex import build_ann_index
+
+
+class Command(BaseCommand):
+    """
+    Build the approximate nearest-neighbour index used by `/api/recommend/?engine=ann`
+    from a model's embeddings.npy, and save it in the model directory.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("--model", type=str, default="baseline")
+        parser.add_argument(
+            "--nlist", type=int, help="Number of IVF lists (default ~4*sqrt(N))"
+        )
+        parser.add_argument("--niter", type=int, default=20)
+
+    def handle(self, *args, **options):
+        modeldirpath = os.path.join(settings.MODELS_BASE_DIR, options["model"])
+        print("Building ANN index for model {}...".format(options["model"]))
+        start = time.time()
+        index = build_ann_index(
+            modeldirpath, nlist=options["nlist"], niter=options["niter"]
+        )
+        print(
+            "Built index with {} lists over {} rows in {:.1f}s".format(
+                index.nlist, len(index.rows), time.time() - start
+            )
+        )
@@ -0,0 +1,50 @@
+##################################################
+# MIT License
+#
+# Copyright (c) 2019 Learning Equality
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+##################################################
+
+from django.core.management.base import BaseCommand
+
+from alignmentapp.columnar import CSV_FORMAT, EXPORT_FORMATS
+from alignmentapp.compaction import compact_exports
+
+
+class Command(BaseCommand):
+    """
+    Merge the delta data exports done since the last full export into a new full
+    snapshot (and point the `latest` symlink to it).
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--format",
+            nargs="+",
+            choices=EXPORT_FORMATS,
+            default=[CSV_FORMAT],
+            help="One or more of csv, npz (numpy), parquet (requires pyarrow).",
+        )
+
+    def handle(self, *args, **options):
+        exportdir = compact_exports(formats=options["format"])
+        if exportdir:
+            print("Compacted data exported to directory", exportdir)
@@ -0,0 +1,53 @@
+##################################################
+# MIT License
+#
+# Copyright (c) 2019 Learning Equality
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+##################################################
+
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ...modelstore import convert_embeddings_to_float32
+
+
+class Command(BaseCommand):
+    """
+    Rewrite the embeddings.npy of models published before embeddings were
+    converted at publish time as float32, so the API can memory-map them.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--model", type=str, help="Only convert this model (default: all)."
+        )
+
+    def handle(self, *args, **options):
+        base_dir = settings.MODELS_BASE_DIR
+        names = [options["model"]] if options["model"] else os.listdir(base_dir)
+        for name in names:
+            modeldirpath = os.path.join(base_dir, name)
+            if not os.path.isdir(modeldirpath):
+                continue
+            if convert_embeddings_to_float32(modeldirpath):
+                print("Converted the embeddings of model {} to float32".format(name))
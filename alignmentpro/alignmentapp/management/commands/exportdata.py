@@ -30,6 +30,7 @@ from django.core.management import call_command
 from django.core.management.base import BaseCommand
 
 from alignmentapp.models import CurriculumDocument, StandardNode
+from alignmentapp.columnar import CSV_FORMAT, EXPORT_FORMATS
 from alignmentapp.exporting import export_data
 
 
@@ -41,10 +42,25 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument("--drafts", action="store_true")
         parser.add_argument("--includetestdata", action="store_true")
+        parser.add_argument(
+            "--format",
+            nargs="+",
+            choices=EXPORT_FORMATS,
+            default=[CSV_FORMAT],
+            help="One or more of csv, npz (numpy), parquet (requires pyarrow).",
+        )
+        parser.add_argument(
+            "--delta",
+            action="store_true",
+            help="Only export what changed since the previous export.",
+        )
 
     def handle(self, *args, **options):
         print("Starting data export...")
         exportdir = export_data(
-            drafts=options["drafts"], includetestdata=options["includetestdata"]
+            drafts=options["drafts"],
+            includetestdata=options["includetestdata"],
+            formats=options["format"],
+            delta=options["delta"],
         )
         print("Data exported to directory", exportdir)
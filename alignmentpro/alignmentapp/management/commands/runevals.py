@@ -24,31 +24,121 @@
 ##################################################
 
 import json
+import multiprocessing
 import nbformat
 import os
+import resource
 import subprocess
 import sys
+import time
 
 from django.conf import settings
 from django.core.management import call_command
 from django.core.management.base import BaseCommand
+from django.db import connections
 
-from ...evaluators import ranking
+from ...evaluators import EVALUATION_MANIFEST_FILENAME
+from ...evaluators import get_evaluation_manifest, get_judgments_hashes, ranking
+from ...modelstore import DIRTY_FILENAME, SCORES_FILENAME, write_json_atomically
+
+
+def evaluate_model(name, model_path):
+    """
+    Evaluate the model `name` and write its scores.json atomically. Returns the
+    model name, the wall time in seconds, the peak RSS of this process in MB,
+    and the error message if the evaluation failed. Runs in a fresh worker
+    process per model, so the peak RSS and the loaded model are per model.
+    """
+    start = time.time()
+    error = None
+    try:
+        scores = ranking(name)
+        write_json_atomically(os.path.join(model_path, SCORES_FILENAME), scores)
+    except Exception as e:
+        error = repr(e)
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return name, time.time() - start, peak_rss, error
 
 
 class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--jobs",
+            type=int,
+            default=1,
+            help="Number of models to evaluate in parallel processes.",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Re-evaluate all models, even if their inputs haven't changed.",
+        )
+
     def handle(self, *args, **options):
         print("Starting model evaluations...")
         os.environ["RUNMODE"] = "production"
         base_dir = os.path.join(settings.MEDIA_ROOT, "models")
         model_dirs = os.listdir(base_dir)
+        judgments_hashes = get_judgments_hashes()
+        tasks = []
+        manifests = {}
+        num_unchanged = 0
         for name in model_dirs:
             print("Preparing to evaluate model {}...".format(name))
             model_path = os.path.join(base_dir, name)
-            dirty_path = os.path.join(model_path, "dirty")
+            dirty_path = os.path.join(model_path, DIRTY_FILENAME)
             if os.path.exists(dirty_path):
                 print("Model is dirty! Skipping.")
                 continue
-            scores = ranking(name)
-            with open(os.path.join(model_path, "scores.json"), "w") as f:
-                json.dump(scores, f, indent=4)
+            manifest = get_evaluation_manifest(model_path, judgments_hashes)
+            if not options["force"] and self.is_unchanged(model_path, manifest):
+                print("Model and judgments unchanged since last evaluation, skipping.")
+                num_unchanged += 1
+                continue
+            manifests[name] = manifest
+            tasks.append((name, model_path))
+
+        start = time.time()
+        jobs = max(1, options["jobs"])
+        # don't share the DB connections with the forked workers
+        connections.close_all()
+        # one process per model, also with --jobs 1, so that the peak RSS is per
+        # model and each model's arrays are freed when its process exits
+        with multiprocessing.Pool(jobs, maxtasksperchild=1) as pool:
+            results = pool.imap_unordered(_evaluate_model_star, tasks)
+            for result in results:
+                self.report(*result, manifests=manifests)
+        print("Evaluated {} models in {:.1f}s".format(len(tasks), time.time() - start))
+        print(
+            "Summary: {} models re-evaluated, {} skipped as unchanged".format(
+                len(tasks), num_unchanged
+            )
+        )
+
+    def is_unchanged(self, model_path, manifest):
+        scores_path = os.path.join(model_path, SCORES_FILENAME)
+        manifest_path = os.path.join(model_path, EVALUATION_MANIFEST_FILENAME)
+        if not os.path.exists(scores_path) or not os.path.exists(manifest_path):
+            return False
+        with open(manifest_path) as f:
+            return json.load(f) == manifest
+
+    def report(self, name, wall_time, peak_rss, error, manifests):
+        if error:
+            print(error)
+            print("ERROR evaluating", name)
+        else:
+            # record the inputs of the scores so the next run can skip this model
+            model_path = os.path.join(settings.MEDIA_ROOT, "models", name)
+            manifest_path = os.path.join(model_path, EVALUATION_MANIFEST_FILENAME)
+            write_json_atomically(manifest_path, manifests[name])
+        print(
+            "Evaluated model {} in {:.1f}s (peak RSS {:.0f} MB)".format(
+                name, wall_time, peak_rss
+            )
+        )
+
+
+def _evaluate_model_star(args):
+    return evaluate_model(*args)
@@ -23,38 +23,83 @@
 #
 ##################################################
 
-import nbformat
+import multiprocessing
 import os
 import subprocess
 import sys
+import time
 
 from django.conf import settings
 from django.core.management import call_command
 from django.core.management.base import BaseCommand
-from nbconvert.preprocessors import ExecutePreprocessor
+from django.db import connections
+from django.utils import timezone
+
+from ...modelruns import STATE_WAITING, run_model_notebook, update_run_status
+from ...modelstore import DIRTY_FILENAME
 
 
 class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--jobs",
+            type=int,
+            default=1,
+            help="Number of model notebooks to execute concurrently.",
+        )
+        parser.add_argument(
+            "--timeout", type=int, default=600, help="Timeout for each cell (s)."
+        )
+        parser.add_argument(
+            "--max_memory",
+            type=int,
+            help="Address space limit for each notebook (MB, default no limit).",
+        )
+        parser.add_argument(
+            "--max_cpu",
+            type=int,
+            help="CPU time limit for each notebook (s, default no limit).",
+        )
+
     def handle(self, *args, **options):
         print("Starting model runs...")
         os.environ["RUNMODE"] = "production"
         base_dir = os.path.join(settings.MEDIA_ROOT, "models")
         model_dirs = os.listdir(base_dir)
+        tasks = []
         for name in model_dirs:
             print("Preparing to run model {}...".format(name))
             model_path = os.path.join(base_dir, name)
-            dirty_path = os.path.join(model_path, "dirty")
+            dirty_path = os.path.join(model_path, DIRTY_FILENAME)
             if not os.path.exists(dirty_path):
                 print("No updates, skipping.")
                 continue
             print("Location:", model_path)
-            try:
-                with open(os.path.join(model_path, "model.ipynb")) as f:
-                    nb = nbformat.read(f, as_version=4)
-                ep = ExecutePreprocessor(timeout=600, kernel_name="python3")
-                ep.preprocess(nb, {"metadata": {"path": model_path}})
-                os.unlink(dirty_path)
-            except Exception as e:
-                print(e)
-                print("ERROR running", name)
-                continue
+            update_run_status(
+                model_path, state=STATE_WAITING, queued=timezone.now().isoformat()
+            )
+            tasks.append(
+                (
+                    name,
+                    model_path,
+                    options["timeout"],
+                    options["max_memory"],
+                    options["max_cpu"],
+                )
+            )
+
+        start = time.time()
+        # don't share the DB connections with the forked workers
+        connections.close_all()
+        # a fresh process per notebook, so resource limits apply to one run only
+        with multiprocessing.Pool(options["jobs"], maxtasksperchild=1) as pool:
+            for name, duration, error in pool.imap_unordered(_run_star, tasks):
+                if error:
+                    print(error)
+                    print("ERROR running", name)
+                print("Finished running model {} in {:.1f}s".format(name, duration))
+        print("Ran {} models in {:.1f}s".format(len(tasks), time.time() - start))
+
+
+def _run_star(args):
+    return run_model_notebook(*args)
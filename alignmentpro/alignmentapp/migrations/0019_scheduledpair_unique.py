@@ -0,0 +1,49 @@
+##################################################
+# MIT License
+#
+# Copyright (c) 2019 Learning Equality
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+##################################################
+
+# Generated by Django 2.2.7 on 2019-11-25 10:12
+
+from django.db import migrations, models
+
+
+def delete_scheduled_pairs(apps, schema_editor):
+    # queued pairs are only a cache, and may contain duplicates
+    ScheduledPair = apps.get_model('alignmentapp', 'ScheduledPair')
+    ScheduledPair.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('alignmentapp', '0018_scheduledpair'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_scheduled_pairs, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='scheduledpair',
+            constraint=models.UniqueConstraint(fields=('user', 'node1', 'node2'), name='scheduled_pair_unique_per_user'),
+        ),
+    ]
@@ -0,0 +1,233 @@
+##################################################
+# MIT License
+#
+# Copyright (c) 2019 Learning Equality
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+##################################################
+
+import json
+import os
+import resource
+import shutil
+import time
+import traceback
+
+from django.utils import timezone
+
+from .modelstore import DIRTY_FILENAME, MODEL_ARTIFACTS
+from .modelstore import convert_embeddings_to_float32, write_json_atomically
+
+
+RUN_STATUS_FILENAME = "runstatus.json"
+NOTEBOOK_FILENAME = "model.ipynb"
+RUNS_DIRNAME = "runs"
+STAGING_DIRNAME = "staging"
+
+STATE_WAITING = "waiting"
+STATE_RUNNING = "running"
+STATE_DONE = "done"
+STATE_FAILED = "failed"
+
+
+# RUN STATUS
+################################################################################
+
+
+def read_run_status(model_path):
+    """
+    Return the status of the last notebook run for the model in `model_path`.
+    Dirty models that are not being run yet are reported as waiting.
+    """
+    status_path = os.path.join(model_path, RUN_STATUS_FILENAME)
+    status = {}
+    if os.path.exists(status_path):
+        with open(status_path) as f:
+            status = json.load(f)
+    dirty_path = os.path.join(model_path, DIRTY_FILENAME)
+    if os.path.exists(dirty_path) and status.get("state") in [None, STATE_DONE]:
+        status = dict(status, state=STATE_WAITING)
+    elif (
+        os.path.exists(dirty_path)
+        and status.get("state") == STATE_FAILED
+        and os.path.getmtime(dirty_path) > status.get("finished_timestamp", 0)
+    ):
+        # the model was uploaded again after the failed run
+        status = dict(status, state=STATE_WAITING)
+    elif not status:
+        status = dict(state=STATE_DONE)
+    return status
+
+
+def update_run_status(model_path, **kwargs):
+    status_path = os.path.join(model_path, RUN_STATUS_FILENAME)
+    status = {}
+    if os.path.exists(status_path):
+        with open(status_path) as f:
+            status = json.load(f)
+    status.update(kwargs)
+    write_json_atomically(status_path, status)
+    return status
+
+
+def get_queue_status(base_dir):
+    """
+    Status of the notebook runs of all the models in `base_dir`.
+    """
+    queue = []
+    for name in sorted(os.listdir(base_dir)):
+        model_path = os.path.join(base_dir, name)
+        if os.path.isdir(model_path):
+            queue.append(dict(read_run_status(model_path), name=name))
+    return queue
+
+
+# NOTEBOOK RUNS
+################################################################################
+
+
+def stage_artifacts(model_path):
+    """
+    Move the model artifacts out of the way of the notebook, which then writes
+    new files (e.g. with `np.save`) instead of truncating the files that the API
+    has memory-mapped. The artifacts are hard-linked into a staging directory
+    and unlinked, so nothing is copied and the memory maps stay valid.
+    """
+    staging_path = os.path.join(model_path, STAGING_DIRNAME)
+    if os.path.exists(staging_path):
+        # left behind by an interrupted run: put the previous artifacts back
+        restore_artifacts(staging_path, model_path, replace=True)
+    os.makedirs(staging_path)
+    for filename in MODEL_ARTIFACTS:
+        filepath = os.path.join(model_path, filename)
+        if os.path.isfile(filepath):
+            os.link(filepath, os.path.join(staging_path, filename))
+            os.unlink(filepath)
+    return staging_path
+
+
+def restore_artifacts(staging_path, model_path, replace=True):
+    """
+    Put the staged artifacts back into the model directory with atomic renames,
+    then remove the staging directory. With `replace=False`, the artifacts the
+    notebook wrote again are kept and only the others are restored; after a
+    failed run (`replace=True`) the previous artifacts replace its outputs.
+    """
+    for filename in os.listdir(staging_path):
+        staged = os.path.join(staging_path, filename)
+        target = os.path.join(model_path, filename)
+        if replace or not os.path.exists(target):
+            os.replace(staged, target)
+    shutil.rmtree(staging_path)
+
+
+def limit_resources(max_memory_mb=None, max_cpu_seconds=None):
+    """
+    Lower the soft memory and CPU limits of the current process. The limits are
+    inherited by the Jupyter kernel that executes the notebook.
+    """
+    if max_memory_mb:
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        resource.setrlimit(resource.RLIMIT_AS, (max_memory_mb * 1024 * 1024, hard))
+    if max_cpu_seconds:
+        _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+        resource.setrlimit(resource.RLIMIT_CPU, (max_cpu_seconds, hard))
+
+
+def notebook_outputs_as_text(nb):
+    """
+    The text output (streams, results, and errors) of the executed notebook `nb`.
+    """
+    lines = []
+    for cell in nb.cells:
+        for output in cell.get("outputs", []):
+            if output.output_type == "stream":
+                lines.append(output.text)
+            elif output.output_type in ["execute_result", "display_data"]:
+                lines.append(output.get("data", {}).get("text/plain", ""))
+            elif output.output_type == "error":
+                lines.append("\n".join(output.traceback))
+    return "\n".join(lines)
+
+
+def run_model_notebook(
+    name, model_path, timeout=600, max_memory_mb=None, max_cpu_seconds=None
+):
+    """
+    Execute the model.ipynb of model `name` with resource limits, writing a log
+    to `runs/<timestamp>.log` in the model directory and keeping `runstatus.json`
+    up to date. Meant to run in its own (pool worker) process.
+    """
+    # imported here so that the API can use the status helpers without nbconvert
+    import nbformat
+    from nbconvert.preprocessors import ExecutePreprocessor
+
+    runs_dir = os.path.join(model_path, RUNS_DIRNAME)
+    os.makedirs(runs_dir, exist_ok=True)
+    log_name = timezone.localtime().strftime("%Y%m%d-%H%M%S") + ".log"
+    log_path = os.path.join(runs_dir, log_name)
+
+    start = time.time()
+    update_run_status(
+        model_path,
+        state=STATE_RUNNING,
+        started=timezone.now().isoformat(),
+        finished=None,
+        duration=None,
+        error=None,
+        log=os.path.join(RUNS_DIRNAME, log_name),
+    )
+    error = None
+    nb = None
+    try:
+        limit_resources(max_memory_mb=max_memory_mb, max_cpu_seconds=max_cpu_seconds)
+        with open(os.path.join(model_path, NOTEBOOK_FILENAME)) as f:
+            nb = nbformat.read(f, as_version=4)
+        ep = ExecutePreprocessor(timeout=timeout, kernel_name="python3")
+        staging_path = stage_artifacts(model_path)
+        ep.preprocess(nb, {"metadata": {"path": model_path}})
+        restore_artifacts(staging_path, model_path, replace=False)
+        convert_embeddings_to_float32(model_path)
+        os.unlink(os.path.join(model_path, DIRTY_FILENAME))
+    except Exception as e:
+        error = repr(e)
+        error_traceback = traceback.format_exc()
+        staging_path = os.path.join(model_path, STAGING_DIRNAME)
+        if os.path.exists(staging_path):
+            restore_artifacts(staging_path, model_path, replace=True)
+    duration = time.time() - start
+
+    with open(log_path, "w") as log_file:
+        log_file.write("Model: {}\n".format(name))
+        log_file.write("Duration: {:.1f}s\n\n".format(duration))
+        if nb is not None:
+            log_file.write(notebook_outputs_as_text(nb))
+        if error:
+            log_file.write("\n\nERROR running notebook:\n" + error_traceback)
+
+    update_run_status(
+        model_path,
+        state=STATE_FAILED if error else STATE_DONE,
+        finished=timezone.now().isoformat(),
+        finished_timestamp=time.time(),
+        duration=duration,
+        error=error,
+    )
+    return name, duration, error
@@ -259,6 +259,11 @@ class StandardNode(MP_Node):
     # basic model extensibility w/o changing base API
     extra_fields = JSONField(default=dict)
 
+    # change tracking for delta data exports (note bulk_update and update
+    # don't set `modified` automatically, so callers must set it themselves)
+    created = models.DateTimeField(auto_now_add=True)
+    modified = models.DateTimeField(auto_now=True, db_index=True)
+
     # Human relevance jugments on edges between nodes
     @property
     def judgments(self):
@@ -323,6 +328,7 @@ class HumanRelevanceJudgment(models.Model):
         on_delete=models.SET_NULL,
     )
     created = models.DateTimeField(auto_now_add=True)
+    modified = models.DateTimeField(auto_now=True, db_index=True)
     is_test_data = models.BooleanField(
         blank=True, null=True, help_text="True for held out test data."
     )
@@ -350,16 +356,105 @@ class Parameter(models.Model):
     modified = models.DateTimeField(auto_now=True)
 
 
+EXPORT_KINDS = [
+    ("full", "Full snapshot"),
+    ("delta", "Changes since the previous export"),
+]
+
+
 class DataExport(models.Model):
     """
     Keep track when data exports was done and which folder it was saved to.
     """
 
     exportdirname = models.CharField(max_length=400, blank=True, null=True)
+    kind = models.CharField(max_length=20, choices=EXPORT_KINDS, default="full")
     started = models.DateTimeField(auto_now_add=True)
     finished = models.DateTimeField(blank=True, null=True)
 
 
+class Tombstone(models.Model):
+    """
+    Records the deletion of a StandardNode or HumanRelevanceJudgment so that
+    delta data exports can tell consumers to drop the row. The code that deletes
+    nodes or judgments creates their tombstones in bulk with `bury` or
+    `bury_nodes`, in the same transaction as the delete (a post_delete signal
+    would make Django delete, and then bury, the rows one at a time).
+    """
+
+    model_name = models.CharField(max_length=100)
+    object_id = models.IntegerField()
+    # the document of a deleted StandardNode, which delta exports re-export
+    # since deleting a node changes its parent (treebeard updates `numchild`
+    # without bumping `modified`)
+    document_id = models.IntegerField(blank=True, null=True)
+    deleted = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    @classmethod
+    def bury(cls, model, object_ids, document_ids=None, batch_size=1000):
+        """
+        Bulk create the tombstones of the rows `object_ids` of `model`, with
+        the matching `document_ids` for nodes.
+        """
+        if document_ids is None:
+            document_ids = [None] * len(object_ids)
+        cls.objects.bulk_create(
+            [
+                cls(model_name=model.__name__, object_id=pk, document_id=document_id)
+                for pk, document_id in zip(object_ids, document_ids)
+            ],
+            batch_size=batch_size,
+        )
+
+    @classmethod
+    def bury_nodes(cls, nodes):
+        """
+        Bulk create the tombstones of the StandardNode queryset `nodes` and of
+        the judgments on them, which are deleted with them (on_delete=CASCADE).
+        Must be called before the nodes are deleted.
+        """
+        node_ids = nodes.values("id")
+        judgment_ids = HumanRelevanceJudgment.objects.filter(
+            Q(node1__in=node_ids) | Q(node2__in=node_ids)
+        ).values_list("id", flat=True)
+        cls.bury(HumanRelevanceJudgment, list(judgment_ids))
+        rows = list(nodes.values_list("id", "document_id"))
+        cls.bury(
+            StandardNode,
+            [node_id for node_id, _ in rows],
+            document_ids=[document_id for _, document_id in rows],
+        )
+
+
+class ScheduledPair(models.Model):
+    """
+    A pair of nodes sampled ahead of time by the scheduler for `user`, so that
+    the pairs can be served from a queue (see `pairqueue`). `params` holds the
+    scheduler parameters the pair was sampled with.
+    """
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        related_name="scheduled_pairs",
+        on_delete=models.CASCADE,
+    )
+    node1 = models.ForeignKey(StandardNode, related_name="+", on_delete=models.CASCADE)
+    node2 = models.ForeignKey(StandardNode, related_name="+", on_delete=models.CASCADE)
+    relevance = models.FloatField()
+    probability = models.FloatField()
+    params = JSONField(default=dict)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["user", "id"])]
+        constraints = [
+            UniqueConstraint(  # the same pair is never queued twice for a user
+                name="scheduled_pair_unique_per_user",
+                fields=["user", "node1", "node2"],
+            )
+        ]
+
+
 # CAMPAIGNS
 ################################################################################
 
@@ -0,0 +1,392 @@
+##################################################
+# MIT License
+#
+# Copyright (c) 2019 Learning Equality
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+##################################################
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from django.conf import settings
+
+from .annindex import ANN_INDEX_FILENAME, IVFIndex
+from .candidates import CANDIDATE_INDEX_CHECK_INTERVAL, CandidateIndex
+from .candidates import get_nodes_watermark
+from .models import StandardNode
+
+
+# MODEL DIRECTORY LAYOUT
+################################################################################
+INDEX_FILENAME = "index.npy"
+RELEVANCE_FILENAME = "relevance.npy"
+EMBEDDINGS_FILENAME = "embeddings.npy"
+NODES_FILENAME = "nodes.pk"
+DIRTY_FILENAME = "dirty"
+SCORES_FILENAME = "scores.json"
+
+BASELINE_MODEL_NAME = "baseline"
+
+MODEL_ARTIFACTS = [
+    INDEX_FILENAME,
+    RELEVANCE_FILENAME,
+    EMBEDDINGS_FILENAME,
+    NODES_FILENAME,
+    ANN_INDEX_FILENAME,
+]
+
+
+def write_json_atomically(path, data):
+    """
+    Write `data` as JSON to `path` via a temporary file in the same directory,
+    so readers (e.g. the /api/model/ endpoint) never see a partial file.
+    """
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, indent=4)
+        os.replace(tmppath, path)
+    except BaseException:
+        os.unlink(tmppath)
+        raise
+
+
+def copy_atomically(src, dst):
+    """
+    Copy the file `src` to `dst` via a temporary file and a rename, so that the
+    file at `dst` is replaced by a new inode instead of being rewritten in place
+    under the memory maps that other processes may have of it.
+    """
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(dst), suffix=".tmp")
+    os.close(fd)
+    try:
+        shutil.copy2(src, tmppath)
+        os.replace(tmppath, dst)
+    except BaseException:
+        os.unlink(tmppath)
+        raise
+
+
+def convert_embeddings_to_float32(modeldirpath, chunk_rows=65536):
+    """
+    Rewrite the embeddings.npy of the model in `modeldirpath` as float32 (via a
+    temporary file and a rename), so that every process memory-maps the array it
+    computes with instead of converting a private copy. Called when a model is
+    published; returns True if the file was converted.
+    """
+    path = os.path.join(modeldirpath, EMBEDDINGS_FILENAME)
+    if not os.path.exists(path):
+        return False
+    embeddings = np.load(path, mmap_mode="r")
+    if embeddings.dtype == np.float32:
+        return False
+    fd, tmppath = tempfile.mkstemp(dir=modeldirpath, suffix=".tmp.npy")
+    os.close(fd)
+    try:
+        converted = np.lib.format.open_memmap(
+            tmppath, mode="w+", dtype=np.float32, shape=embeddings.shape
+        )
+        for start in range(0, len(embeddings), chunk_rows):
+            converted[start : start + chunk_rows] = embeddings[
+                start : start + chunk_rows
+            ]
+        converted.flush()
+        del converted
+        os.replace(tmppath, path)
+    except BaseException:
+        os.unlink(tmppath)
+        raise
+    return True
+
+
+# PROCESS-RESIDENT MODEL CACHE
+################################################################################
+
+_models = {}
+_models_lock = threading.RLock()
+
+
+def get_model(model_name=BASELINE_MODEL_NAME):
+    """
+    Return the `LoadedModel` for `model_name`, loading it at most once per
+    process. The model is reloaded when any of its artifacts change on disk,
+    e.g. after `runmodels` re-executes the notebook and removes the `dirty`
+    marker. While a model is dirty we keep serving the copy already in memory.
+    """
+    modeldirpath = os.path.join(settings.MODELS_BASE_DIR, model_name)
+    signature = get_model_signature(modeldirpath)
+    with _models_lock:
+        model = _models.get(model_name)
+        if model is not None:
+            if model.signature == signature:
+                return model
+            if signature[0]:  # dirty: notebook is still writing the artifacts
+                return model
+        model = LoadedModel(model_name, modeldirpath, signature)
+        _models[model_name] = model
+        return model
+
+
+def clear_models():
+    """
+    Drop all the models cached in this process.
+    """
+    with _models_lock:
+        _models.clear()
+
+
+def get_model_signature(modeldirpath):
+    """
+    Cheap fingerprint of the model directory, computed with one `stat` call per
+    artifact: `(is_dirty, (filename, inode, mtime, size), ...)`.
+    """
+    is_dirty = os.path.exists(os.path.join(modeldirpath, DIRTY_FILENAME))
+    stats = []
+    for filename in MODEL_ARTIFACTS:
+        try:
+            st = os.stat(os.path.join(modeldirpath, filename))
+        except FileNotFoundError:
+            continue
+        stats.append((filename, st.st_ino, st.st_mtime_ns, st.st_size))
+    return (is_dirty,) + tuple(stats)
+
+
+class LoadedModel(object):
+    """
+    The artifacts of a trained model. The numpy arrays are memory-mapped
+    read-only so all the gunicorn workers share the same OS page cache, and
+    nothing is read from disk until a row is actually accessed.
+
+    Artifacts must never be rewritten in place, since truncating a file under a
+    live memory map is unsafe (SIGBUS): uploads are copied with `copy_atomically`
+    and the artifacts are moved aside before a notebook runs, so that it writes
+    new files (see `modelruns.stage_artifacts`).
+    """
+
+    def __init__(self, name, path, signature):
+        self.name = name
+        self.path = path
+        self.signature = signature
+
+        # the index maps matrix rows to StandardNode ids
+        self.node_id_lookup = self._load_array(INDEX_FILENAME)
+        assert self.node_id_lookup is not None, "model has no " + INDEX_FILENAME
+        self.n = len(self.node_id_lookup)
+
+        # the N x N relevance matrix
+        self.relevance_matrix = self._load_array(RELEVANCE_FILENAME)
+        if self.relevance_matrix is not None:
+            shape = self.relevance_matrix.shape
+            assert shape == (self.n, self.n), "relevance_matrix has wrong shape"
+
+        # the N x d node embeddings, used when there is no relevance matrix
+        self.embeddings = self._load_array(EMBEDDINGS_FILENAME)
+        if self.embeddings is not None:
+            assert self.embeddings.shape[0] == self.n, "embeddings has wrong shape"
+        assert (
+            self.relevance_matrix is not None or self.embeddings is not None
+        ), "model needs either {} or {}".format(RELEVANCE_FILENAME, EMBEDDINGS_FILENAME)
+        if self.embeddings is not None and self.embeddings.dtype != np.float32:
+            print(
+                "Embeddings of model {} are {}, convert them to float32 with "
+                "manage.py convertembeddings".format(name, self.embeddings.dtype)
+            )
+
+        # the pickled DataFrame of nodes (indexed by node id, with a `row` column)
+        self.nodes = self._load_nodes()
+
+        self._id_index = None
+        self._document_ids = None
+        self._document_masks = {}
+        self._ann_index = None
+        self._candidate_index = None
+        self._candidate_index_checked = None
+
+    def _load_array(self, filename):
+        filepath = os.path.join(self.path, filename)
+        if not os.path.exists(filepath):
+            return None
+        return np.load(filepath, mmap_mode="r")
+
+    def _load_nodes(self):
+        nodespath = os.path.join(self.path, NODES_FILENAME)
+        if os.path.exists(nodespath):
+            return pd.read_pickle(nodespath)
+        if self.name == BASELINE_MODEL_NAME:
+            return None
+        # embeddings-only models reuse the node metadata of the baseline model,
+        # and read the documents of the nodes it doesn't have (e.g. the nodes of
+        # new curricula) from the database with one query
+        baseline_nodes = get_model(BASELINE_MODEL_NAME).nodes
+        ids = pd.Index(self.node_id_lookup)
+        if baseline_nodes is None:
+            nodes = pd.DataFrame(index=ids, columns=["document_id"], dtype=float)
+        else:
+            nodes = baseline_nodes.reindex(ids)
+        missing = nodes.document_id.isna().values
+        if missing.any():
+            missing_ids = ids[missing].tolist()
+            document_ids = dict(
+                StandardNode.objects.filter(id__in=missing_ids).values_list(
+                    "id", "document_id"
+                )
+            )
+            nodes.loc[missing, "document_id"] = [
+                document_ids.get(node_id, -1) for node_id in missing_ids
+            ]
+        nodes["document_id"] = nodes.document_id.astype(np.int64)
+        nodes["row"] = np.arange(self.n)
+        return nodes
+
+    def row_for_id(self, node_id):
+        """
+        Return the matrix row that corresponds to the StandardNode `node_id`.
+        """
+        return int(self.nodes.row.loc[node_id])
+
+    def rows_for_ids(self, node_ids):
+        """
+        Vectorized `row_for_id`: returns the rows for the array `node_ids`,
+        with -1 for the ids that are not part of this model.
+        """
+        if self._id_index is None:
+            self._id_index = pd.Index(self.node_id_lookup)
+        return self._id_index.get_indexer(np.asarray(node_ids))
+
+    @property
+    def document_ids(self):
+        """
+        Array of `document_id`s aligned with the matrix rows.
+        """
+        if self._document_ids is None:
+            document_ids = np.zeros(self.n, dtype=np.int64)
+            document_ids[self.nodes.row.values] = self.nodes.document_id.values
+            self._document_ids = document_ids
+        return self._document_ids
+
+    def document_mask(self, document_id):
+        """
+        Boolean column mask selecting the nodes that belong to `document_id`.
+        Masks are computed once per document and shared between requests, so
+        callers must not modify them.
+        """
+        mask = self._document_masks.get(document_id)
+        if mask is None:
+            mask = self.document_ids == document_id
+            mask.flags.writeable = False
+            self._document_masks[document_id] = mask
+        return mask
+
+    @property
+    def ann_index(self):
+        """
+        The optional `IVFIndex` built offline by `manage.py buildannindex`, or
+        None when the model directory doesn't have one, or has one that was
+        built from other embeddings (searches then fall back to exact search).
+        """
+        if self._ann_index is None:
+            annpath = os.path.join(self.path, ANN_INDEX_FILENAME)
+            if self.embeddings is None or not os.path.exists(annpath):
+                return None
+            index = IVFIndex.load(annpath)
+            embeddingspath = os.path.join(self.path, EMBEDDINGS_FILENAME)
+            if not index.matches(embeddingspath, self.n):
+                print("Ignoring stale {} of model {}".format(annpath, self.name))
+                index = False
+            self._ann_index = index
+        return self._ann_index or None
+
+    @property
+    def candidate_index(self):
+        """
+        The `CandidateIndex` of the nodes of the model, built with one query the
+        first time the scheduler needs it, and then kept with the model until
+        the nodes change (checked at most every CANDIDATE_INDEX_CHECK_INTERVAL s).
+        """
+        index = self._candidate_index
+        now = time.monotonic()
+        checked = self._candidate_index_checked
+        if index is None or now - checked > CANDIDATE_INDEX_CHECK_INTERVAL:
+            if index is None or index.watermark != get_nodes_watermark():
+                index = CandidateIndex.build(self)
+                self._candidate_index = index
+            self._candidate_index_checked = now
+        return index
+
+    @property
+    def embeddings32(self):
+        """
+        The memory-mapped embeddings, float32 for all the models published since
+        `convert_embeddings_to_float32`. Older float64 files are used as they
+        are (slower matmuls) rather than copied into every process.
+        """
+        return self.embeddings
+
+    def embedding_relevances(self, rows):
+        """
+        Compute the relevances between `rows` (an int or an array of ints) and
+        all nodes as inner products of the embeddings, with a float32 matmul.
+        Memory use is O(len(rows) * N) instead of the O(N^2) of a full matrix.
+        """
+        embeddings = self.embeddings32
+        return np.dot(embeddings[rows], embeddings.T)
+
+    def relevance_rows(self, rows):
+        """
+        Return a writable float64 block with the relevances between `rows` and
+        all nodes, read from the relevance matrix when the model has one, and
+        computed from the embeddings otherwise.
+        """
+        if self.relevance_matrix is not None:
+            return np.array(self.relevance_matrix[rows, :], dtype=np.float64)
+        return self.embedding_relevances(rows).astype(np.float64)
+
+    def relevances_to(self, i, columns):
+        """
+        Return the float64 relevances between row `i` and the rows `columns`,
+        the same values as `relevance_row(i)[columns]`.
+        """
+        if self.relevance_matrix is not None:
+            return np.array(self.relevance_matrix[i, columns], dtype=np.float64)
+        embeddings = self.embeddings32
+        return np.dot(embeddings[columns], embeddings[i]).astype(np.float64)
+
+    def relevance_row(self, i):
+        """
+        Return a writable copy of the relevances between row `i` and all nodes.
+        """
+        return self.relevance_rows(i)
+
+    def relevance(self, i, j):
+        if self.relevance_matrix is not None:
+            return float(self.relevance_matrix[i, j])
+        embeddings = self.embeddings32
+        return float(np.dot(embeddings[i], embeddings[j]))
+
+    def __repr__(self):
+        return "<LoadedModel {} n={}>".format(self.name, self.n)
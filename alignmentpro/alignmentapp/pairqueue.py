@@ -0,0 +1,177 @@
+##################################################
+# MIT License
+#
+# Copyright (c) 2019 Learning Equality
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+##################################################
+
+"""
+Per-user queues of pairs sampled ahead of time by the random scheduler, so that
+serving a pair is a single indexed query. Queues are stored as `ScheduledPair`
+rows, and are refilled in a background thread when they get short. Only the
+scheduler parameters that stay the same from one request to the next are
+queued: requests for the subtree of a given node are sampled right away.
+"""
+
+import json
+import threading
+import traceback
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import ScheduledPair, StandardNode
+from .schedulers import prob_weighted_random_pairs
+
+
+QUEUE_DEPTH = 20  # number of pairs to keep queued per user and parameters
+QUEUE_REFILL_THRESHOLD = 5  # refill in the background below this many pairs
+QUEUE_MAX_AGE = timedelta(hours=1)  # older pairs may come from an older model
+
+# scheduler parameters that change with every judgment (the frontend passes the
+# node that was just judged as `left_root_id`), so queues for them never get hit
+UNQUEUED_PARAMS = ["left_root_id", "right_root_id"]
+
+_refilling = set()
+_refilling_lock = threading.Lock()
+
+
+def is_queueable(params):
+    """
+    Whether pairs for the scheduler `params` are served from the queues.
+    """
+    return all(params.get(name) is None for name in UNQUEUED_PARAMS)
+
+
+def get_queue(user_id, params):
+    """
+    The fresh pairs queued for `user_id` with the scheduler `params`.
+    """
+    fresh = timezone.now() - QUEUE_MAX_AGE
+    return ScheduledPair.objects.filter(
+        user_id=user_id, params=params, created__gte=fresh
+    )
+
+
+def pop_pair(user_id, params):
+    """
+    Remove and return the first pair in the queue of `user_id` for the scheduler
+    `params`, refilling the queue in the background when it gets short. When the
+    queue is empty, a batch is sampled right away. Returns None if the scheduler
+    has no pairs to offer.
+    """
+    pair = _pop_first(user_id, params)
+    if pair is None:
+        if not refill_queue(user_id, params):
+            return None
+        pair = _pop_first(user_id, params)
+    if get_queue(user_id, params).count() < QUEUE_REFILL_THRESHOLD:
+        request_refill(user_id, params)
+    return pair
+
+
+def _pop_first(user_id, params):
+    with transaction.atomic():
+        queue = get_queue(user_id, params).select_for_update(skip_locked=True)
+        pair = queue.order_by("id").first()
+        if pair is not None:
+            ScheduledPair.objects.filter(id=pair.id).delete()
+    return pair
+
+
+def refill_queue(user_id, params):
+    """
+    Sample enough pairs to fill the queue of `user_id` for the scheduler `params`
+    up to `QUEUE_DEPTH`, in one batch. The stale pairs of the user, and the pairs
+    queued for other parameters, are dropped, and pairs that are already queued
+    are not queued again. Returns the number of pairs added.
+    Concurrent refills for the same user (from other requests, threads or
+    processes) are serialized with a lock on the user row.
+    """
+    with transaction.atomic():
+        User.objects.select_for_update().filter(id=user_id).first()
+        return _refill_locked_queue(user_id, params)
+
+
+def _refill_locked_queue(user_id, params):
+    fresh = timezone.now() - QUEUE_MAX_AGE
+    ScheduledPair.objects.filter(user_id=user_id).filter(
+        Q(created__lt=fresh) | ~Q(params=params)
+    ).delete()
+    queued = {
+        frozenset(node_ids)
+        for node_ids in get_queue(user_id, params).values_list("node1_id", "node2_id")
+    }
+    needed = QUEUE_DEPTH - len(queued)
+    if needed <= 0:
+        return 0
+    pairs, _ = prob_weighted_random_pairs(StandardNode.objects.all(), needed, **params)
+    new_pairs = []
+    for pair in pairs:
+        node_ids = frozenset([pair["left_id"], pair["right_id"]])
+        if node_ids in queued:
+            continue
+        queued.add(node_ids)
+        new_pairs.append(
+            ScheduledPair(
+                user_id=user_id,
+                node1_id=pair["left_id"],
+                node2_id=pair["right_id"],
+                relevance=pair["relevance"],
+                probability=pair["probability"],
+                params=params,
+            )
+        )
+    # the unique constraint on (user, node1, node2) is the last line of defence
+    ScheduledPair.objects.bulk_create(new_pairs, ignore_conflicts=True)
+    return len(new_pairs)
+
+
+def request_refill(user_id, params):
+    """
+    Refill the queue in a background thread, unless this process is already
+    refilling it.
+    """
+    key = (user_id, json.dumps(params, sort_keys=True))
+    with _refilling_lock:
+        if key in _refilling:
+            return
+        _refilling.add(key)
+    thread = threading.Thread(
+        target=_refill_in_background, args=(key, user_id, params), daemon=True
+    )
+    thread.start()
+
+
+def _refill_in_background(key, user_id, params):
+    try:
+        refill_queue(user_id, params)
+    except Exception:
+        print("Error refilling the pair queue of user", user_id)
+        traceback.print_exc()
+    finally:
+        # the thread got its own database connection, which Django won't close
+        connection.close()
+        with _refilling_lock:
+            _refilling.discard(key)
@@ -24,48 +24,105 @@
 ##################################################
 
 from datetime import datetime
-import os
 import numpy as np
-import pandas as pd
-import random
-
-from django.conf import settings
 
+from .annindex import DEFAULT_NPROBE
+from .hydration import hydrate_nodes
 from .models import CurriculumDocument, StandardNode, HumanRelevanceJudgment
+from .modelstore import get_model
 
 
-def recommend_top_ranked(queryset, target_node, threshold, count, model="baseline"):
-    """
-    """
-
-    modeldirpath = os.path.join(settings.MODELS_BASE_DIR, model)
-
-    # load the index
-    node_id_lookup = np.load(os.path.join(modeldirpath, "index.npy"))
-
-    # load the matrix
-    relevance_matrix = np.load(os.path.join(modeldirpath, "relevance.npy"))
-
-    # load the pickled DataFrame of nodes
-    nodes = pd.read_pickle(os.path.join(modeldirpath, "nodes.pk"))
-
-    # sanity checks
-    n = len(node_id_lookup)
-    assert relevance_matrix.shape[0] == n, "relevance_matrix has wrong shape"
-    assert relevance_matrix.shape[1] == n, "relevance_matrix has wrong shape"
-
-    relevances = relevance_matrix[nodes.loc[target_node.id].row, :].flatten()
+ENGINES = ["exact", "ann"]
 
-    nodes.insert(1, "relevance", relevances)
 
-    nodes.relevance[nodes.document_id == target_node.document_id] = 0
-
-    ranked_nodes = nodes.sort_values(by="relevance", ascending=False, inplace=False)
+def recommend_top_ranked(
+    queryset, target_node, threshold, count, model="baseline", engine="exact"
+):
+    """
+    Return the relevances and the nodes from other documents that the model
+    `model` ranks as most relevant to `target_node`. Use `engine="ann"` to
+    search the model's approximate nearest-neighbour index instead of scoring
+    all nodes; models without an ANN index fall back to the exact search.
+    """
+    assert engine in ENGINES, "Unknown recommendation engine " + engine
+    model = get_model(model)
+
+    if engine == "ann" and model.ann_index is not None:
+        search = top_k_ann
+    else:
+        search = top_k
+    ids, scores = search(
+        model,
+        model.row_for_id(target_node.id),
+        exclude_document_id=target_node.document_id,
+        threshold=threshold,
+        count=count,
+    )
+
+    # nodes deleted since the model was trained are skipped by hydrate_nodes, so
+    # the scores are matched to the nodes that were actually found
+    nodes = hydrate_nodes(queryset, ids)
+    scores_by_id = dict(zip(ids.tolist(), scores.tolist()))
+    return [scores_by_id[node.id] for node in nodes], nodes
+
+
+def top_k(model, row, exclude_document_id=None, threshold=None, count=None):
+    """
+    Find the `count` columns with the highest relevance in `row` of `model`.
+    Columns from the document `exclude_document_id` are skipped, and if
+    `threshold` is given only relevances above it are kept. Returns the arrays
+    `(ids, scores)` sorted by decreasing relevance.
+    """
+    relevances = model.relevance_row(row)
+    if exclude_document_id is not None:
+        relevances[model.document_mask(exclude_document_id)] = -np.inf
 
     if threshold:
-        ranked_nodes = ranked_nodes[ranked_nodes.relevance > float(threshold)]
-
-    if count:
-        ranked_nodes = ranked_nodes[:count]
+        candidates = np.flatnonzero(relevances > float(threshold))
+    else:
+        candidates = np.flatnonzero(relevances > -np.inf)
+    candidate_scores = relevances[candidates]
+
+    # partial selection is O(N), then only the top `count` get sorted
+    if count and int(count) < len(candidates):
+        count = int(count)
+        top = np.argpartition(-candidate_scores, count - 1)[:count]
+        candidates = candidates[top]
+        candidate_scores = candidate_scores[top]
+
+    order = np.argsort(-candidate_scores, kind="stable")
+    rows = candidates[order]
+    return model.node_id_lookup[rows], candidate_scores[order]
+
+
+def top_k_ann(
+    model, row, exclude_document_id=None, threshold=None, count=None, nprobe=None
+):
+    """
+    Approximate version of `top_k` that only scores the candidate rows returned
+    by the model's ANN index for the embedding of `row`. The candidates are
+    scored like `top_k` does (from the relevance matrix when the model has one).
+    """
+    embeddings = model.embeddings32
+    candidates = model.ann_index.candidates(
+        embeddings[row], nprobe=nprobe or DEFAULT_NPROBE
+    )
+    if exclude_document_id is not None:
+        document_mask = model.document_mask(exclude_document_id)
+        candidates = candidates[~document_mask[candidates]]
+    candidate_scores = model.relevances_to(row, candidates)
 
-    return ranked_nodes.relevance, [queryset.get(id=i) for i in ranked_nodes.index]
+    if threshold:
+        keep = candidate_scores > float(threshold)
+        candidates = candidates[keep]
+        candidate_scores = candidate_scores[keep]
+
+    if count and int(count) < len(candidates):
+        count = int(count)
+        top = np.argpartition(-candidate_scores, count - 1)[:count]
+        candidates = candidates[top]
+        candidate_scores = candidate_scores[top]
+
+    order = np.argsort(-candidate_scores, kind="stable")
+    rows = candidates[order]
+    return model.node_id_lookup[rows], candidate_scores[order]
@@ -23,15 +23,22 @@
 #
 ##################################################
 
+from collections import OrderedDict
 from datetime import datetime
-import os
 import numpy as np
-import pandas as pd
 import random
+import threading
 
-from django.conf import settings
-
+from .judgedpairs import get_judged_pairs
 from .models import CurriculumDocument, StandardNode, HumanRelevanceJudgment
+from .modelstore import get_model
+
+
+MAX_LEFT_ATTEMPTS = 10
+
+
+class NoCandidatesError(ValueError):
+    pass
 
 
 def prob_weighted_random(
@@ -42,80 +49,297 @@ def prob_weighted_random(
     right_root_id=None,
     allow_same_doc=False,
     include_nonleaf_nodes=False,
+    exclude_judged_by=None,
+    max_judgments=None,
 ):
     """
     Chooses a random row (uniform random) from all the possible ones,
     then chooses a weighted random column based on the probability and the
     relevance-favoritism factor `gamma`.
+    The candidates are filtered with the model's `CandidateIndex`, so the only
+    queries are for the chosen nodes (and for root nodes missing from the model).
+    Pairs judged by the user `exclude_judged_by`, or judged at least
+    `max_judgments` times, are not offered (see `judgedpairs`).
     """
 
-    modeldirpath = os.path.join(settings.MODELS_BASE_DIR, model_name)
+    model = get_model(model_name)
+    index = model.candidate_index
+    left_root_path = get_root_path(model, queryset, left_root_id)
+    left_mask = index.candidates_mask(include_nonleaf_nodes, left_root_path)
+    left_index = np.flatnonzero(left_mask)
+    judged = get_judged_pairs() if exclude_judged_by or max_judgments else None
+
+    # left-hand nodes whose right-hand candidates were all judged are retried
+    for _ in range(MAX_LEFT_ATTEMPTS):
+        ir = int(random.choice(left_index))  # choose a random row for the left side
+        try:
+            return _sample_right(
+                queryset,
+                model,
+                ir,
+                gamma,
+                right_root_id,
+                allow_same_doc,
+                include_nonleaf_nodes,
+                get_judged_rows(model, judged, ir, exclude_judged_by, max_judgments),
+            )
+        except NoCandidatesError:
+            continue
+    raise NoCandidatesError("No pairs left to choose from")
 
-    # load the index
-    node_id_lookup = np.load(os.path.join(modeldirpath, "index.npy"))
 
-    # load the matrix
-    relevance_matrix = np.load(os.path.join(modeldirpath, "relevance.npy"))
+def _sample_right(
+    queryset,
+    model,
+    ir,
+    gamma,
+    right_root_id,
+    allow_same_doc,
+    include_nonleaf_nodes,
+    judged_rows,
+):
+    """
+    Choose the right-hand node for the left-hand row `ir` of `model`, excluding
+    the `judged_rows`, and return the result of `prob_weighted_random`.
+    """
+    node_id_lookup = model.node_id_lookup
+    index = model.candidate_index
+    leftid = node_id_lookup[ir]
 
-    # load the pickled DataFrame of nodes
-    nodes = pd.read_pickle(os.path.join(modeldirpath, "nodes.pk"))
+    # the distribution for choosing the right-hand node only depends on the
+    # left-hand row and the filters, so it is computed once and cached
+    right_root_path = get_root_path(model, queryset, right_root_id)
+    key = (
+        model.name,
+        model.signature,
+        index.watermark,
+        ir,
+        gamma,
+        include_nonleaf_nodes,
+        right_root_path,
+        allow_same_doc,
+    )
 
-    # sanity checks
-    n = len(node_id_lookup)
-    assert relevance_matrix.shape[0] == n, "relevance_matrix has wrong shape"
-    assert relevance_matrix.shape[1] == n, "relevance_matrix has wrong shape"
+    def get_weights():
+        # filter down the right-hand side candidates
+        right_mask = index.candidates_mask(include_nonleaf_nodes, right_root_path)
+        if not allow_same_doc:
+            right_mask &= index.document_ids != index.document_ids[ir]
 
-    queryset = queryset.filter(id__in=node_id_lookup)
-    left_queryset = queryset
-    right_queryset = queryset
+        rowi = model.relevance_row(ir)  # select row
+        rowi[~right_mask] = 0  # exclude the columns that are not candidates
+        rowi[rowi < 0] = 0  # ignore any with negative values
+        rowi[rowi > 0.999] = 0  # ignore any that are virtually identical
 
-    if not include_nonleaf_nodes:
-        left_queryset = left_queryset.filter(numchild=0)
-        right_queryset = right_queryset.filter(numchild=0)
+        # skew the distribution by gamma exponent
+        weights = rowi ** gamma
+        if not np.sum(weights) > 0:
+            weights = rowi
+        return weights
 
-    # filter down and choose a random left-hand side node
-    if left_root_id is not None:
-        left_ancestor_root = queryset.get(id=left_root_id)
-        left_queryset = left_queryset.filter(path__startswith=left_ancestor_root.path)
-    left_index = nodes.row.loc[left_queryset.values_list("id", flat=True)]
+    sampler = get_row_sampler(key, get_weights)
+    jr, probability = sampler.sample(excluded_columns=judged_rows)
+    rightid = node_id_lookup[jr]
 
-    ir = random.choice(list(left_index))  # choose a random row index for the left side
-    leftid = node_id_lookup[ir]
-    leftnode = queryset.get(id=leftid)
+    return (
+        model.relevance(ir, jr),
+        probability,
+        sampler.top_probabilities,
+        queryset.filter(id__in=[leftid, rightid]),
+    )
+
+
+MAX_PAIRS = 100
+
+
+def prob_weighted_random_pairs(
+    queryset,
+    num_pairs,
+    model_name="baseline",
+    gamma=3.0,
+    left_root_id=None,
+    right_root_id=None,
+    allow_same_doc=False,
+    include_nonleaf_nodes=False,
+    exclude_judged_by=None,
+    max_judgments=None,
+):
+    """
+    Batch version of `prob_weighted_random`: samples `num_pairs` distinct
+    left-hand rows and then one right-hand column for each of them, in one
+    vectorized pass over the `num_pairs` x N block of relevances.
+    Returns the pairs, as dicts with the `left_id`, `right_id`, `relevance` and
+    `probability` of each pair, and the queryset of all the nodes in the pairs.
+    Left-hand nodes without any right-hand candidate are skipped, so there can
+    be fewer than `num_pairs` pairs.
+    """
+    model = get_model(model_name)
+    node_id_lookup = model.node_id_lookup
+    index = model.candidate_index
+    left_index, right_mask = get_candidates(
+        model, queryset, left_root_id, right_root_id, include_nonleaf_nodes
+    )
+    # distinct left-hand rows, so that a batch doesn't repeat pairs
+    num_rows = min(num_pairs, MAX_PAIRS, len(left_index))
+    left_rows = np.random.choice(left_index, size=num_rows, replace=False)
 
-    # filter down the right-hand side queryset
+    block = model.relevance_rows(left_rows)
+    block[:, ~right_mask] = 0
     if not allow_same_doc:
-        right_queryset = right_queryset.exclude(document_id=leftnode.document_id)
-    if right_root_id is not None:
-        right_ancestor_root = queryset.get(id=right_root_id)
-        right_queryset = right_queryset.filter(
-            path__startswith=right_ancestor_root.path
-        )
-    right_index = nodes.row.loc[right_queryset.values_list("id", flat=True)]
+        left_document_ids = index.document_ids[left_rows]
+        block[left_document_ids[:, None] == index.document_ids[None, :]] = 0
+    block[block < 0] = 0  # ignore any with negative values
+    block[block > 0.999] = 0  # ignore any that are virtually identical
+    if exclude_judged_by or max_judgments:
+        judged = get_judged_pairs()
+        for k, ir in enumerate(left_rows):
+            judged_rows = get_judged_rows(
+                model, judged, ir, exclude_judged_by, max_judgments
+            )
+            block[k, judged_rows] = 0
 
-    # build a probability distribution for choosing the right-hand node
-    rowi = relevance_matrix[ir, :].flatten()  # select row
+    # skew each row by gamma, falling back to the plain relevances like above
+    weights = block ** gamma
+    no_weight = ~(weights.sum(axis=1) > 0)
+    weights[no_weight] = block[no_weight]
+    totals = weights.sum(axis=1)
+    sampled = totals > 0
+    left_rows = left_rows[sampled]
+    probabilities = weights[sampled] / totals[sampled, None]
 
-    # exclude right-hand side columns based on the queryset
-    columns_to_include = np.indices(rowi.shape)
-    columns_to_exclude = np.setxor1d(columns_to_include, right_index)
-    rowi[columns_to_exclude] = 0
+    # inverse transform sampling of one column per row, among the columns with a
+    # positive probability (scaling by the last cumulative sum, so that rounding
+    # can never pick a column past the last candidate)
+    right_rows = np.empty(len(left_rows), dtype=np.int64)
+    for k, uniform in enumerate(np.random.random_sample(len(left_rows))):
+        columns = np.flatnonzero(probabilities[k] > 0)
+        cdf = np.cumsum(probabilities[k, columns])
+        i = np.searchsorted(cdf, uniform * cdf[-1], side="right")
+        right_rows[k] = columns[min(i, len(columns) - 1)]
 
-    rowi[rowi < 0] = 0  # ignore any with negative values
-    rowi[rowi > 0.999] = 0  # ignore any that are virtually identical
+    pairs = []
+    for k, (ir, jr) in enumerate(zip(left_rows, right_rows)):
+        pairs.append(
+            {
+                "left_id": int(node_id_lookup[ir]),
+                "right_id": int(node_id_lookup[jr]),
+                "relevance": model.relevance(ir, jr),
+                "probability": float(probabilities[k, jr]),
+            }
+        )
+    node_ids = {p["left_id"] for p in pairs} | {p["right_id"] for p in pairs}
+    return pairs, queryset.filter(id__in=node_ids)
 
-    # skew the distribution by gamma exponent, normalize, and select a weighted random item
-    rowi_asp = rowi ** gamma / sum(rowi ** gamma)
-    rowi_asp[np.isnan(rowi_asp)] = 0
-    if sum(rowi_asp) == 0:
-        rowi_asp = rowi
-    jr = np.random.choice(n, p=rowi_asp)
-    rightid = node_id_lookup[jr]
-    rightnode = queryset.get(id=rightid)
 
-    return (
-        relevance_matrix[ir, jr],
-        rowi_asp[jr],
-        list(reversed(sorted(rowi_asp[rowi_asp > 0.001])))[:20],
-        queryset.filter(id__in=[leftid, rightid]),
+def get_candidates(model, queryset, left_root_id, right_root_id, include_nonleaf_nodes):
+    """
+    The array of left-hand candidate rows and the mask of right-hand candidate
+    columns (before excluding the left-hand node's document).
+    """
+    index = model.candidate_index
+    left_root_path = get_root_path(model, queryset, left_root_id)
+    left_mask = index.candidates_mask(include_nonleaf_nodes, left_root_path)
+    right_root_path = get_root_path(model, queryset, right_root_id)
+    right_mask = index.candidates_mask(include_nonleaf_nodes, right_root_path)
+    return np.flatnonzero(left_mask), right_mask
+
+
+def get_judged_rows(model, judged, row, user_id, max_judgments):
+    """
+    The rows of the nodes that `judged` (a `JudgedPairs` or None) has as judged
+    with the node at `row`.
+    """
+    if judged is None:
+        return np.array([], dtype=np.int64)
+    node_ids = judged.judged_with(
+        int(model.node_id_lookup[row]), user_id=user_id, max_judgments=max_judgments
     )
+    rows = model.rows_for_ids(list(node_ids))
+    return rows[rows >= 0]
+
+
+def get_root_path(model, queryset, root_id):
+    """
+    The path of the node `root_id` (None if `root_id` is None), read from the
+    candidate index when the node is part of the model.
+    """
+    if root_id is None:
+        return None
+    row = model.rows_for_ids([root_id])[0]
+    index = model.candidate_index
+    if row >= 0 and index.exists[row]:
+        return str(index.paths[row])
+    return queryset.get(id=root_id).path
+
+
+# CACHED ROW SAMPLERS
+################################################################################
+
+ROW_SAMPLER_CACHE_SIZE = 64
+TOP_PROBABILITIES = 20
+EPSILON = 1e-12
+
+_row_samplers = OrderedDict()
+_row_samplers_lock = threading.Lock()
+
+
+class RowSampler(object):
+    """
+    Samples columns with probabilities proportional to `weights`, by binary
+    search in the cumulative sums of the positive weights.
+    """
+
+    def __init__(self, weights):
+        self.columns = np.flatnonzero(weights > 0)
+        if len(self.columns) == 0:
+            raise NoCandidatesError("No right-hand side candidates to choose from")
+        probabilities = weights[self.columns] / np.sum(weights[self.columns])
+        self.cdf = np.cumsum(probabilities)
+        # the largest probabilities (above 0.001), in decreasing order
+        top = probabilities[probabilities > 0.001]
+        if len(top) > TOP_PROBABILITIES:
+            top = np.partition(top, len(top) - TOP_PROBABILITIES)[-TOP_PROBABILITIES:]
+        self.top_probabilities = np.sort(top)[::-1].tolist()
+
+    def sample(self, excluded_columns=()):
+        """
+        Return a random column and its probability, never choosing any of the
+        `excluded_columns`: a uniform number is drawn from the total probability
+        that is left, and then shifted past the intervals of the excluded columns
+        in the cumulative sums, in O(len(excluded_columns) + log N).
+        """
+        excluded = np.unique(np.searchsorted(self.columns, excluded_columns))
+        excluded = excluded[excluded < len(self.columns)]
+        excluded = excluded[np.isin(self.columns[excluded], excluded_columns)]
+        starts = np.where(excluded > 0, self.cdf[excluded - 1], 0.0)
+        widths = self.cdf[excluded] - starts
+        total = self.cdf[-1] - np.sum(widths)
+        if not total > EPSILON:
+            raise NoCandidatesError("All the right-hand side candidates are excluded")
+
+        u = np.random.random_sample() * total
+        for start, width in zip(starts, widths):
+            if u < start:
+                break
+            u += width
+        k = min(np.searchsorted(self.cdf, u, side="right"), len(self.cdf) - 1)
+        probability = self.cdf[k] - (self.cdf[k - 1] if k else 0.0)
+        return int(self.columns[k]), float(probability / total)
+
+
+def get_row_sampler(key, get_weights):
+    """
+    The `RowSampler` for `key`, built from `get_weights()` if it is not in the
+    least recently used cache of the last `ROW_SAMPLER_CACHE_SIZE` samplers.
+    """
+    with _row_samplers_lock:
+        sampler = _row_samplers.get(key)
+        if sampler is not None:
+            _row_samplers.move_to_end(key)
+            return sampler
+    sampler = RowSampler(get_weights())
+    with _row_samplers_lock:
+        _row_samplers[key] = sampler
+        while len(_row_samplers) > ROW_SAMPLER_CACHE_SIZE:
+            _row_samplers.popitem(last=False)
+    return sampler
@@ -0,0 +1,82 @@
+##################################################
+# MIT License
+#
+# Copyright (c) 2019 Learning Equality
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+##################################################
+
+import hashlib
+
+from django.db.models import BooleanField
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+
+from .models import Parameter
+
+
+# Judgments are assigned to the test set based on a hash of their (unordered)
+# node pair, so all the judgments about the same pair land in the same split
+# and the split doesn't depend on the order in which judgments arrive.
+# The first 7 hex digits (28 bits) of md5("<min id>:<max id>") as a fraction:
+HASH_BITS = 28
+
+PAIR_HASH_FRACTION_SQL = (
+    "(('x' || substr(md5(LEAST(node1_id, node2_id)::text || ':' || "
+    "GREATEST(node1_id, node2_id)::text), 1, 7))::bit(28)::int / 268435456.0)"
+)
+
+
+def get_test_size():
+    """
+    The proportion of human judgments to set aside for testing, from the
+    `test_size` Parameter.
+    """
+    return float(Parameter.objects.get(key="test_size").value)
+
+
+def pair_hash_fraction(node1_id, node2_id):
+    """
+    Stable pseudo-random number in [0, 1) for the unordered pair of nodes.
+    Computes the same value as `PAIR_HASH_FRACTION_SQL`.
+    """
+    key = "{}:{}".format(min(node1_id, node2_id), max(node1_id, node2_id))
+    digest = hashlib.md5(key.encode("utf-8")).hexdigest()
+    return int(digest[: HASH_BITS // 4], 16) / 2 ** HASH_BITS
+
+
+def is_test_pair(node1_id, node2_id, test_size):
+    return pair_hash_fraction(node1_id, node2_id) < test_size
+
+
+def assign_test_data(judgments, test_size=None):
+    """
+    Set `is_test_data` on the `judgments` that don't have it yet, with a single
+    set-based UPDATE that hashes the node pairs in the database.
+    Returns the number of judgments updated.
+    """
+    if test_size is None:
+        test_size = get_test_size()
+    is_test_data = RawSQL(
+        PAIR_HASH_FRACTION_SQL + " < %s", (test_size,), output_field=BooleanField()
+    )
+    return judgments.filter(is_test_data=None).update(
+        is_test_data=is_test_data, modified=timezone.now()
+    )
@@ -23,6 +23,421 @@
 #
 ##################################################
 
-from django.test import TestCase
+import os
+import shutil
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+
+from alignmentapp import judgedpairs
+from alignmentapp.columnar import frame_to_rowdicts
+from alignmentapp.compaction import compact_exports, read_export_table
+from alignmentapp.exporting import export_data
+from alignmentapp.judgedpairs import JudgedPairs
+from alignmentapp.models import CurriculumDocument, DataExport, ScheduledPair
+from alignmentapp.models import HumanRelevanceJudgment, StandardNode, Tombstone
+from alignmentapp.models import UserProfile
+from alignmentapp.modelstore import DIRTY_FILENAME, EMBEDDINGS_FILENAME
+from alignmentapp.modelstore import INDEX_FILENAME, NODES_FILENAME
+from alignmentapp.modelstore import clear_models, convert_embeddings_to_float32
+from alignmentapp.modelstore import get_model
+from alignmentapp.pairqueue import get_queue, pop_pair, refill_queue
+from alignmentapp.recommenders import top_k
+from alignmentapp.schedulers import prob_weighted_random
+from alignmentapp.schedulers import prob_weighted_random_pairs
+from importing.bulkloader import bulk_load_tree
+
+# DATA EXPORTS
+################################################################################
+
+
+def make_tree():
+    # identifiers that change when parsed as numbers
+    return dict(
+        title="Doc",
+        children=[
+            dict(
+                identifier="01",
+                title="Numbers",
+                children=[
+                    dict(identifier="1.1", title="Counting"),
+                    dict(identifier="1.10", title="Addition"),
+                ],
+            ),
+            dict(identifier="NA", title="Shapes"),
+        ],
+    )
+
+
+class DeltaExportTestCase(TestCase):
+    def setUp(self):
+        self.export_base_dir = tempfile.mkdtemp()
+        self.override = override_settings(DATA_EXPORT_BASE_DIR=self.export_base_dir)
+        self.override.enable()
+        self.user = User.objects.create(username="judge")
+        UserProfile.objects.create(user=self.user, background="other")
+        self.document = CurriculumDocument.objects.create(
+            source_id="deltaexport",
+            title="Doc",
+            country="Kenya",
+            digitization_method="manual_entry",
+            is_draft=False,
+        )
+        bulk_load_tree(make_tree(), self.document)
+        self.add_judgment("1.1", "NA")
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.export_base_dir)
+
+    def get_node(self, identifier):
+        return StandardNode.objects.get(document=self.document, identifier=identifier)
+
+    def add_judgment(self, identifier1, identifier2):
+        return HumanRelevanceJudgment.objects.create(
+            node1=self.get_node(identifier1),
+            node2=self.get_node(identifier2),
+            rating=1.0,
+            confidence=0.5,
+            mode="manual",
+            ui_name="test",
+            ui_version_hash="test",
+            user=self.user,
+        )
+
+    def export(self, delta):
+        # export dirs are named by the minute, so give each its own dir
+        exportdirname = export_data(includetestdata=True, delta=delta)
+        renamed = "{}-{}".format(exportdirname, DataExport.objects.count())
+        os.rename(
+            os.path.join(self.export_base_dir, exportdirname),
+            os.path.join(self.export_base_dir, renamed),
+        )
+        DataExport.objects.filter(exportdirname=exportdirname).update(
+            exportdirname=renamed
+        )
+        return renamed
+
+    def read_rows(self, exportdirname, filename):
+        exportpath = os.path.join(self.export_base_dir, exportdirname)
+        df = read_export_table(exportpath, filename)
+        return list(frame_to_rowdicts(df)) if df is not None else []
+
+    def assertSnapshotMatchesDatabase(self, exportdirname):
+        nodes = self.read_rows(exportdirname, settings.STANDARD_NODES_FILENAME)
+        self.assertEqual(
+            sorted((row["id"], row["identifier"], row["title"]) for row in nodes),
+            sorted(
+                StandardNode.objects.filter(document=self.document).values_list(
+                    "id", "identifier", "title"
+                )
+            ),
+        )
+        judgments = self.read_rows(
+            exportdirname, settings.HUMAN_JUDGMENTS_FILENAME
+        ) + self.read_rows(exportdirname, settings.HUMAN_JUDGMENTS_TEST_FILENAME)
+        self.assertEqual(
+            sorted((row["id"], row["node1_id"], row["node2_id"]) for row in judgments),
+            sorted(
+                HumanRelevanceJudgment.objects.values_list("id", "node1_id", "node2_id")
+            ),
+        )
+
+    def test_compacted_deltas_match_full_export(self):
+        self.assertSnapshotMatchesDatabase(self.export(delta=False))
+
+        node = self.get_node("1.10")
+        node.title = "Addition and subtraction"
+        node.save()
+        self.add_judgment("01", "1.10")
+        delta1 = self.export(delta=True)
+        self.assertEqual(DataExport.objects.get(exportdirname=delta1).kind, "delta")
+
+        judgment = HumanRelevanceJudgment.objects.get(node2=self.get_node("NA"))
+        Tombstone.bury(HumanRelevanceJudgment, [judgment.id])
+        judgment.delete()
+        self.export(delta=True)
+
+        self.assertSnapshotMatchesDatabase(compact_exports())
+
+    def test_deleted_nodes_reexport_their_document(self):
+        self.export(delta=False)
+
+        for identifier in ["1.1", "1.10"]:
+            node = self.get_node(identifier)
+            Tombstone.bury_nodes(StandardNode.get_tree(node))
+            node.delete()
+        delta = self.export(delta=True)
+        nodes = self.read_rows(delta, settings.STANDARD_NODES_FILENAME)
+        self.assertEqual({row["identifier"] for row in nodes}, {"", "01", "NA"})
+
+        snapshot = compact_exports()
+        self.assertSnapshotMatchesDatabase(snapshot)
+        nodes = self.read_rows(snapshot, settings.STANDARD_NODES_FILENAME)
+        parent = [row for row in nodes if row["identifier"] == "01"][0]
+        self.assertEqual(parent["dist_from_leaf"], 0)
+
+
+# MODELS
+################################################################################
+
+
+def save_array(path, array):
+    # a new file and a rename, like the published artifacts (see `LoadedModel`)
+    tmppath = path + ".tmp.npy"
+    np.save(tmppath, array)
+    os.replace(tmppath, path)
+
+
+def write_model(modeldirpath, node_ids, document_ids, embeddings):
+    if not os.path.exists(modeldirpath):
+        os.makedirs(modeldirpath)
+    save_array(os.path.join(modeldirpath, INDEX_FILENAME), np.array(node_ids))
+    save_array(os.path.join(modeldirpath, EMBEDDINGS_FILENAME), embeddings)
+    nodes = pd.DataFrame(
+        {"document_id": document_ids, "row": np.arange(len(node_ids))},
+        index=pd.Index(node_ids),
+    )
+    nodes.to_pickle(os.path.join(modeldirpath, NODES_FILENAME))
+
+
+class ModelTestCase(TestCase):
+    def setUp(self):
+        self.models_base_dir = tempfile.mkdtemp()
+        self.override = override_settings(MODELS_BASE_DIR=self.models_base_dir)
+        self.override.enable()
+        self.model_path = os.path.join(self.models_base_dir, "baseline")
+        clear_models()
+
+    def tearDown(self):
+        clear_models()
+        self.override.disable()
+        shutil.rmtree(self.models_base_dir)
+
+
+class ModelStoreTestCase(ModelTestCase):
+    def setUp(self):
+        super().setUp()
+        self.embeddings = np.arange(8, dtype=np.float64).reshape(4, 2)
+        write_model(self.model_path, [10, 11, 12, 13], [1, 1, 2, 2], self.embeddings)
+
+    def test_model_is_loaded_once(self):
+        model = get_model()
+        self.assertIs(get_model(), model)
+        self.assertEqual(model.row_for_id(12), 2)
+
+    def test_model_is_reloaded_when_published(self):
+        model = get_model()
+        dirtypath = os.path.join(self.model_path, DIRTY_FILENAME)
+        open(dirtypath, "w").close()
+        embeddingspath = os.path.join(self.model_path, EMBEDDINGS_FILENAME)
+        save_array(embeddingspath, self.embeddings * 2)
+        # the notebook is still writing the artifacts
+        self.assertIs(get_model(), model)
+        np.testing.assert_array_equal(model.embeddings, self.embeddings)
+
+        os.unlink(dirtypath)
+        reloaded = get_model()
+        self.assertIsNot(reloaded, model)
+        np.testing.assert_array_equal(reloaded.embeddings, self.embeddings * 2)
+
+    def test_convert_embeddings_to_float32(self):
+        model = get_model()
+        self.assertTrue(convert_embeddings_to_float32(self.model_path, chunk_rows=3))
+        self.assertFalse(convert_embeddings_to_float32(self.model_path))
+        reloaded = get_model()
+        self.assertIsNot(reloaded, model)
+        self.assertEqual(reloaded.embeddings.dtype, np.float32)
+        np.testing.assert_array_equal(reloaded.embeddings, self.embeddings)
+
+
+class TopKTestCase(ModelTestCase):
+    def setUp(self):
+        super().setUp()
+        embeddings = np.array(
+            [[1.0, 0.0], [0.9, 0.0], [0.5, 0.0], [0.8, 0.0], [0.7, 0.0]],
+            dtype=np.float32,
+        )
+        write_model(self.model_path, [10, 11, 12, 13, 14], [1, 1, 2, 2, 3], embeddings)
+        self.model = get_model()
+
+    def assertTopK(self, expected_ids, expected_scores, **kwargs):
+        ids, scores = top_k(self.model, 0, **kwargs)
+        self.assertEqual(ids.tolist(), expected_ids)
+        np.testing.assert_allclose(scores, expected_scores, rtol=1e-6)
+
+    def test_sorted_by_decreasing_relevance(self):
+        self.assertTopK([10, 11, 13, 14, 12], [1.0, 0.9, 0.8, 0.7, 0.5])
+
+    def test_excludes_document(self):
+        self.assertTopK([13, 14, 12], [0.8, 0.7, 0.5], exclude_document_id=1)
+
+    def test_count_and_threshold(self):
+        self.assertTopK([13, 14], [0.8, 0.7], exclude_document_id=1, count=2)
+        self.assertTopK([13], [0.8], exclude_document_id=1, threshold=0.75)
+
+
+# SCHEDULERS
+################################################################################
+
+
+class SchedulerTestCase(ModelTestCase):
+    """
+    Two documents with three leaves each, and a model where all the nodes are
+    equally relevant to each other.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username="judge")
+        self.leaves = {}
+        for name in ["a", "b"]:
+            document = CurriculumDocument.objects.create(
+                source_id=name,
+                title=name,
+                country="Kenya",
+                digitization_method="manual_entry",
+            )
+            children = [dict(identifier=name + str(i), title=name) for i in range(3)]
+            bulk_load_tree(dict(title=name, children=children), document)
+        nodes = list(StandardNode.objects.order_by("id"))
+        self.ids = {node.identifier: node.id for node in nodes if node.is_leaf()}
+        embeddings = np.full((len(nodes), 2), 0.5, dtype=np.float32)
+        document_ids = [node.document_id for node in nodes]
+        write_model(self.model_path, [n.id for n in nodes], document_ids, embeddings)
+        # an empty index of the judged pairs, whatever earlier tests judged
+        patcher = mock.patch.object(judgedpairs, "_judged_pairs", JudgedPairs())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def add_judgment(self, identifier1, identifier2, **kwargs):
+        return HumanRelevanceJudgment.objects.create(
+            node1_id=self.ids[identifier1],
+            node2_id=self.ids[identifier2],
+            rating=1.0,
+            confidence=0.5,
+            mode="manual",
+            ui_name="test",
+            ui_version_hash="test",
+            user=self.user,
+            **kwargs
+        )
+
+    def pair(self, identifier1, identifier2):
+        return frozenset([self.ids[identifier1], self.ids[identifier2]])
+
+    def all_pairs(self):
+        return {
+            self.pair("a" + str(i), "b" + str(j)) for i in range(3) for j in range(3)
+        }
+
+
+class ProbWeightedRandomTestCase(SchedulerTestCase):
+    def test_pairs_are_leaves_of_different_documents(self):
+        for _ in range(20):
+            pairs, _ = prob_weighted_random_pairs(StandardNode.objects.all(), 10)
+            self.assertEqual(len(pairs), 6)
+            for pair in pairs:
+                self.assertIn(
+                    frozenset([pair["left_id"], pair["right_id"]]), self.all_pairs()
+                )
+                self.assertAlmostEqual(pair["probability"], 1 / 3)
+
+    def test_batch_excludes_judged_pairs(self):
+        self.add_judgment("a0", "b0")
+        self.add_judgment("b1", "a0")
+        judged = {self.pair("a0", "b0"), self.pair("a0", "b1")}
+        for _ in range(20):
+            pairs, _ = prob_weighted_random_pairs(
+                StandardNode.objects.all(), 10, exclude_judged_by=self.user.id
+            )
+            for pair in pairs:
+                node_ids = frozenset([pair["left_id"], pair["right_id"]])
+                self.assertNotIn(node_ids, judged)
+                if pair["left_id"] == self.ids["a0"]:
+                    self.assertEqual(pair["probability"], 1.0)
+
+    def test_excludes_judged_pairs(self):
+        judged = [("a0", "b0"), ("a0", "b1"), ("b0", "a1")]
+        for identifier1, identifier2 in judged:
+            self.add_judgment(identifier1, identifier2)
+        judged = {self.pair(*identifiers) for identifiers in judged}
+        for _ in range(20):
+            _, _, _, nodes = prob_weighted_random(
+                StandardNode.objects.all(), exclude_judged_by=self.user.id
+            )
+            node_ids = frozenset(node.id for node in nodes)
+            self.assertIn(node_ids, self.all_pairs() - judged)
+
+
+class JudgedPairsTestCase(SchedulerTestCase):
+    def test_late_commits_are_picked_up(self):
+        judged = JudgedPairs()
+        self.add_judgment("a0", "b0")
+        judged.refresh()
+        late = self.add_judgment("a1", "b1")
+        self.add_judgment("a2", "b2")
+        # the transaction of `late` hasn't committed yet when the index refreshes
+        late_id = late.id
+        late.delete()
+        judged.refresh()
+        self.assertEqual(judged.judged_with(self.ids["a1"], self.user.id), set())
+        self.assertEqual(
+            judged.judged_with(self.ids["a2"], self.user.id), {self.ids["b2"]}
+        )
+
+        self.add_judgment("a1", "b1", id=late_id)
+        judged.refresh()
+        self.assertEqual(
+            judged.judged_with(self.ids["a1"], self.user.id), {self.ids["b1"]}
+        )
+
+    def test_recorded_judgments_are_counted_once(self):
+        judged = JudgedPairs()
+        judged.refresh()
+        judgment = self.add_judgment("a0", "b0")
+        judged.record(judgment)
+        self.assertEqual(
+            judged.judged_with(self.ids["a0"], max_judgments=1), {self.ids["b0"]}
+        )
+        judged.refresh()
+        judged.refresh()
+        self.add_judgment("b0", "a0")
+        judged.refresh()
+        self.assertEqual(judged.counts[self.ids["a0"]][self.ids["b0"]], 2)
+
+
+class PairQueueTestCase(SchedulerTestCase):
+    def setUp(self):
+        super().setUp()
+        # no background refills
+        patcher = mock.patch("alignmentapp.pairqueue.request_refill")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.params = dict(exclude_judged_by=self.user.id)
+
+    def queued_pairs(self):
+        node_ids = get_queue(self.user.id, self.params).values_list(
+            "node1_id", "node2_id"
+        )
+        return [frozenset(pair) for pair in node_ids]
+
+    def test_refills_never_queue_a_pair_twice(self):
+        self.add_judgment("a0", "b0")
+        for _ in range(20):
+            refill_queue(self.user.id, self.params)
+        queued = self.queued_pairs()
+        self.assertEqual(len(queued), len(set(queued)))
+        self.assertEqual(set(queued), self.all_pairs() - {self.pair("a0", "b0")})
+
+    def test_pop_pair(self):
+        pair = pop_pair(self.user.id, self.params)
+        self.assertIn(frozenset([pair.node1_id, pair.node2_id]), self.all_pairs())
+        self.assertNotIn(frozenset([pair.node1_id, pair.node2_id]), self.queued_pairs())
+        self.assertFalse(ScheduledPair.objects.filter(id=pair.id).exists())
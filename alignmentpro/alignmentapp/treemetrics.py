@@ -0,0 +1,119 @@
+##################################################
+# MIT License
+#
+# Copyright (c) 2019 Learning Equality
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+##################################################
+
+"""
+Tree metrics computed from materialized paths, without any per-node queries.
+
+All functions take rows (dicts with at least `id` and `path`) sorted by `path`,
+as returned by `StandardNode.objects.order_by("path").values(...)`.
+"""
+
+from .models import StandardNode
+
+
+PARENT_ID = "parent_id"
+DEPTH = "depth"
+HEIGHT = "height"  # distance to the furthest leaf below the node (0 for leaves)
+NUM_LEAVES = "num_leaves"  # number of leaves in the subtree (1 for leaves)
+NUM_DESCENDANTS = "num_descendants"
+
+
+def compute_tree_metrics(rows, steplen=StandardNode.steplen):
+    """
+    Compute the parent id, depth, height, number of leaves and number of
+    descendants of every node in `rows` in one bottom-up pass: when iterating
+    in reverse path order, all the descendants of a node are seen before it.
+    Returns a dict mapping node ids to dicts of metrics.
+    """
+    id_by_path = {row["path"]: row["id"] for row in rows}
+    metrics_by_path = {}
+
+    def get_metrics(path):
+        metrics = metrics_by_path.get(path)
+        if metrics is None:
+            metrics = {HEIGHT: 0, NUM_LEAVES: 0, NUM_DESCENDANTS: 0}
+            metrics_by_path[path] = metrics
+        return metrics
+
+    for row in reversed(rows):
+        path = row["path"]
+        metrics = get_metrics(path)  # children have already been accumulated
+        if metrics[NUM_DESCENDANTS] == 0:
+            metrics[NUM_LEAVES] = 1
+        parent_path = path[:-steplen]
+        metrics[PARENT_ID] = id_by_path.get(parent_path)
+        metrics[DEPTH] = len(path) // steplen
+        if parent_path in id_by_path:
+            parent_metrics = get_metrics(parent_path)
+            parent_metrics[HEIGHT] = max(parent_metrics[HEIGHT], metrics[HEIGHT] + 1)
+            parent_metrics[NUM_LEAVES] += metrics[NUM_LEAVES]
+            parent_metrics[NUM_DESCENDANTS] += metrics[NUM_DESCENDANTS] + 1
+
+    return {id_by_path[path]: metrics for path, metrics in metrics_by_path.items()}
+
+
+def iter_trees(rows):
+    """
+    Split the stream of `rows` into lists of rows, one per top-level subtree,
+    so that metrics can be computed for one tree at a time.
+    """
+    tree_rows = []
+    for row in rows:
+        if tree_rows and not row["path"].startswith(tree_rows[0]["path"]):
+            yield tree_rows
+            tree_rows = []
+        tree_rows.append(row)
+    if tree_rows:
+        yield tree_rows
+
+
+def iter_rows_with_metrics(rows):
+    """
+    Yield `(row, metrics)` for the stream of `rows`, tree by tree, keeping only
+    one tree in memory at a time.
+    """
+    for tree_rows in iter_trees(rows):
+        metrics = compute_tree_metrics(tree_rows)
+        for row in tree_rows:
+            yield row, metrics[row["id"]]
+
+
+def get_subtree_rows(root, *fields):
+    """
+    The rows of `root` and all its descendants, in path order, with one query.
+    """
+    fields = set(fields) | {"id", "path"}
+    return list(
+        StandardNode.objects.filter(path__startswith=root.path)
+        .order_by("path")
+        .values(*fields)
+    )
+
+
+def get_subtree_metrics(root):
+    """
+    Tree metrics for `root` and all its descendants, with one query.
+    """
+    return compute_tree_metrics(get_subtree_rows(root))
@@ -208,6 +208,10 @@ STANDARD_NODES_FILENAME = "standardnodes.csv"
 HUMAN_JUDGMENTS_FILENAME = "humanjudgments.csv"
 HUMAN_JUDGMENTS_TEST_FILENAME = "humanjudgments_test.csv"
 USERPROFILES_FILENAME = "userprofiles.csv"
+TOMBSTONES_FILENAME = "tombstones.csv"
+HUMAN_JUDGMENTS_GRAPH_FILENAME = "humanjudgments_graph.npz"
+HUMAN_JUDGMENTS_TEST_GRAPH_FILENAME = "humanjudgments_test_graph.npz"
+NODE_INDEX_FILENAME = "nodeindex.npy"
 METADATA_FILENAME = "metadata.json"
 
 # in production, we'd want to limit this, but for hackathon purposes
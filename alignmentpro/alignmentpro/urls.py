@@ -53,6 +53,7 @@ from alignmentapp.api import (
     UserViewSet,
     TrainedModelViewSet,
     LeaderboardView,
+    ModelQueueView,
     StandardNodeRecommendationViewSet,
     review_section,
     get_user_points
@@ -77,6 +78,7 @@ urlpatterns = [
         include(
             router.urls
             + [path("leaderboard", LeaderboardView.as_view(), name="leaderboard"),
+               path("model-queue", ModelQueueView.as_view(), name="model_queue"),
                path("section-review/", review_section, name="review_section"),
                path("user-points/", get_user_points, name="user_points"),
                ]
@@ -23,9 +23,14 @@
 #
 ##################################################
 
+from collections import defaultdict
+from functools import reduce
+import operator
+
 from django.contrib.postgres.fields import ArrayField
 from django.contrib.postgres.fields import JSONField
 from django.db import models
+from django.db.models import Q
 
 from django.db.models.expressions import RawSQL
 
@@ -51,6 +56,13 @@ class Jurisdictions(models.Model):
         db_table = "jurisdictions"
 
 
+def position_ordering():
+    """
+    Order Standards by their position among their siblings.
+    """
+    return RawSQL("document->>%s", ("position",))
+
+
 class Standards(models.Model):
     # id
     jurisdiction = models.ForeignKey(Jurisdictions, models.DO_NOTHING)
@@ -74,7 +86,7 @@ class Standards(models.Model):
     def get_children(self):
         return Standards.objects.filter(
             parent_ids=self.parent_ids + [self.id]
-        ).order_by(RawSQL("document->>%s", ("position",)))
+        ).order_by(position_ordering())
 
     def get_descendants(self):
         return Standards.objects.filter(
@@ -82,10 +94,7 @@ class Standards(models.Model):
         )
 
     def to_dicttree(self):
-        self_dict = dict(data=self, children=[])
-        for child in self.get_children():
-            self_dict["children"].append(child.to_dicttree())
-        return self_dict
+        return get_dicttrees([self])[self.id]
 
     def __str__(self):
         return "%s: %s" % (self.id, self.title)
@@ -93,3 +102,42 @@ class Standards(models.Model):
     class Meta:
         managed = False
         db_table = "standards"
+
+
+def get_dicttrees(roots):
+    """
+    Extract the subtrees of the Standards `roots` (objects or ids) as dict trees
+    `{data=Standard, children=[...]}`, with the children ordered by position.
+    Makes one `in_bulk` query for the roots given as ids, and a single
+    `parent_ids__contains` query for all their descendants, instead of one
+    `get_children` query per node. Returns a dict mapping root ids to trees.
+    """
+    root_ids = [int(root) for root in roots if not isinstance(root, Standards)]
+    roots_by_id = Standards.objects.in_bulk(root_ids) if root_ids else {}
+    for root in roots:
+        if isinstance(root, Standards):
+            roots_by_id[root.id] = root
+    if not roots_by_id:
+        return {}
+
+    descendants_filter = reduce(
+        operator.or_,
+        [
+            Q(parent_ids__contains=root.parent_ids + [root.id])
+            for root in roots_by_id.values()
+        ],
+    )
+    descendants = Standards.objects.filter(descendants_filter).order_by(
+        position_ordering()
+    )
+    children_by_parent_id = defaultdict(list)  # in position order
+    for standard in descendants:
+        children_by_parent_id[standard.parent_ids[-1]].append(standard)
+
+    def _subtree(standard):
+        return dict(
+            data=standard,
+            children=[_subtree(c) for c in children_by_parent_id[standard.id]],
+        )
+
+    return {root_id: _subtree(root) for root_id, root in roots_by_id.items()}
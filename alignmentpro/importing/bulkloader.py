@@ -0,0 +1,118 @@
+##################################################
+# MIT License
+#
+# Copyright (c) 2019 Learning Equality
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+##################################################
+
+from django.db import transaction
+
+from alignmentapp.models import StandardNode, Tombstone
+
+
+BULK_CREATE_BATCH_SIZE = 1000
+
+# the keys of the dict tree that are copied to the StandardNode fields
+NODE_FIELDS = [
+    "identifier",
+    "kind",
+    "title",
+    "sort_order",
+    "time_units",
+    "notes",
+    "extra_fields",
+]
+
+
+# HIGH LEVEL API
+################################################################################
+
+
+def bulk_load_tree(tree, document, batch_size=BULK_CREATE_BATCH_SIZE):
+    """
+    Create the nested dict `tree` (like those made by `transform_subtree`, with
+    the node fields and a list of `children`) as a new StandardNode tree for
+    `document`. The treebeard paths, depths, and `numchild` are computed in
+    memory and the nodes are inserted with `bulk_create`, instead of the several
+    queries that each `add_child` call makes.
+    Children without a `sort_order` get their position (1, 2, 3, ...).
+    Returns the list of `(subtree, node)` pairs in path order.
+    """
+    with transaction.atomic():
+        pairs = build_nodes(tree, document, get_new_root_path())
+        StandardNode.objects.bulk_create(
+            [node for _, node in pairs], batch_size=batch_size
+        )
+    return pairs
+
+
+def delete_document(document):
+    """
+    Delete `document` with its nodes and the judgments on them, leaving their
+    tombstones (for delta data exports) with a few bulk queries.
+    """
+    with transaction.atomic():
+        Tombstone.bury_nodes(StandardNode.objects.filter(document=document))
+        document.delete()
+
+
+def get_new_root_path():
+    """
+    The treebeard path for a new root node, after the last existing root.
+    """
+    last_root = StandardNode.get_last_root_node()
+    if last_root:
+        return last_root._inc_path()
+    return StandardNode._get_path(None, 1, 1)
+
+
+def build_nodes(tree, document, root_path):
+    """
+    Make the (unsaved) StandardNodes for the dict `tree` with its root at
+    `root_path`, returning `(subtree, node)` pairs in path order.
+    """
+    pairs = []
+    stack = [(tree, root_path, 1, 1)]
+    while stack:
+        subtree, path, depth, sort_order = stack.pop()
+        children = subtree.get("children", [])
+        kwargs = {f: subtree[f] for f in NODE_FIELDS if subtree.get(f) is not None}
+        kwargs.setdefault("sort_order", sort_order)
+        node = StandardNode(
+            document=document,
+            path=path,
+            depth=depth,
+            numchild=len(children),
+            **kwargs
+        )
+        pairs.append((subtree, node))
+        # the children's paths must follow `sort_order`, the `node_order_by` field
+        sort_orders = [
+            i + 1 if child.get("sort_order") is None else child["sort_order"]
+            for i, child in enumerate(children)
+        ]
+        ordered = sorted(zip(sort_orders, range(len(children))))
+        child_items = []
+        for step, (child_sort_order, i) in enumerate(ordered, start=1):
+            child_path = StandardNode._get_path(path, depth + 1, step)
+            child_items.append((children[i], child_path, depth + 1, child_sort_order))
+        stack.extend(reversed(child_items))  # pop the first child first
+    return pairs
@@ -23,8 +23,10 @@
 #
 ##################################################
 
-from commonstandardsproject.models import Jurisdictions, Standards
-from alignmentapp.models import CurriculumDocument, StandardNode
+from commonstandardsproject.models import Jurisdictions, Standards, get_dicttrees
+from alignmentapp.models import CurriculumDocument
+from importing.bulkloader import bulk_load_tree, delete_document
+from importing.treediff import reimport_tree
 
 
 # SHARED
@@ -43,13 +45,16 @@ def join_standards(standard_ids, identifier, title, notes=""):
         extra_fields={},
     )
     root = dict(data=data, children=[])
+    # extract all the subtrees with a constant number of queries
+    dicttrees = get_dicttrees([standard_id for standard_id, _ in standard_ids])
     for standard_id, identifier in standard_ids:
-        standard = Standards.objects.get(id=standard_id)
+        dicttree = dicttrees[int(standard_id)]
+        standard = dicttree["data"]
         source_identifier = standard.document.get("statementNotation", None)
         if source_identifier:
             print("Replacing source_identifier", source_identifier)
         standard.document["statementNotation"] = identifier
-        root["children"].append(standard.to_dicttree())
+        root["children"].append(dicttree)
     return root
 
 
@@ -140,6 +145,55 @@ def hoist_unnecessary_tree_nodes(subtree, hoist_titles):
             hoist_unnecessary_tree_nodes(child, hoist_titles=hoist_titles)
     subtree["children"] = new_children
 
+
+def load_document(
+    transformed_tree,
+    document_attributes,
+    kind_mapping=None,
+    incremental=False,
+    dry_run=False,
+):
+    """
+    Replace the curriculum document with `document_attributes` by a new one
+    with the nodes of `transformed_tree`, mapping the node kinds (except the
+    root's) using `kind_mapping`. The nodes are inserted with `bulk_load_tree`.
+    With `incremental` (or `dry_run`), an existing document is updated in place
+    by `reimport_tree` so the judgments on its unchanged nodes are preserved.
+    """
+    kind_mapping = kind_mapping or {}
+
+    def _node_subtree(subtree, kind):
+        return dict(
+            title=subtree["title"],
+            identifier=subtree["identifier"],
+            kind=kind,
+            children=[
+                _node_subtree(child, kind_mapping.get(child["kind"], child["kind"]))
+                for child in subtree["children"]
+            ],
+        )
+
+    tree = _node_subtree(transformed_tree, transformed_tree["kind"])
+    source_id = document_attributes["source_id"]
+    document = CurriculumDocument.objects.filter(source_id=source_id).first()
+    if (incremental or dry_run) and document:
+        if not dry_run:
+            CurriculumDocument.objects.filter(id=document.id).update(
+                **document_attributes
+            )
+        reimport_tree(tree, document, dry_run=dry_run)
+        return document
+    elif dry_run:
+        print("No existing document", source_id, "to compare with.")
+        return None
+
+    if document:
+        delete_document(document)
+    document = CurriculumDocument.objects.create(**document_attributes)
+    bulk_load_tree(tree, document)
+    return document
+
+
 # Common Core State Standards for Mathematics
 ################################################################################
 
@@ -222,48 +276,21 @@ def transform_ccssm(tree):
     return tree3
 
 
-def load_ccssm(transformed_tree):
-    try:
-        document = CurriculumDocument.objects.get(
-            source_id=CCSSM_DOCUMENT_ATTRIBUTES["source_id"]
-        )
-        document.delete()
-    except CurriculumDocument.DoesNotExist:
-        pass
-    document = CurriculumDocument.objects.create(**CCSSM_DOCUMENT_ATTRIBUTES)
-
-    root = StandardNode.add_root(
-        identifier=transformed_tree["identifier"],
-        title=transformed_tree["title"],
-        kind=transformed_tree["kind"],
-        document=document,
+def load_ccssm(transformed_tree, incremental=False, dry_run=False):
+    load_document(
+        transformed_tree,
+        CCSSM_DOCUMENT_ATTRIBUTES,
+        kind_mapping=CCSSM_TO_NODE_KIND_MAPPING,
+        incremental=incremental,
+        dry_run=dry_run,
     )
 
-    def _add_children_to_parent(parent, children):
-        for i, child in enumerate(children):
-            sort_order = i + 1
-            source_kind = child["kind"]
-            if source_kind in CCSSM_TO_NODE_KIND_MAPPING:
-                kind = CCSSM_TO_NODE_KIND_MAPPING[source_kind]
-            else:
-                kind = source_kind
-            node = parent.add_child(
-                document=parent.document,
-                title=child["title"],
-                identifier=child["identifier"],
-                sort_order=sort_order,
-                kind=kind,
-            )
-            _add_children_to_parent(node, child["children"])
 
-    _add_children_to_parent(root, transformed_tree["children"])
-
-
-def import_ccssm():
+def import_ccssm(incremental=False, dry_run=False):
     tree = extract_ccssm()
     transformed_tree = transform_ccssm(tree)
     # print_commonstandards_tree(transformed_tree, display_len_limit=None)
-    load_ccssm(transformed_tree)
+    load_ccssm(transformed_tree, incremental=incremental, dry_run=dry_run)
     print("Finished importing CCSSM")
 
 
@@ -343,48 +370,21 @@ def transform_ngss(tree):
     return tree3
 
 
-def load_ngss(transformed_tree):
-    try:
-        document = CurriculumDocument.objects.get(
-            source_id=NGSS_DOCUMENT_ATTRIBUTES["source_id"]
-        )
-        document.delete()
-    except CurriculumDocument.DoesNotExist:
-        pass
-    document = CurriculumDocument.objects.create(**NGSS_DOCUMENT_ATTRIBUTES)
-
-    root = StandardNode.add_root(
-        identifier=transformed_tree["identifier"],
-        title=transformed_tree["title"],
-        kind=transformed_tree["kind"],
-        document=document,
+def load_ngss(transformed_tree, incremental=False, dry_run=False):
+    load_document(
+        transformed_tree,
+        NGSS_DOCUMENT_ATTRIBUTES,
+        kind_mapping=NGSS_TO_NODE_KIND_MAPPING,
+        incremental=incremental,
+        dry_run=dry_run,
     )
 
-    def _add_children_to_parent(parent, children):
-        for i, child in enumerate(children):
-            sort_order = i + 1
-            source_kind = child["kind"]
-            if source_kind in NGSS_TO_NODE_KIND_MAPPING:
-                kind = NGSS_TO_NODE_KIND_MAPPING[source_kind]
-            else:
-                kind = source_kind
-            node = parent.add_child(
-                document=parent.document,
-                title=child["title"],
-                identifier=child["identifier"],
-                sort_order=sort_order,
-                kind=kind,
-            )
-            _add_children_to_parent(node, child["children"])
-
-    _add_children_to_parent(root, transformed_tree["children"])
 
-
-def import_ngss():
+def import_ngss(incremental=False, dry_run=False):
     tree = extract_ngss()
     transformed_tree = transform_ngss(tree)
     # print_commonstandards_tree(transformed_tree, display_len_limit=90)
-    load_ngss(transformed_tree)
+    load_ngss(transformed_tree, incremental=incremental, dry_run=dry_run)
     print("Finished importing NGSS")
 
 
@@ -426,7 +426,7 @@ CALIFORNIA_VOCATIONAL_DOCUMENT_ATTRIBUTES = {
     "is_draft": False,
 }
 
-def import_california():
+def import_california(incremental=False, dry_run=False):
     j = Jurisdictions.objects.get(id=CALIFORNIA_JURISDICTION_ID)
     root_tuples = CALIFORNIA_VOCATIONAL_ROOTS
     tree = join_standards(
@@ -466,35 +466,12 @@ def import_california():
     print_commonstandards_tree(transformed_tree, display_len_limit=90)
     # return transformed_tree
 
-    try:
-        document = CurriculumDocument.objects.get(
-            source_id=CALIFORNIA_VOCATIONAL_DOCUMENT_ATTRIBUTES["source_id"]
-        )
-        document.delete()
-    except CurriculumDocument.DoesNotExist:
-        pass
-    document = CurriculumDocument.objects.create(**CALIFORNIA_VOCATIONAL_DOCUMENT_ATTRIBUTES)
-
-    root = StandardNode.add_root(
-        identifier=transformed_tree["identifier"],
-        title=transformed_tree["title"],
-        kind=transformed_tree["kind"],
-        document=document,
+    load_document(
+        transformed_tree,
+        CALIFORNIA_VOCATIONAL_DOCUMENT_ATTRIBUTES,
+        incremental=incremental,
+        dry_run=dry_run,
     )
-
-    def _add_children_to_parent(parent, children):
-        for i, child in enumerate(children):
-            sort_order = i + 1
-            node = parent.add_child(
-                document=parent.document,
-                title=child["title"],
-                identifier=child["identifier"],
-                sort_order=sort_order,
-                kind=child["kind"],
-            )
-            _add_children_to_parent(node, child["children"])
-
-    _add_children_to_parent(root, transformed_tree["children"])
     print("Finished importing California vocational standards")
 
 
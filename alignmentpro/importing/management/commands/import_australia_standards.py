@@ -22,24 +22,104 @@
 # SOFTWARE.
 #
 ##################################################
-
+import functools
 import glob
 import json
+import multiprocessing
 import os
 import re
 import textwrap
+import xml.etree.ElementTree as ET
 
 from django.core.management.base import BaseCommand
+from django.db import connections
 
-import xmltodict
-
-from alignmentapp.models import CurriculumDocument, StandardNode
+from alignmentapp.models import CurriculumDocument
+from importing.bulkloader import bulk_load_tree, delete_document
+from importing.treediff import add_reimport_arguments, reimport_tree
 
 
 this_dir = os.path.dirname(os.path.abspath(__file__))
 data_dir = os.path.abspath(os.path.join(this_dir, '..', '..', 'data'))
 
 
+# STREAMING RDF READER
+################################################################################
+
+RDF_DESCRIPTION = 'rdf:Description'
+RDF_ABOUT = 'rdf:about'
+RDF_RESOURCE = 'rdf:resource'
+GEM_HAS_CHILD = 'gem:hasChild'
+GEM_IS_CHILD_OF = 'gem:isChildOf'
+# the text elements of a description used by `add_standard`
+TEXT_FIELDS = [
+    'asn:statementLabel',
+    'dct:title',
+    'dct:description',
+    'dct:statementNotation',
+]
+
+
+def iter_rdf_descriptions(path):
+    """
+    Stream the top-level `rdf:Description` elements of the RDF file at `path`
+    with `iterparse`, yielding small dicts that keep only the fields used to
+    build the standards tree:
+      - `about`: the URI of the standard;
+      - the `TEXT_FIELDS` that are present (the first one, if repeated);
+      - `child_ids` and `parent_ids`: the URIs of `gem:hasChild` / `gem:isChildOf`.
+    Names are qualified with the prefixes declared in the document (as xmltodict
+    does), and every element is cleared once read, so memory stays flat.
+    """
+    prefixes = {}  # namespace URI --> prefix
+
+    def qname(tag):
+        if tag.startswith('{'):
+            uri, local = tag[1:].split('}', 1)
+            prefix = prefixes.get(uri)
+            return prefix + ':' + local if prefix else local
+        return tag
+
+    def resource(elem):
+        for key, value in elem.attrib.items():
+            if qname(key) == RDF_RESOURCE:
+                return value
+        return None
+
+    root = None
+    level = 0
+    for event, item in ET.iterparse(path, events=('start-ns', 'start', 'end')):
+        if event == 'start-ns':
+            prefix, uri = item
+            prefixes[uri] = prefix
+        elif event == 'start':
+            if root is None:
+                root = item
+            level += 1
+        elif event == 'end':
+            level -= 1
+            if level != 1 or qname(item.tag) != RDF_DESCRIPTION:
+                continue
+            description = dict(about=None, child_ids=[], parent_ids=[])
+            for key, value in item.attrib.items():
+                if qname(key) == RDF_ABOUT:
+                    description['about'] = value
+            for child in item:
+                name = qname(child.tag)
+                if name in TEXT_FIELDS and name not in description:
+                    description[name] = child.text or ''
+                elif name == GEM_HAS_CHILD:
+                    description['child_ids'].append(resource(child))
+                elif name == GEM_IS_CHILD_OF:
+                    description['parent_ids'].append(resource(child))
+            root.clear()  # drop the elements read so far
+            yield description
+
+
+# TREE BUILDING
+################################################################################
+
+
 def get_topic_children_recursive(parent, topics_list):
     """
     The XML document stores the standards as a flat list and uses IDs to identify parent and
@@ -47,32 +127,24 @@ def get_topic_children_recursive(parent, topics_list):
     :param parent: Parent item to check for children
     :param topics_list: Complete, flat list of standard topics with IDs as keys.
     """
-    if 'gem:hasChild' in parent:
-        children = parent['gem:hasChild']
-        # if there's a single child, it's a dict, but if there are
-        # multiple children, it's an array...
-        if isinstance(children, dict):
-            children = [children]
-        for resource in children:
-            id = resource['@rdf:resource']
-            if not 'children' in parent:
-                parent['children'] = []
-            child = topics_list[id]
-            if not child in parent['children']:
-                parent['children'].append(child)
-                get_topic_children_recursive(child, topics_list)
-
-
-def get_topic_hierarchy(data):
+    for id in parent['child_ids']:
+        if not 'children' in parent:
+            parent['children'] = []
+        child = topics_list[id]
+        if not child in parent['children']:
+            parent['children'].append(child)
+            get_topic_children_recursive(child, topics_list)
+
+
+def get_topic_hierarchy(descriptions):
     """
-    Get the flat list of topics from the XML file, then convert it into a hierarchical tree representation.
-    :param data: XML data converted to a Python dict format by xmltodict.
+    Convert the flat list of topics read from the XML file into a hierarchical tree representation.
+    :param descriptions: the topics read by `iter_rdf_descriptions`.
     :return:
     """
-    topics_list = data['rdf:RDF']['rdf:Description']
     topics = {}
-    for topic in topics_list:
-        topics[topic['@rdf:about']] = topic
+    for topic in descriptions:
+        topics[topic['about']] = topic
 
     # root topics are ones whose 'parent' is the standard itself, and the standard's ID
     # is external to this document. So if we can't find the parent's ID in the doc, it's
@@ -80,11 +152,7 @@ def get_topic_hierarchy(data):
     root_topics = []
     for topic_id in topics:
         topic = topics[topic_id]
-        parents = topic['gem:isChildOf']
-        if isinstance(parents, dict):
-            parents = [parents]
-        for parent in parents:
-            parent_id = parent['@rdf:resource']
+        for parent_id in topic['parent_ids']:
             if not parent_id in topics:
                 root_topics.append(topic)
 
@@ -95,37 +163,37 @@ def get_topic_hierarchy(data):
 
 
 def add_standard(subject_json, parent, indent=0):
+    """
+    Add the standard in `subject_json` and its children to the `children` of the
+    dict tree node `parent`, to be inserted later with `bulk_load_tree`.
+    """
     try:
-        kind = subject_json['asn:statementLabel']['#text']
+        kind = subject_json['asn:statementLabel']
         # the tree has two organizations, one by year level, and another by
         # strand. They are the same data
         if kind == 'Strand':
             return
         if 'dct:title' in subject_json:
-            title = subject_json['dct:title']['#text']
+            title = subject_json['dct:title']
             # For achievement standards, the title is just "Achievement Standard", but the description
             # is where the actual data is. So merge the title and description in this case.
             if title == "Achievement Standard":
-                title = title + ": " + re.sub('<[^<]+?>', '', subject_json['dct:description']['#text'])
+                title = title + ": " + re.sub('<[^<]+?>', '', subject_json['dct:description'])
         else:
-            title = re.sub('<[^<]+?>', '', subject_json['dct:description']['#text'])
+            title = re.sub('<[^<]+?>', '', subject_json['dct:description'])
 
         if kind == "Content description":
             kind = "content"
 
         print("{}{}".format(" " * indent, textwrap.shorten(title, 80)))
 
-        all_identifiers = set()
-        statement_notation_el = subject_json.get('dct:statementNotation', None)
-        if statement_notation_el:
-            identifier = statement_notation_el['#text']
+        statement_notation = subject_json.get('dct:statementNotation', None)
+        if statement_notation:
+            identifier = statement_notation
         else:
-            identifier = subject_json["@rdf:about"].split('/')[-1]  # use suffix of the URI
-        node = parent.add_child(document=parent.document,
-                         title=title,
-                         identifier=identifier,
-                         kind=kind
-        )
+            identifier = subject_json['about'].split('/')[-1]  # use suffix of the URI
+        node = dict(title=title, identifier=identifier, kind=kind, children=[])
+        parent['children'].append(node)
         if 'children' in subject_json:
             for child in subject_json['children']:
                 add_standard(child, parent=node, indent=indent + 2)
@@ -134,7 +202,42 @@ def add_standard(subject_json, parent, indent=0):
         raise
 
 
+def read_standards_file(afile, dump_json=False):
+    """
+    Parse the RDF file `afile` into a dict tree ready for `bulk_load_tree`.
+    Doesn't touch the database, so it can run in a pool worker process.
+    Returns `(topic, tree)`.
+    """
+    basename = os.path.basename(afile)
+    topic = os.path.splitext(basename)[0]
+    descriptions = list(iter_rdf_descriptions(afile))
+    if dump_json:
+        json_file = afile + ".json"
+        with open(json_file, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(descriptions, ensure_ascii=False, indent=2))
+
+    root = dict(title=topic, kind='document', children=[])
+    topic_tree = get_topic_hierarchy(descriptions)
+    for subject in topic_tree:
+        add_standard(subject, parent=root)
+    return topic, root
+
+
 class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--jobs",
+            type=int,
+            default=1,
+            help="Number of processes used to parse the RDF files.",
+        )
+        parser.add_argument(
+            "--dump_json",
+            action="store_true",
+            help="Write the data read from each RDF file to <file>.rdf.json for debugging.",
+        )
+        add_reimport_arguments(parser)
+
     def handle(self, *args, **options):
         """
         Imports Australian curriculum standards into the alignment prototype database.
@@ -144,42 +247,51 @@ class Command(BaseCommand):
 
         http://rdf.australiancurriculum.edu.au/
 
-        Currently, this function accepts no arguments.
+        The files are parsed in `--jobs` parallel processes and written to the
+        database one at a time, in bulk, by this process.
+        Use --incremental to update the existing documents in place, preserving the
+        judgments on their unchanged nodes, and --dry_run to only print the changes.
         """
         standards_dir = os.path.join(data_dir, 'australia_standards')
-        for afile in glob.glob(os.path.join(standards_dir, '*.rdf')):
-            basename = os.path.basename(afile)
-            topic = os.path.splitext(basename)[0]
-            with open(afile, encoding='utf-8') as doc:
-                data = xmltodict.parse(doc.read())
-                json_file = os.path.join(standards_dir, basename + ".json")
-                f = open(json_file, 'w', encoding='utf-8')
-                f.write(json.dumps(data, ensure_ascii=False, indent=2))
-                f.close()
-                # continue
-
-                source_id = "australia_standards_{}".format(topic.lower().replace(" ", "_"))
-                country = "Australia"
-                digitization_method="data_import"
-                draft = True
-
-                # For now, clean out old runs so we don't proliferate the db.
-                try:
-                    existing_doc = CurriculumDocument.objects.get(source_id=source_id)
-                    # this will delete all children and also learning objectives due to cascade delete
-                    existing_doc.delete()
-                except CurriculumDocument.DoesNotExist:
-                    pass
-
-                document = CurriculumDocument.objects.create(
-                    source_id=source_id,
-                    title=topic,
-                    country=country,
-                    digitization_method=digitization_method,
-                    is_draft=draft,
-                )
-
-                root = StandardNode.add_root(title=topic, kind='document', document=document)
-                topic_tree = get_topic_hierarchy(data)
-                for subject in topic_tree:
-                    add_standard(subject, parent=root)
+        afiles = sorted(glob.glob(os.path.join(standards_dir, '*.rdf')))
+        read_file = functools.partial(read_standards_file, dump_json=options['dump_json'])
+
+        jobs = options['jobs']
+        if jobs > 1:
+            # the forked workers must not share the parent's database connections
+            connections.close_all()
+            with multiprocessing.Pool(jobs) as pool:
+                for topic, root in pool.imap(read_file, afiles):
+                    self.write_document(topic, root, options)
+        else:
+            for topic, root in map(read_file, afiles):
+                self.write_document(topic, root, options)
+
+    def write_document(self, topic, root, options):
+        source_id = "australia_standards_{}".format(topic.lower().replace(" ", "_"))
+        country = "Australia"
+        digitization_method="data_import"
+        draft = True
+
+        incremental = options['incremental'] or options['dry_run']
+        existing_doc = CurriculumDocument.objects.filter(source_id=source_id).first()
+        if incremental and existing_doc:
+            reimport_tree(root, existing_doc, dry_run=options['dry_run'])
+            return
+        elif options['dry_run']:
+            print("No existing document", source_id, "to compare with.")
+            return
+
+        # For now, clean out old runs so we don't proliferate the db.
+        if existing_doc:
+            # this will delete all children and also learning objectives due to cascade delete
+            delete_document(existing_doc)
+
+        document = CurriculumDocument.objects.create(
+            source_id=source_id,
+            title=topic,
+            country=country,
+            digitization_method=digitization_method,
+            is_draft=draft,
+        )
+        bulk_load_tree(root, document)
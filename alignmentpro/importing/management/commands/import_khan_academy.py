@@ -23,20 +23,32 @@
 #
 ##################################################
 
+from collections import defaultdict
 import json
 import os
 
 from django.contrib.auth.models import User
 from django.core.management.base import BaseCommand
+from django.db import transaction
 
 from alignmentapp.models import CurriculumDocument, HumanRelevanceJudgment, StandardNode
+from alignmentapp.models import Tombstone
+from importing.bulkloader import BULK_CREATE_BATCH_SIZE, bulk_load_tree, delete_document
+from importing.commonstandardsimporter import CCSSM_DOCUMENT_ATTRIBUTES
+from importing.treediff import add_reimport_arguments, reimport_tree
 
 
 this_dir = os.path.dirname(os.path.abspath(__file__))
 data_dir = os.path.abspath(os.path.join(this_dir, '..', '..', 'data'))
 
 
-def get_node(data, parent=None, user=None):
+def get_node(data, parent=None, exercises=None):
+    """
+    Add the dict tree node for the topic `data` to the `children` of `parent`.
+    Exercises don't become nodes: their slugs are added to the `extra_fields`
+    of `parent`, and they are collected in `exercises` as `(parent, data)` pairs
+    to be handled by `get_exercise_judgment` once the tree is saved.
+    """
 
     kind = data['kind']
 
@@ -44,30 +56,13 @@ def get_node(data, parent=None, user=None):
         # Don't make a standard node for videos
         return None
 
-    if kind == 'exercise' and parent and user:
+    if kind == 'exercise' and parent and exercises is not None:
         if len(data['tags']) == 0:
             # print("Exercise {} doesn't have a standard associated with it".format(data))
             return None
-        exercise_slugs = parent.extra_fields.get('exercise_slugs', [])
-        exercise_slugs.append( data['slug'] )
-        parent.extra_fields['exercise_slugs'] = exercise_slugs
-        parent.save()
-        standard = data['tags'][0]
-        # The KA standard name uses a slightly different structure than the CCSSM docs,
-        # so convert it to the CCSSM format for searching.
-        standard = 'CCSS.' + standard.replace('.CC', '.Content', 1)
-        ccs_query = StandardNode.objects.filter(identifier=standard)
-        num_results = ccs_query.count()
-        if num_results == 1:
-            ccs = ccs_query.first()
-            HumanRelevanceJudgment.objects.create(
-                user=user, node1=ccs, node2=parent, rating=1.0, confidence=1.0
-            )
-        elif num_results == 0:
-            print("No standard found in CCSSM tree for {}".format(standard))
-
-        assert num_results <= 1, "Multiple StandardNodes found for identifier: {}".format(data['tags'][0])
-
+        extra_fields = parent.setdefault('extra_fields', {})
+        extra_fields.setdefault('exercise_slugs', []).append(data['slug'])
+        exercises.append((parent, data))
         # Don't make a standard node for the actual exercise
         return None
 
@@ -79,16 +74,55 @@ def get_node(data, parent=None, user=None):
 
     assert identifier, "No identifier found for {}".format(data)
 
-    node = parent.add_child(document=parent.document,
-                            title=data['title'],
-                            identifier=identifier,
-                            kind=kind,
-                            notes=data.get('description', ''),
-                            )
+    node = dict(
+        title=data['title'],
+        identifier=identifier,
+        kind=kind,
+        notes=data.get('description', ''),
+        children=[],
+    )
+    parent['children'].append(node)
 
     return node
 
-def get_node_data_recursive(data, level=0, parent=None, user=None):
+
+def get_ccssm_ids_by_identifier():
+    """
+    Map the identifiers of the CCSSM nodes to the lists of their ids, loaded
+    with a single query, to resolve the standards of all the exercises.
+    """
+    ids_by_identifier = defaultdict(list)
+    ccssm_nodes = StandardNode.objects.filter(
+        document__source_id=CCSSM_DOCUMENT_ATTRIBUTES['source_id']
+    )
+    for node_id, identifier in ccssm_nodes.values_list('id', 'identifier'):
+        ids_by_identifier[identifier].append(node_id)
+    return ids_by_identifier
+
+
+def get_exercise_judgment(data, parent, user, ccssm_ids_by_identifier):
+    """
+    Return the (unsaved) relevance judgment between the saved `parent`
+    StandardNode of the exercise `data` and the CCSSM standard of the exercise,
+    or None when the standard is not in the CCSSM tree.
+    """
+    standard = data['tags'][0]
+    # The KA standard name uses a slightly different structure than the CCSSM docs,
+    # so convert it to the CCSSM format for searching.
+    standard = 'CCSS.' + standard.replace('.CC', '.Content', 1)
+    ccs_ids = ccssm_ids_by_identifier.get(standard, [])
+    num_results = len(ccs_ids)
+    assert num_results <= 1, "Multiple StandardNodes found for identifier: {}".format(data['tags'][0])
+
+    if num_results == 0:
+        print("No standard found in CCSSM tree for {}".format(standard))
+        return None
+    return HumanRelevanceJudgment(
+        user=user, node1_id=ccs_ids[0], node2=parent, rating=1.0, confidence=1.0
+    )
+
+
+def get_node_data_recursive(data, level=0, parent=None, exercises=None):
     if level >= 5:
         return
 
@@ -108,13 +142,16 @@ def get_node_data_recursive(data, level=0, parent=None, user=None):
         print('skipping', data['title'])
         return
     else:
-        node = get_node(data, parent, user)
+        node = get_node(data, parent, exercises)
         if node and 'children' in data:
             for child in data['children']:
-                get_node_data_recursive(child, level+1, node, user)
+                get_node_data_recursive(child, level+1, node, exercises)
 
 
 class Command(BaseCommand):
+    def add_arguments(self, parser):
+        add_reimport_arguments(parser)
+
     def handle(self, *args, **options):
         print("Importing Khan Academy topic tree from khan_academy_ricecooker_tree.json...")
         filename = os.path.join(data_dir, 'khan_academy_ricecooker_tree.json')
@@ -128,23 +165,54 @@ class Command(BaseCommand):
 
         ka_user, _created = User.objects.get_or_create(username='khan_academy_org')
 
-        try:
-            existing_doc = CurriculumDocument.objects.get(source_id=source_id)
-            # this will delete all children and also learning objectives due to cascade delete
-            existing_doc.delete()
-        except CurriculumDocument.DoesNotExist:
-            pass
+        # first build the topic tree in memory...
+        root = dict(title=topic, identifier='KA-en', kind='channel', children=[])
+        exercises = []
+        for domain in root_node['children']:
+            get_node_data_recursive(domain, parent=root, exercises=exercises)
+
+        incremental = options['incremental'] or options['dry_run']
+        document = CurriculumDocument.objects.filter(source_id=source_id).first()
+        if options['dry_run']:
+            if document:
+                reimport_tree(root, document, dry_run=True)
+            else:
+                print("No existing document", source_id, "to compare with.")
+            return
 
         ka_judgments = HumanRelevanceJudgment.objects.filter(user=ka_user)
-        ka_judgments.delete()
-
-        document = CurriculumDocument.objects.create(
-            source_id=source_id,
-            title=topic,
-            country=country,
-            digitization_method=digitization_method,
-            is_draft=draft,
+        with transaction.atomic():
+            ka_judgment_ids = list(ka_judgments.values_list('id', flat=True))
+            Tombstone.bury(HumanRelevanceJudgment, ka_judgment_ids)
+            ka_judgments.delete()
+
+        # ...then update the existing nodes in place or insert them in bulk...
+        if incremental and document:
+            pairs = reimport_tree(root, document).pairs
+        else:
+            if document:
+                # this will delete all children and also learning objectives due to cascade delete
+                delete_document(document)
+            document = CurriculumDocument.objects.create(
+                source_id=source_id,
+                title=topic,
+                country=country,
+                digitization_method=digitization_method,
+                is_draft=draft,
+            )
+            pairs = bulk_load_tree(root, document)
+
+        # ...then add the judgments between the saved nodes and the CCSSM standards
+        ccssm_ids_by_identifier = get_ccssm_ids_by_identifier()
+        nodes_by_subtree = {id(subtree): node for subtree, node in pairs}
+        judgments = []
+        for parent, data in exercises:
+            judgment = get_exercise_judgment(
+                data, nodes_by_subtree[id(parent)], ka_user, ccssm_ids_by_identifier
+            )
+            if judgment:
+                judgments.append(judgment)
+        HumanRelevanceJudgment.objects.bulk_create(
+            judgments, batch_size=BULK_CREATE_BATCH_SIZE
         )
-        root = StandardNode.add_root(title=topic, identifier='KA-en', kind='channel', document=document)
-        for domain in root_node['children']:
-            get_node_data_recursive(domain, parent=root, user=ka_user)
+        print("Added", len(judgments), "judgments for", len(exercises), "exercises")
@@ -40,7 +40,9 @@ from importing.csvutils import (
     TIME_UNITS_KEY,
     NOTES_KEY,
 )
-from alignmentapp.models import CurriculumDocument, StandardNode
+from alignmentapp.models import CurriculumDocument
+from importing.bulkloader import bulk_load_tree, delete_document
+from importing.treediff import add_reimport_arguments, reimport_tree
 
 
 class Command(BaseCommand):
@@ -82,6 +84,7 @@ class Command(BaseCommand):
             type=str,
             help="StandardNode.id after which we should add this chunk.",
         )
+        add_reimport_arguments(parser)
 
     def handle(self, *args, **options):
         print("Handling importchunk with options = ", options)
@@ -91,25 +94,8 @@ class Command(BaseCommand):
         country = options["country"] or "Unknown"
         draft = options["draft"]
 
-        try:
-            document = CurriculumDocument.objects.get(source_id=source_id)
-            if document.is_draft:
-                print("Deleting old draft verison of curriculum document...")
-                document.delete()
-            else:
-                print('ERROR: document is no longer in draft state so cannot be updated.')
-                sys.exit(1)
-        except CurriculumDocument.DoesNotExist:
-            pass
-
-        document = CurriculumDocument.objects.create(
-            source_id=source_id,
-            title=title,
-            country=country,
-            digitization_method=digitization_method,
-            is_draft=draft,
-        )
-        root = StandardNode.add_root(title=title, document=document)
+        # build the tree as nested dicts and insert all the nodes at the end
+        root = dict(title=title, children=[])
 
         curriculum_list = load_curriculum_list(options["gsheet_id"], options["gid"])
 
@@ -142,17 +128,61 @@ class Command(BaseCommand):
             # Add the node to the appropriate location
             parent = nodes_breadcrumbs[cur_level - 1]
             node_counts[cur_level] += 1
-            node = parent.add_child(
-                document=parent.document,
+            node = dict(
                 title=row[TITLE_KEY],
                 identifier=row[IDENTIFIER_KEY],
                 sort_order=node_counts[cur_level],
                 kind=row[KIND_KEY],
                 time_units=float(row[TIME_UNITS_KEY]) if row[TIME_UNITS_KEY] else None,
                 notes=row[NOTES_KEY] or '',
+                children=[],
             )
+            parent["children"].append(node)
             nodes_breadcrumbs[cur_level] = node
 
+        document_fields = dict(
+            title=title,
+            country=country,
+            digitization_method=digitization_method,
+            is_draft=draft,
+        )
+        document = CurriculumDocument.objects.filter(source_id=source_id).first()
+        if document and not document.is_draft:
+            print('ERROR: document is no longer in draft state so cannot be updated.')
+            sys.exit(1)
+
+        incremental = options["incremental"] or options["dry_run"]
+        if incremental and document:
+            reimport_tree(root, document, dry_run=options["dry_run"])
+            update_document(document, document_fields, dry_run=options["dry_run"])
+            if not options["dry_run"]:
+                print("Import finished")
+                print(get_tree_as_markdown(document.root, {}))
+            return
+        elif incremental and options["dry_run"]:
+            print("No existing document", source_id, "to compare with.")
+            return
+
+        if document:
+            print("Deleting old draft verison of curriculum document...")
+            delete_document(document)
+
+        document = CurriculumDocument.objects.create(
+            source_id=source_id, **document_fields
+        )
+        pairs = bulk_load_tree(root, document)
         print("Import finished")
-        print(get_tree_as_markdown(root, {}))
+        print(get_tree_as_markdown(pairs[0][1], {}))
+
 
+def update_document(document, fields, dry_run=False):
+    """
+    Set the metadata `fields` of the incrementally re-imported `document`.
+    """
+    changed = [name for name in fields if getattr(document, name) != fields[name]]
+    for name in changed:
+        old = getattr(document, name)
+        print("  document {}: {!r} -> {!r}".format(name, old, fields[name]))
+        setattr(document, name, fields[name])
+    if changed and not dry_run:
+        document.save(update_fields=changed)
@@ -25,4 +25,140 @@
 
 from django.test import TestCase
 
-# Create your tests here.
+from alignmentapp.models import CurriculumDocument, StandardNode
+from importing.bulkloader import bulk_load_tree
+from importing.treediff import diff_tree, reimport_tree
+
+
+def make_tree():
+    return dict(
+        title="Doc",
+        children=[
+            dict(
+                identifier="1",
+                title="Numbers",
+                children=[
+                    dict(identifier="1.1", title="Counting"),
+                    dict(identifier="1.2", title="Addition"),
+                ],
+            ),
+            dict(
+                identifier="2",
+                title="Shapes",
+                children=[dict(identifier="2.1", title="Triangles")],
+            ),
+        ],
+    )
+
+
+class TreeDiffTestCase(TestCase):
+    def setUp(self):
+        self.document = CurriculumDocument.objects.create(
+            source_id="treediff",
+            title="Doc",
+            country="Kenya",
+            digitization_method="manual_entry",
+        )
+        bulk_load_tree(make_tree(), self.document)
+        self.ids = self.get_ids()
+
+    def get_ids(self):
+        nodes = StandardNode.objects.filter(document=self.document)
+        return {node.identifier: node.id for node in nodes}
+
+    def get_node(self, identifier):
+        return StandardNode.objects.get(document=self.document, identifier=identifier)
+
+    def assertTreeConsistent(self):
+        nodes = list(StandardNode.objects.filter(document=self.document))
+        paths = {node.path for node in nodes}
+        for node in nodes:
+            self.assertEqual(node.depth, len(node.path) // node.steplen)
+            if node.depth > 1:
+                self.assertIn(node.path[: -node.steplen], paths)
+            children = [
+                other
+                for other in nodes
+                if other.depth == node.depth + 1 and other.path.startswith(node.path)
+            ]
+            self.assertEqual(node.numchild, len(children))
+        self.assertEqual(StandardNode.find_problems(), ([], [], [], [], []))
+
+    def test_unchanged_tree(self):
+        diff = reimport_tree(make_tree(), self.document)
+        self.assertTrue(diff.is_empty)
+        self.assertEqual(self.get_ids(), self.ids)
+        self.assertTreeConsistent()
+
+    def test_update_keeps_matched_nodes(self):
+        tree = make_tree()
+        tree["children"][0]["children"][0]["title"] = "Counting to ten"
+        diff = reimport_tree(tree, self.document)
+        self.assertEqual(len(diff.updates), 1)
+        self.assertEqual(diff.inserts, [])
+        self.assertEqual(diff.deletes, [])
+        self.assertEqual(self.get_ids(), self.ids)
+        self.assertEqual(self.get_node("1.1").title, "Counting to ten")
+        self.assertTreeConsistent()
+
+    def test_move(self):
+        tree = make_tree()
+        addition = tree["children"][0]["children"].pop()
+        tree["children"][1]["children"].append(addition)
+        diff = reimport_tree(tree, self.document)
+        self.assertEqual([node.id for node in diff.moves], [self.ids["1.2"]])
+        self.assertEqual(self.get_ids(), self.ids)
+        self.assertEqual(self.get_node("1.2").get_parent().id, self.ids["2"])
+        self.assertEqual(self.get_node("1").numchild, 1)
+        self.assertEqual(self.get_node("2").numchild, 2)
+        self.assertTreeConsistent()
+
+    def test_delete(self):
+        tree = make_tree()
+        del tree["children"][1]
+        diff = reimport_tree(tree, self.document)
+        deleted_ids = {node.id for node in diff.deletes}
+        self.assertEqual(deleted_ids, {self.ids["2"], self.ids["2.1"]})
+        self.assertFalse(StandardNode.objects.filter(id__in=deleted_ids).exists())
+        self.assertEqual(self.document.root.numchild, 1)
+        self.assertTreeConsistent()
+
+    def test_insert(self):
+        tree = make_tree()
+        tree["children"][0]["children"].append(dict(identifier="1.3", title="Zero"))
+        tree["children"].append(
+            dict(
+                identifier="3",
+                title="Measures",
+                children=[dict(identifier="3.1", title="Length")],
+            )
+        )
+        diff = reimport_tree(tree, self.document)
+        self.assertEqual(
+            sorted(node.identifier for node in diff.inserts), ["1.3", "3", "3.1"]
+        )
+        ids = self.get_ids()
+        for identifier, node_id in self.ids.items():
+            self.assertEqual(ids[identifier], node_id)
+        self.assertEqual(
+            [node.identifier for node in self.get_node("1").get_children()],
+            ["1.1", "1.2", "1.3"],
+        )
+        self.assertEqual(self.get_node("3.1").get_parent().id, ids["3"])
+        self.assertTreeConsistent()
+
+    def test_match_by_position(self):
+        tree = make_tree()
+        tree["children"][0]["children"] = [
+            dict(identifier="", title="First"),
+            dict(identifier="", title="Second"),
+        ]
+        reimport_tree(tree, self.document)
+        children = list(self.get_node("1").get_children())
+        tree["children"][0]["children"][1]["title"] = "Second, edited"
+        diff = diff_tree(tree, self.document)
+        self.assertEqual(len(diff.updates), 1)
+        self.assertEqual(diff.inserts, [])
+        self.assertEqual(diff.deletes, [])
+        self.assertEqual(diff.updates[0][0].id, children[1].id)
+        self.assertEqual(diff.updates[0][0].title, "Second, edited")
@@ -0,0 +1,252 @@
+##################################################
+# MIT License
+#
+# Copyright (c) 2019 Learning Equality
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+##################################################
+
+from collections import Counter, defaultdict
+
+from django.db import models, transaction
+from django.utils import timezone
+
+from alignmentapp.models import StandardNode, Tombstone
+from importing.bulkloader import BULK_CREATE_BATCH_SIZE, NODE_FIELDS
+from importing.bulkloader import build_nodes, get_new_root_path
+
+
+# the StandardNode fields written when a matched node changes
+UPDATE_FIELDS = NODE_FIELDS + ["path", "depth", "numchild"]
+
+# paths are temporarily prefixed with this (not in the treebeard alphabet) while
+# nodes are being moved, so that the unique constraint on `path` is never violated
+TEMPORARY_PATH_PREFIX = "x"
+
+
+class TreeDiff(object):
+    """
+    The plan to turn the existing nodes of `document` into the dict `tree`:
+      - `pairs`: the `(subtree, node)` pairs of all the incoming nodes in path
+        order, where `node` is the existing StandardNode when it was matched;
+      - `inserts`: the new (unsaved) StandardNodes;
+      - `updates`: `(node, changes)` pairs for the matched nodes that changed,
+        where `changes` maps field names to `(old, new)` values;
+      - `moves`: the updated nodes that have a different parent;
+      - `deletes`: the existing nodes that didn't match any incoming node.
+    """
+
+    def __init__(self, document, tree):
+        self.document = document
+        self.tree = tree
+        self.pairs = []
+        self.inserts = []
+        self.updates = []
+        self.moves = []
+        self.deletes = []
+
+    @property
+    def is_empty(self):
+        return not (self.inserts or self.updates or self.deletes)
+
+    def print_report(self, verbose=True):
+        print(
+            "Re-import of {}: {} inserts, {} updates ({} moves), {} deletes".format(
+                self.document.source_id,
+                len(self.inserts),
+                len(self.updates),
+                len(self.moves),
+                len(self.deletes),
+            )
+        )
+        if not verbose:
+            return
+        for node in self.inserts:
+            print("  + [{}] {}".format(node.identifier, node.title))
+        for node, changes in self.updates:
+            print("  ~ [{}] {}".format(node.identifier, node.title))
+            for field, (old, new) in changes.items():
+                print("      {}: {!r} -> {!r}".format(field, old, new))
+        for node in self.deletes:
+            print("  - [{}] {}".format(node.identifier, node.title))
+
+
+# HIGH LEVEL API
+################################################################################
+
+
+def add_reimport_arguments(parser):
+    """
+    Add the `--incremental` and `--dry_run` options to an importer command.
+    """
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Update the existing document in place instead of recreating it.",
+    )
+    parser.add_argument(
+        "--dry_run",
+        action="store_true",
+        help="Only print the changes an --incremental import would make.",
+    )
+
+
+def reimport_tree(tree, document, dry_run=False):
+    """
+    Incrementally update the nodes of `document` to match the dict `tree`,
+    preserving the nodes (and the human judgments on them) that didn't change.
+    With `dry_run`, only print the plan.
+    """
+    diff = diff_tree(tree, document)
+    diff.print_report()
+    if not dry_run:
+        apply_tree_diff(diff)
+    return diff
+
+
+def diff_tree(tree, document):
+    """
+    Match the nodes of the dict `tree` (as accepted by `bulk_load_tree`) to the
+    existing nodes of `document`, and compute the minimal set of inserts,
+    updates, moves, and deletes. Nodes are matched:
+      1. by `identifier`, when it is unique both in `tree` and in the document
+         (wherever the node is, so nodes can move to another parent);
+      2. otherwise by position: the k-th child of a matched parent with a given
+         identifier is matched with the k-th such existing child.
+    Makes a single query for the existing nodes.
+    """
+    diff = TreeDiff(document, tree)
+    existing = list(StandardNode.objects.filter(document=document).order_by("path"))
+    root = existing[0] if existing else None
+    assert root is None or root.depth == 1, "document has no root node"
+    root_path = root.path if root else get_new_root_path()
+
+    # the target nodes, with their final paths, depths, and numchild
+    target_pairs = build_nodes(tree, document, root_path)
+    target_parents = {}  # id(subtree) --> parent subtree
+    for subtree, _ in target_pairs:
+        for child in subtree.get("children", []):
+            target_parents[id(child)] = subtree
+
+    existing_by_path = {node.path: node for node in existing}
+    existing_children = defaultdict(list)
+    for node in existing[1:]:
+        existing_children[node.path[: -node.steplen]].append(node)
+
+    # identifiers that are unique on both sides are matched globally
+    incoming_counts = Counter(
+        subtree.get("identifier") or "" for subtree, _ in target_pairs
+    )
+    existing_counts = Counter(node.identifier for node in existing)
+    existing_by_identifier = {node.identifier: node for node in existing}
+
+    def is_global(identifier):
+        return (
+            bool(identifier)
+            and incoming_counts[identifier] == 1
+            and existing_counts[identifier] == 1
+        )
+
+    matches = {}  # id(subtree) --> existing node
+    matched_ids = set()
+    if root is not None:
+        matches[id(tree)] = root
+        matched_ids.add(root.id)
+    for subtree, _ in target_pairs:  # path order, so parents are matched first
+        if subtree is tree:
+            continue
+        identifier = subtree.get("identifier") or ""
+        if is_global(identifier) and existing_by_identifier[identifier] is not root:
+            match = existing_by_identifier[identifier]
+        else:
+            parent_match = matches.get(id(target_parents[id(subtree)]))
+            if parent_match is None:
+                continue
+            candidates = [
+                candidate
+                for candidate in existing_children[parent_match.path]
+                if candidate.identifier == identifier
+                and candidate.id not in matched_ids
+            ]
+            if not candidates:
+                continue
+            match = candidates[0]
+        matches[id(subtree)] = match
+        matched_ids.add(match.id)
+
+    for subtree, target in target_pairs:
+        node = matches.get(id(subtree))
+        if node is None:
+            diff.inserts.append(target)
+            diff.pairs.append((subtree, target))
+            continue
+        diff.pairs.append((subtree, node))
+        changes = {}
+        for field in UPDATE_FIELDS:
+            old, new = getattr(node, field), getattr(target, field)
+            if old != new:
+                changes[field] = (old, new)
+                setattr(node, field, new)
+        if changes:
+            diff.updates.append((node, changes))
+            if "path" in changes and subtree is not tree:
+                old_parent = existing_by_path.get(changes["path"][0][: -node.steplen])
+                new_parent = matches.get(id(target_parents[id(subtree)]))
+                if new_parent is None or new_parent is not old_parent:
+                    diff.moves.append(node)
+
+    diff.deletes = [node for node in existing if node.id not in matched_ids]
+    return diff
+
+
+def apply_tree_diff(diff, batch_size=BULK_CREATE_BATCH_SIZE):
+    """
+    Apply the plan `diff` in a single transaction.
+    """
+    with transaction.atomic():
+        if diff.deletes:
+            # bypass MP_NodeQuerySet.delete, which also deletes all the nodes
+            # under the deleted paths and updates numchild one node at a time:
+            # moved descendants must survive, and the plan sets numchild itself
+            ids = [node.id for node in diff.deletes]
+            Tombstone.bury_nodes(StandardNode.objects.filter(id__in=ids))
+            models.QuerySet.delete(StandardNode.objects.filter(id__in=ids))
+
+        updated = [node for node, _ in diff.updates]
+        moved = [node for node, changes in diff.updates if "path" in changes]
+        if moved:
+            for node in moved:
+                node.path = TEMPORARY_PATH_PREFIX + node.path
+            StandardNode.objects.bulk_update(moved, ["path"], batch_size=batch_size)
+            for node in moved:
+                node.path = node.path[len(TEMPORARY_PATH_PREFIX) :]
+        if updated:
+            # bulk_update doesn't set auto_now fields, which delta exports need
+            now = timezone.now()
+            for node in updated:
+                node.modified = now
+            StandardNode.objects.bulk_update(
+                updated, UPDATE_FIELDS + ["modified"], batch_size=batch_size
+            )
+
+        if diff.inserts:
+            StandardNode.objects.bulk_create(diff.inserts, batch_size=batch_size)
+    return diff
+